@@ -0,0 +1,267 @@
+"""
+Нагрузочные замеры горячих путей бота на синтетических данных
+
+Запуск:
+    python benchmark.py                              # размеры истории 1, 100, 1000, 10000
+    python benchmark.py --sizes 1,100000 --users 5   # свои размеры и число пользователей для рассылки
+    python benchmark.py --save-baseline              # сохранить результаты как базовые
+    python benchmark.py --baseline bench_baseline.json --tolerance 0.2
+
+Замеры выполняются во временной папке (рабочие файлы бота не затрагиваются) и без сети: вместо Telegram
+используется FakeBot. Для каждого замера выводятся пропускная способность (операций в секунду), средняя
+задержка и пиковая память одной операции (tracemalloc). При сравнении с базовым файлом замедление больше
+tolerance помечается как регрессия, и скрипт завершается с кодом 1.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import datetime
+import tempfile
+import tracemalloc
+
+# Окружение задается до импорта модулей бота: они читают настройки при импорте
+os.environ.setdefault('MY_VAR', '123456:BENCHMARK')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ.setdefault('XLS_FLUSH_DELAY', '3600')
+# FakeBot не ограничивает частоту, поэтому лимиты рассылки снимаются
+os.environ.setdefault('BROADCAST_GLOBAL_RATE', '1000000')
+os.environ.setdefault('BROADCAST_PER_CHAT_RATE', '1000000')
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(SCRIPT_DIR, 'bench_baseline.json')
+
+EXPENSE_CATEGORIES = ("Жилье", "Коммуналка", "Еда", "Проезд", "Интернет", "Сотовая связь", "Одежда", "Медикаменты",
+                      "Процент кредита", "Хоз расходы", "Техника", "Парикмахерская", "Развлечения", "Обучение",
+                      "Подарки", "Прочие")
+INCOME_CATEGORIES = ("Зп на руки", "Зп на карточку", "Шабашки", "Другие")
+
+
+class FakeBot:
+    """
+    Заглушка Telegram: запоминает количество и объем отправленных сообщений, ничего не отправляя
+    """
+
+    def __init__(self):
+        self.sent = 0
+        self.sent_bytes = 0
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        self.sent += 1
+        self.sent_bytes += len(text.encode('utf-8'))
+
+
+def generate_user(user_id, size, today, seed=0):
+    """
+    Функция для создания синтетического пользователя с историей из size операций
+    :return: Разделы журнала ledger/ГГГГ-ММ.jsonl пишутся напрямую (как после миграции); операции распределены
+    по последним дням, последние из них приходятся на сегодняшний день, чтобы ежедневный отчет был не пустым.
+    """
+    rng = random.Random(f'{seed}-{user_id}-{size}')
+    folder = f'user_files/{user_id}/ledger'
+    os.makedirs(folder, exist_ok=True)
+    per_day = 20
+    partitions = {}
+    for index in range(size):
+        day = today - datetime.timedelta(days=(size - 1 - index) // per_day)
+        seconds = 8 * 3600 + ((size - 1 - index) % per_day) * 60
+        is_income = rng.random() < 0.1
+        partitions.setdefault(day.strftime("%Y-%m"), []).append(json.dumps({
+            "op": "add",
+            "date": day.strftime("%d.%m.%Y"),
+            "time": f'{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:00',
+            "description": None if rng.random() < 0.5 else f'покупка {index}',
+            "type": 'Доход' if is_income else 'Расход',
+            "category": rng.choice(INCOME_CATEGORIES if is_income else EXPENSE_CATEGORIES),
+            "amount": rng.randint(50, 5000)
+        }, ensure_ascii=False) + '\n')
+    for period, lines in partitions.items():
+        with open(f'{folder}/{period}.jsonl', 'w', encoding='utf-8') as file:
+            file.write(''.join(lines))
+
+
+async def measure(name, size, operation, iterations, prepare=None):
+    """
+    Функция для замера одного горячего пути
+    :param operation: Корутина без аргументов (одна операция); получает номер итерации
+    :param iterations: Количество операций в замере
+    :param prepare: Корутина, вызываемая перед каждой операцией вне замера (например, сброс кэша)
+
+    :return: Словарь {name, size, iterations, ops_per_sec, avg_ms, peak_kib}. Время и память меряются
+    отдельными проходами, потому что tracemalloc сам замедляет выполнение.
+    """
+    elapsed = 0.0
+    for index in range(iterations):
+        if prepare is not None:
+            await prepare(index)
+        started = time.perf_counter()
+        await operation(index)
+        elapsed += time.perf_counter() - started
+
+    if prepare is not None:
+        await prepare(iterations)
+    tracemalloc.start()
+    await operation(iterations)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "name": name,
+        "size": size,
+        "iterations": iterations,
+        "ops_per_sec": iterations / elapsed if elapsed else float('inf'),
+        "avg_ms": elapsed / iterations * 1000,
+        "peak_kib": peak / 1024
+    }
+
+
+async def run_size(main, size, users, iterations):
+    """
+    Функция для всех замеров одного размера истории
+    """
+    import job_xls
+    import job_json
+    import job_registry
+    import job_aggregates
+
+    today = datetime.datetime.now()
+    date_str = today.strftime("%d.%m.%Y")
+    user_id = 10 ** 9 + size
+    generate_user(user_id, size, today)
+    await job_aggregates.rebuild(user_id)
+    results = []
+
+    def time_str(index):
+        seconds = 20 * 3600 + index
+        return f'{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}'
+
+    async def add(index):
+        await job_json.description_operation(user_id, 'Расход', 'Еда', 100, date_str, time_str(index))
+    results.append(await measure('description_operation', size, add, iterations))
+
+    async def describe(index):
+        await job_json.get_description_text(user_id, date_str, time_str(index % iterations), f'описание {index}')
+    results.append(await measure('get_description_text', size, describe, iterations))
+
+    async def report(index):
+        await job_json.read_and_process_file(user_id)
+
+    async def drop_report(index):
+        # Холодный путь: отчет за день собирается заново по журналу
+        job_json._daily_reports.pop(str(user_id), None)
+    results.append(await measure('read_and_process_file (cold)', size, report, max(1, iterations // 10),
+                                 prepare=drop_report))
+    results.append(await measure('read_and_process_file (warm)', size, report, iterations))
+
+    async def validate(index):
+        await job_xls.data_validator(user_id, EXPENSE_CATEGORIES[index % len(EXPENSE_CATEGORIES)], 100)
+    results.append(await measure('data_validator (no workbook)', size, validate, iterations))
+    await job_xls.ensure_xls(user_id)
+    results.append(await measure('data_validator (workbook)', size, validate, iterations))
+    await job_xls.flush_user(user_id)
+
+    # В рассылке участвуют пользователь замеров выше и users дополнительных пользователей того же размера
+    broadcast_users = [2 * 10 ** 9 + size * 1000 + index for index in range(users)]
+    for broadcast_user in broadcast_users:
+        generate_user(broadcast_user, size, today)
+        # Журнал записан напрямую, поэтому операцию за сегодня в реестре отмечаем сами
+        await job_registry.mark_active(broadcast_user, today)
+    bot = FakeBot()
+
+    async def broadcast(index):
+        await main.send_daily_message(send=bot.send_message)
+    results.append(await measure(f'send_daily_message ({users + 1} users)', size, broadcast, 1))
+
+    # Пользователи этого размера удаляются, чтобы не попасть в рассылку следующего
+    job_xls.drop_user(user_id)
+    for folder_user in [user_id] + broadcast_users:
+        shutil.rmtree(f'user_files/{folder_user}', ignore_errors=True)
+        job_registry.reset(folder_user)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Функция для сравнения результатов с базовыми
+    :return: Список строк отчета и признак регрессии (пропускная способность упала больше чем на tolerance)
+    """
+    lines = []
+    regression = False
+    header = f"{'замер':<36} {'N':>7} {'оп/с':>11} {'мс/оп':>9} {'пик КиБ':>10} {'к базе':>8}"
+    lines.append(header)
+    lines.append('-' * len(header))
+    for result in results:
+        key = f"{result['name']}@{result['size']}"
+        delta = ''
+        if key in baseline:
+            change = result['ops_per_sec'] / baseline[key]['ops_per_sec'] - 1
+            delta = f'{change:+.0%}'
+            if change < -tolerance:
+                delta += ' !'
+                regression = True
+        lines.append(f"{result['name']:<36} {result['size']:>7} {result['ops_per_sec']:>11.1f} "
+                     f"{result['avg_ms']:>9.3f} {result['peak_kib']:>10.1f} {delta:>8}")
+    return lines, regression
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix='fin-bench-')
+    os.chdir(workdir)
+    os.makedirs('user_files', exist_ok=True)
+    sys.path.insert(0, SCRIPT_DIR)
+    import main
+    import job_xls
+    import job_pool
+    main.setup()
+
+    results = []
+    try:
+        for size in args.sizes:
+            results += await run_size(main, size, args.users, args.iterations)
+    finally:
+        await job_xls.flush_all()
+        job_pool.shutdown()
+        await main.dp.storage.close()
+    return results, workdir
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Замеры горячих путей бота на синтетических данных")
+    parser.add_argument('--sizes', default='1,100,1000,10000',
+                        type=lambda value: [int(size) for size in value.split(',')],
+                        help="размеры истории пользователя через запятую (1..100000)")
+    parser.add_argument('--users', type=int, default=10, help="число пользователей в замере рассылки")
+    parser.add_argument('--iterations', type=int, default=200, help="операций в каждом замере")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help="файл с базовыми результатами")
+    parser.add_argument('--save-baseline', action='store_true', help="сохранить результаты как базовые")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="допустимое падение пропускной способности")
+    parser.add_argument('--keep', action='store_true', help="не удалять временную папку с синтетическими данными")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    results, workdir = asyncio.run(run(args))
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as file:
+            baseline = json.load(file)
+    lines, regression = compare(results, baseline, args.tolerance)
+    print('\n'.join(lines))
+    if args.keep:
+        print(f"\nРабочая папка: {workdir}")
+    else:
+        os.chdir(SCRIPT_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as file:
+            json.dump({f"{result['name']}@{result['size']}": result for result in results}, file,
+                      ensure_ascii=False, indent=2)
+        print(f"Базовые результаты сохранены в {args.baseline}")
+    sys.exit(1 if regression and not args.save_baseline else 0)
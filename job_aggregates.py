@@ -0,0 +1,231 @@
+import os
+import json
+import datetime
+import aiofiles
+
+import job_lock
+import job_json
+import job_cache
+
+# Категории доходов; все остальные категории считаются расходами
+INCOME_CATEGORIES = ("Зп на руки", "Зп на карточку", "Шабашки", "Другие")
+
+MONTH_NAMES = {
+    1: 'Январь', 2: 'Февраль', 3: 'Март', 4: 'Апрель',
+    5: 'Май', 6: 'Июнь', 7: 'Июль', 8: 'Август',
+    9: 'Сентябрь', 10: 'Октябрь', 11: 'Ноябрь', 12: 'Декабрь'
+}
+
+# Суммы в памяти: id пользователя -> {"ГГГГ-ММ": {категория: сумма}, WAL_KEY: номер записи журнала намерений}.
+# Суммы пользователя, который сейчас их изменяет, не вытесняются: иначе параллельное чтение загрузило бы
+# из файла копию без его изменений, и следующая запись продолжила бы с нее.
+_aggregates = job_cache.LRUCache(busy=lambda key, data: job_lock.is_locked(key, 'aggregates'))
+
+# Ключ, под которым хранится номер последней учтенной записи журнала намерений (job_wal)
+WAL_KEY = '_wal'
+
+
+def _aggregates_path(user_id):
+    return f'user_files/{user_id}/aggregates.json'
+
+
+def _month_key(year, month):
+    return f'{year:04d}-{month:02d}'
+
+
+def _sums_from_ledger(ledger):
+    """
+    Функция для подсчета месячных сумм по журналу операций
+    :return: Кортеж (суммы {"ГГГГ-ММ": {категория: сумма}}, количество учтенных операций)
+    """
+    data = {}
+    count = 0
+    for date_str, day in ledger.items():
+        date = datetime.datetime.strptime(date_str, "%d.%m.%Y")
+        month = data.setdefault(_month_key(date.year, date.month), {})
+        for entry in day.values():
+            month[entry['category']] = month.get(entry['category'], 0) + entry['amount']
+            count += 1
+    return data, count
+
+
+async def _load(user_id):
+    """
+    Функция для получения сумм пользователя: из памяти, а при первом обращении — из файла aggregates.json
+    (в памяти хранятся суммы job_cache.CACHE_SIZE пользователей, вытесненные читаются из файла заново)
+
+    Примечание:
+    - У пользователей, появившихся до месячных сумм, файла aggregates.json нет. Для них суммы один раз
+    подсчитываются по журналу операций и сразу сохраняются, чтобы "Расходы за месяц" не показывали 0.
+    - Первое обращение к суммам при операции происходит до ее записи в журнал (job_wal берет номер записи
+    из сумм), поэтому операция не попадает в подсчет и не учитывается дважды.
+    """
+    key = str(user_id)
+    data = _aggregates.get(key)
+    if data is None:
+        file_path = _aggregates_path(user_id)
+        if os.path.exists(file_path):
+            async with aiofiles.open(file_path, 'r', encoding='utf-8') as file:
+                data = json.loads(await file.read())
+            # Пока файл читался, суммы мог загрузить и уже изменить другой вызов: остаются его суммы
+            current = _aggregates.get(key)
+            if current is not None:
+                return current
+            _aggregates[key] = data
+        elif os.path.isdir(os.path.dirname(file_path)):
+            data, _ = _sums_from_ledger(await job_json.load_ledger(user_id))
+            _aggregates[key] = data
+            await _save(user_id, data)
+        else:
+            data = _aggregates[key] = {}
+    return data
+
+
+async def _save(user_id, data):
+    file_path = _aggregates_path(user_id)
+    if not os.path.isdir(os.path.dirname(file_path)):
+        return
+    tmp_path = f'{file_path}.tmp'
+    async with aiofiles.open(tmp_path, 'w', encoding='utf-8') as file:
+        await file.write(json.dumps(data, ensure_ascii=False))
+    os.replace(tmp_path, file_path)
+
+
+async def add(user_id, category, amount, date=None, seq=None):
+    """
+    Функция для инкрементального обновления месячной суммы категории
+    :param user_id: ID пользователя
+    :param category: Категория дохода или расхода
+    :param amount: Сумма операции
+    :param date: Дата операции (по умолчанию — текущая)
+    :param seq: Номер записи журнала намерений (job_wal), которой соответствует операция
+
+    :type user_id: int
+    :type category: str
+    :type amount: int
+    :type date: datetime.date
+    :type seq: int
+
+    :return: Сумма категории за месяц увеличивается в памяти, файл aggregates.json перезаписывается целиком
+    (он содержит не больше 12 * 20 чисел в год, поэтому запись дешевая). Номер seq записывается в тот же файл
+    той же атомарной записью, поэтому по нему точно видно, учтена ли операция. Сохраняется наибольший
+    из учтенных номеров: номер не уменьшается, даже если операции применены не по порядку.
+    """
+    date = date or datetime.datetime.now()
+    async with job_lock.user_lock(user_id, 'aggregates'):
+        data = await _load(user_id)
+        month = data.setdefault(_month_key(date.year, date.month), {})
+        month[category] = month.get(category, 0) + amount
+        if seq is not None:
+            data[WAL_KEY] = max(data.get(WAL_KEY, 0), seq)
+        await _save(user_id, data)
+
+
+async def add_many(user_id, items, seq=None):
+    """
+    Функция для пакетного обновления месячных сумм
+    :param user_id: ID пользователя
+    :param items: Итерируемый набор кортежей (дата, категория, сумма)
+    :param seq: Номер последней записи журнала намерений (job_wal), вошедшей в пачку
+
+    :type user_id: int
+    :type items: iterable
+    :type seq: int
+
+    :return: Все суммы обновляются в памяти, файл aggregates.json записывается один раз
+    """
+    async with job_lock.user_lock(user_id, 'aggregates'):
+        data = await _load(user_id)
+        for date, category, amount in items:
+            month = data.setdefault(_month_key(date.year, date.month), {})
+            month[category] = month.get(category, 0) + amount
+        if seq is not None:
+            data[WAL_KEY] = max(data.get(WAL_KEY, 0), seq)
+        await _save(user_id, data)
+
+
+async def applied_seq(user_id):
+    """
+    Функция для получения номера последней записи журнала намерений, учтенной в суммах
+    :return: Номер записи (0, если записей еще не было)
+    """
+    data = await _load(user_id)
+    return data.get(WAL_KEY, 0)
+
+
+async def month_summary(user_id, year, month):
+    """
+    Функция для получения сумм по категориям за месяц
+    :return: Словарь {категория: сумма}; пустой, если операций за месяц не было
+    """
+    data = await _load(user_id)
+    return dict(data.get(_month_key(year, month), {}))
+
+
+async def years(user_id):
+    """
+    Функция для получения списка лет, за которые у пользователя есть месячные суммы
+    :return: Отсортированный список годов
+    """
+    data = await _load(user_id)
+    return sorted({int(key[:4]) for key in data if key != WAL_KEY})
+
+
+async def year_summary(user_id, year):
+    """
+    Функция для получения сумм по категориям за все месяцы года
+    :return: Словарь {номер месяца: {категория: сумма}}
+    """
+    data = await _load(user_id)
+    return {month: dict(data.get(_month_key(year, month), {})) for month in MONTH_NAMES}
+
+
+async def month_totals(user_id, year, month):
+    """
+    Функция для получения итогов за месяц
+    :param user_id: ID пользователя
+    :param year: Год
+    :param month: Номер месяца (1-12)
+
+    :type user_id: int
+    :type year: int
+    :type month: int
+
+    :return: Кортеж (доходы, расходы) за месяц. Значения берутся из памяти, книга Excel не открывается.
+    """
+    summary = await month_summary(user_id, year, month)
+    income = sum(amount for category, amount in summary.items() if category in INCOME_CATEGORIES)
+    expense = sum(amount for category, amount in summary.items() if category not in INCOME_CATEGORIES)
+    return income, expense
+
+
+async def rebuild(user_id):
+    """
+    Функция для пересчета всех месячных сумм пользователя по журналу операций
+    :param user_id: ID пользователя
+
+    :type user_id: int
+
+    :return: Количество учтенных операций. Суммы в памяти и в файле aggregates.json заменяются пересчитанными.
+
+    Примечание:
+    - Журнал читается под блокировками 'wal_apply' и 'aggregates' (в том же порядке, что и при записи операции
+    в job_wal): операция, записанная между чтением журнала и заменой сумм, иначе потерялась бы или, если она
+    уже в журнале, но еще не в суммах, была бы учтена дважды.
+    """
+    async with job_lock.user_lock(user_id, 'wal_apply'), job_lock.user_lock(user_id, 'aggregates'):
+        # Номер записи журнала намерений сохраняется: пересчет по журналу операций его не меняет
+        previous = await _load(user_id)
+        data, count = _sums_from_ledger(await job_json.load_ledger(user_id))
+        if WAL_KEY in previous:
+            data[WAL_KEY] = previous[WAL_KEY]
+        _aggregates[str(user_id)] = data
+        await _save(user_id, data)
+    return count
+
+
+def drop_user(user_id):
+    """
+    Функция для удаления сумм пользователя из памяти (используется при сбросе данных)
+    """
+    _aggregates.pop(str(user_id), None)
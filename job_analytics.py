@@ -0,0 +1,144 @@
+import os
+import asyncio
+import datetime
+
+import numpy as np
+import pandas as pd
+
+import job_json
+import job_cache
+
+# Столбцы таблицы операций
+COLUMNS = ('date', 'type', 'category', 'amount', 'description')
+
+# Сколько таблиц операций хранится в памяти (таблица занимает память пропорционально истории пользователя)
+FRAME_CACHE_SIZE = int(os.getenv('ANALYTICS_CACHE_SIZE', 64))
+
+# Кэш таблиц операций: id пользователя -> (версия журнала, DataFrame)
+_frames = job_cache.LRUCache(FRAME_CACHE_SIZE)
+
+
+def _build_frame(user_id):
+    """
+    Функция для загрузки журнала пользователя в столбцовую таблицу pandas
+    :return: DataFrame со столбцами COLUMNS, где date — datetime64 (дата и время операции), amount — float.
+    Функция блокирующая и вызывается через `asyncio.to_thread()`.
+    """
+    rows = ((f'{date_str} {time_str}', entry['type'], entry['category'], entry['amount'], entry['description'])
+            for date_str, time_str, entry in job_json.iter_transactions(user_id))
+    frame = pd.DataFrame.from_records(rows, columns=COLUMNS)
+    frame['date'] = pd.to_datetime(frame['date'], format="%d.%m.%Y %H:%M:%S")
+    frame['amount'] = pd.to_numeric(frame['amount'], errors='coerce').fillna(0).astype(float)
+    frame['type'] = frame['type'].astype('category')
+    frame['category'] = frame['category'].astype('category')
+    return frame
+
+
+async def get_frame(user_id):
+    """
+    Функция для получения таблицы операций пользователя
+    :param user_id: ID пользователя
+
+    :type user_id: int
+
+    :return: DataFrame со всеми операциями. Таблица строится один раз и хранится в памяти, пока не изменится
+    версия журнала `job_json.ledger_version()` (добавление операции, изменение описания, сброс данных).
+    """
+    version = job_json.ledger_version(user_id)
+    cached = _frames.get(str(user_id))
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    if job_json.STORAGE_BACKEND == 'jsonl':
+        await job_json.ensure_ledger(user_id)
+    frame = await asyncio.to_thread(_build_frame, user_id)
+    _frames[str(user_id)] = (version, frame)
+    return frame
+
+
+def invalidate(user_id):
+    """
+    Функция для удаления таблицы операций пользователя из кэша (используется при сбросе данных)
+    """
+    _frames.pop(str(user_id), None)
+
+
+def _expenses(frame):
+    return frame[frame['type'] == 'Расход']
+
+
+def _month_mask(frame, year, month):
+    return (frame['date'].dt.year == year) & (frame['date'].dt.month == month)
+
+
+async def month_over_month(user_id, months=6):
+    """
+    Функция для сравнения расходов по месяцам
+    :param user_id: ID пользователя
+    :param months: Сколько последних месяцев показать
+
+    :type user_id: int
+    :type months: int
+
+    :return: DataFrame с индексом-месяцем (pandas.Period) и столбцами expense (сумма расходов) и change
+    (изменение к предыдущему месяцу в процентах, NaN для первого месяца и после месяца без расходов).
+    """
+    frame = _expenses(await get_frame(user_id))
+    end = pd.Period(datetime.date.today(), freq='M')
+    index = pd.period_range(end=end, periods=months, freq='M')
+    totals = frame.groupby(frame['date'].dt.to_period('M'))['amount'].sum()
+    totals = totals.reindex(pd.period_range(end=end, periods=months + 1, freq='M'), fill_value=0.0)
+    change = totals.pct_change().replace([np.inf, -np.inf], np.nan) * 100
+    return pd.DataFrame({'expense': totals, 'change': change}).loc[index]
+
+
+async def by_category(user_id, year, month=None, type_operation='Расход'):
+    """
+    Функция для получения сумм по категориям за месяц или год
+    :param user_id: ID пользователя
+    :param year: Год
+    :param month: Номер месяца (1-12); None — весь год
+    :param type_operation: Тип операций: 'Расход' или 'Доход'
+
+    :return: Series {категория: сумма}, отсортированная по убыванию, без категорий с нулевой суммой
+    """
+    frame = await get_frame(user_id)
+    period = _month_mask(frame, year, month) if month is not None else frame['date'].dt.year == year
+    frame = frame[(frame['type'] == type_operation) & period]
+    totals = frame.groupby('category', observed=True)['amount'].sum()
+    return totals[totals > 0].sort_values(ascending=False)
+
+
+async def average_daily_spend(user_id, year, month):
+    """
+    Функция для расчета среднего расхода в день за месяц
+    :param user_id: ID пользователя
+    :param year: Год
+    :param month: Номер месяца (1-12)
+
+    :return: Сумма расходов за месяц, деленная на число дней месяца. Для текущего месяца делится
+    на число уже прошедших дней (включая сегодняшний).
+    """
+    frame = _expenses(await get_frame(user_id))
+    total = frame.loc[_month_mask(frame, year, month), 'amount'].sum()
+    today = datetime.date.today()
+    if (year, month) == (today.year, today.month):
+        days = today.day
+    else:
+        days = pd.Period(year=year, month=month, freq='M').days_in_month
+    return float(total) / days
+
+
+async def top_expenses(user_id, n=5, year=None, month=None):
+    """
+    Функция для получения самых крупных расходов
+    :param user_id: ID пользователя
+    :param n: Количество операций
+    :param year: Год (вместе с month ограничивает выборку одним месяцем; None — вся история)
+    :param month: Номер месяца (1-12)
+
+    :return: DataFrame из n операций с наибольшей суммой, по убыванию суммы
+    """
+    frame = _expenses(await get_frame(user_id))
+    if year is not None and month is not None:
+        frame = frame[_month_mask(frame, year, month)]
+    return frame.nlargest(n, 'amount')
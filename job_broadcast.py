@@ -0,0 +1,195 @@
+import os
+import time
+import asyncio
+import logging
+
+from aiogram.utils.exceptions import RetryAfter, NetworkError, BotBlocked, ChatNotFound, UserDeactivated
+
+# Общий лимит Telegram на рассылку — около 30 сообщений в секунду
+GLOBAL_RATE = float(os.getenv('BROADCAST_GLOBAL_RATE', 30))
+# Лимит на один чат — не чаще одного сообщения в секунду
+PER_CHAT_RATE = float(os.getenv('BROADCAST_PER_CHAT_RATE', 1))
+# Сколько сообщений отправляется одновременно
+CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', 20))
+# Сколько раз повторять отправку после RetryAfter или сетевой ошибки
+MAX_RETRIES = 5
+
+
+class TokenBucket:
+    """
+    Ограничитель частоты по алгоритму «ведро с токенами»
+    :param rate: Сколько токенов добавляется в секунду
+    :param capacity: Максимальное количество накопленных токенов (допустимый всплеск), по умолчанию равно rate
+
+    :type rate: float
+    :type capacity: float
+
+    Пример:
+    bucket = TokenBucket(30)
+    await bucket.acquire()  # ждет, пока не появится свободный токен
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """
+        Приостанавливает выдачу токенов (используется, когда Telegram ответил RetryAfter)
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def _read_checkpoint(checkpoint_path, run_id):
+    """
+    Функция для чтения контрольной точки рассылки
+    :return: Множество id чатов, которым сообщение уже доставлено в рамках запуска run_id.
+    Контрольная точка другого запуска игнорируется.
+    """
+    if not checkpoint_path or not os.path.exists(checkpoint_path):
+        return set()
+    with open(checkpoint_path, 'r', encoding='utf-8') as file:
+        lines = file.read().splitlines()
+    if not lines or lines[0] != run_id:
+        return set()
+    return set(lines[1:])
+
+
+def _open_checkpoint(checkpoint_path, run_id, fresh):
+    """
+    Функция открывает контрольную точку для дозаписи; новая контрольная точка начинается со строки run_id
+    :return: Файл, открытый на дозапись, или None, если контрольная точка не ведется
+    """
+    if not checkpoint_path:
+        return None
+    file = open(checkpoint_path, 'w' if fresh else 'a', encoding='utf-8')
+    if fresh:
+        file.write(f'{run_id}\n')
+        file.flush()
+    return file
+
+
+async def broadcast(chat_ids, make_text, send, run_id, checkpoint_path=None, concurrency=CONCURRENCY,
+                    global_rate=GLOBAL_RATE, per_chat_rate=PER_CHAT_RATE):
+    """
+    Асинхронная функция для рассылки сообщений с ограничением частоты и возобновлением после сбоя
+    :param chat_ids: Итерируемый набор id чатов
+    :param make_text: Корутина make_text(chat_id), возвращающая текст сообщения или None (чат пропускается)
+    :param send: Корутина send(chat_id, text), которая отправляет сообщение (например, bot.send_message или
+    локальная заглушка)
+    :param run_id: Идентификатор запуска (например, дата отчета); по нему контрольная точка относится к запуску
+    :param checkpoint_path: Файл контрольной точки (None — без сохранения прогресса)
+    :param concurrency: Количество одновременных отправок
+    :param global_rate: Общий лимит сообщений в секунду
+    :param per_chat_rate: Лимит сообщений в секунду на один чат
+
+    :type chat_ids: iterable
+    :type make_text: callable
+    :type send: callable
+    :type run_id: str
+    :type checkpoint_path: str
+    :type concurrency: int
+    :type global_rate: float
+    :type per_chat_rate: float
+
+    :return: Словарь со счетчиками {'sent', 'skipped', 'failed', 'resumed'}.
+
+    Логика работы:
+    1. Из контрольной точки читаются чаты, которым сообщение уже доставлено в этом запуске, — они пропускаются.
+    2. concurrency задач берут чаты из общей очереди; перед отправкой каждая ждет токен общего ограничителя
+    и ограничителя своего чата. Ограничитель чата создается при первой отправке в него и хранится до конца
+    рассылки, поэтому несколько сообщений одному чату (например, повтор id в chat_ids) идут не чаще per_chat_rate.
+    3. На RetryAfter общий ограничитель ставится на паузу на указанное Telegram время, и отправка повторяется.
+    Сетевые ошибки повторяются с экспоненциальной задержкой, заблокировавшие бота пользователи не повторяются.
+    4. Каждый доставленный чат сразу дописывается в контрольную точку (строка сбрасывается в файл до отправки
+    следующего сообщения); после полного завершения она удаляется.
+
+    Примечание:
+    После сбоя повторно может уйти только сообщение, отправленное в момент сбоя: Telegram уже принял его,
+    а строка в контрольную точку еще не записана.
+    """
+    done = _read_checkpoint(checkpoint_path, run_id)
+    stats = {'sent': 0, 'skipped': 0, 'failed': 0, 'resumed': len(done)}
+    checkpoint = _open_checkpoint(checkpoint_path, run_id, fresh=not done)
+
+    global_bucket = TokenBucket(global_rate)
+    # Ограничители чатов живут до конца рассылки: повторное сообщение в тот же чат ждет токен его ограничителя
+    chat_buckets = {}
+    queue = asyncio.Queue()
+    for chat_id in chat_ids:
+        if str(chat_id) not in done:
+            queue.put_nowait(chat_id)
+
+    def mark_delivered(chat_id):
+        if checkpoint is not None:
+            checkpoint.write(f'{chat_id}\n')
+            checkpoint.flush()
+
+    async def send_one(chat_id, text):
+        bucket = chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = chat_buckets[chat_id] = TokenBucket(per_chat_rate, 1)
+        for attempt in range(MAX_RETRIES + 1):
+            await global_bucket.acquire()
+            await bucket.acquire()
+            try:
+                await send(chat_id, text)
+                return True
+            except RetryAfter as e:
+                logging.warning(f"Telegram попросил подождать {e.timeout} с перед отправкой в чат {chat_id}.")
+                global_bucket.pause(e.timeout)
+            except (BotBlocked, ChatNotFound, UserDeactivated) as e:
+                logging.info(f"Чат {chat_id} недоступен для рассылки: {e}")
+                return False
+            except NetworkError as e:
+                logging.warning(f"Сетевая ошибка при отправке в чат {chat_id} (попытка {attempt + 1}): {e}")
+                await asyncio.sleep(min(2 ** attempt, 30))
+        return False
+
+    async def worker():
+        while True:
+            try:
+                chat_id = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                text = await make_text(chat_id)
+                if text is None:
+                    stats['skipped'] += 1
+                    continue
+                if await send_one(chat_id, text):
+                    stats['sent'] += 1
+                    mark_delivered(chat_id)
+                else:
+                    stats['failed'] += 1
+            except Exception as e:
+                stats['failed'] += 1
+                logging.error(f"Ошибка при отправке сообщения пользователю {chat_id}: {e}")
+
+    try:
+        await asyncio.gather(*[worker() for _ in range(max(1, concurrency))])
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return stats
@@ -0,0 +1,54 @@
+import os
+from collections import OrderedDict
+
+# Сколько пользователей хранится в каждом кэше в памяти (отчеты за день, индексы, версии и суммы, графики)
+CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 1024))
+
+
+class LRUCache(OrderedDict):
+    """
+    Словарь с вытеснением самой давно использованной записи (как кэш книг job_xls)
+    :param maxsize: Наибольшее количество записей, по умолчанию CACHE_SIZE
+    :param busy: Функция busy(key, value): True — запись сейчас вытеснять нельзя (например, пока ее пользователь
+    держит блокировку); такая запись пропускается и вытесняется при следующей вставке
+
+    :type maxsize: int
+    :type busy: callable
+
+    Пример:
+    _reports = LRUCache()
+    _reports[user_id] = report  # при переполнении удаляется самая давно использованная запись
+    """
+
+    def __init__(self, maxsize=None, busy=None):
+        super().__init__()
+        self.maxsize = maxsize if maxsize is not None else CACHE_SIZE
+        self.busy = busy
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        self._trim()
+
+    def _trim(self):
+        excess = len(self) - self.maxsize
+        if excess <= 0:
+            return
+        victims = []
+        for key in self:
+            if len(victims) == excess:
+                break
+            if self.busy is None or not self.busy(key, super().__getitem__(key)):
+                victims.append(key)
+        for key in victims:
+            del self[key]
@@ -0,0 +1,121 @@
+import io
+import datetime
+
+from aiogram.types import InputFile
+
+import job_json
+import job_pool
+import job_cache
+import job_analytics
+import job_aggregates
+
+# Периоды графиков: название в команде -> подпись
+PERIODS = {'month': 'месяц', 'year': 'год'}
+# Сколько месяцев показывается на графике расходов по месяцам
+HISTORY_MONTHS = 12
+
+# Кэш графиков: (id пользователя, период) -> {"key": (период, версия журнала), "png": байты, "file_id": file_id};
+# хранится не больше job_cache.CACHE_SIZE графиков, вытесненный график отрисовывается заново
+_charts = job_cache.LRUCache()
+
+
+def render_chart(title, categories, months):
+    """
+    Функция для отрисовки графика расходов в PNG
+    :param title: Заголовок графика
+    :param categories: Список пар (категория, сумма) за период, по убыванию суммы
+    :param months: Список пар (подпись месяца, сумма расходов) в хронологическом порядке
+
+    :type title: str
+    :type categories: list
+    :type months: list
+
+    :return: Содержимое PNG-файла. Слева — расходы по категориям за период, справа — расходы по месяцам.
+
+    Примечание:
+    - Функция блокирующая и вызывается в пуле процессов через `job_pool.run_in_process()`; данные для нее
+      готовятся заранее, поэтому дочерний процесс не читает журнал.
+    - matplotlib импортируется внутри функции с бэкендом Agg, чтобы основной процесс бота его не загружал.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    figure, (left, right) = plt.subplots(1, 2, figsize=(12, 5))
+    figure.suptitle(title)
+
+    if categories:
+        labels, values = zip(*reversed(categories))
+        left.barh(labels, values, color='tab:red')
+    else:
+        left.text(0.5, 0.5, 'Нет расходов', ha='center', va='center', transform=left.transAxes)
+    left.set_title('По категориям')
+
+    labels, values = zip(*months)
+    right.bar(labels, values, color='tab:blue')
+    right.set_title('По месяцам')
+    right.tick_params(axis='x', labelrotation=45)
+
+    figure.tight_layout()
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format='png', dpi=100)
+    plt.close(figure)
+    return buffer.getvalue()
+
+
+async def _chart_data(user_id, period, now):
+    month = now.month if period == 'month' else None
+    categories = await job_analytics.by_category(user_id, now.year, month)
+    history = await job_analytics.month_over_month(user_id, HISTORY_MONTHS)
+    months = [(f"{job_aggregates.MONTH_NAMES[index.month][:3]} {index.year % 100:02d}", float(row['expense']))
+              for index, row in history.iterrows()]
+    if period == 'month':
+        title = f"Расходы за {job_aggregates.MONTH_NAMES[now.month]} {now.year}"
+    else:
+        title = f"Расходы за {now.year} год"
+    return title, [(category, float(amount)) for category, amount in categories.items()], months
+
+
+async def send_chart(user_id, period, send):
+    """
+    Функция для отправки графика расходов с кэшированием
+    :param user_id: ID пользователя
+    :param period: Период графика: 'month' или 'year' (см. PERIODS)
+    :param send: Корутина отправки фото, например `message.answer_photo`
+
+    :type user_id: int
+    :type period: str
+    :type send: callable
+
+    :return: Сообщение Telegram с графиком.
+
+    Логика работы:
+    1. Ключ кэша — период (месяц или год на сегодня) и версия журнала `job_json.ledger_version()`.
+    2. Если ключ не изменился и у графика уже есть file_id, он отправляется по file_id без загрузки.
+    3. Если ключ не изменился, но file_id нет (прошлая отправка не удалась), загружается сохраненный PNG.
+    4. Иначе график отрисовывается заново в пуле процессов.
+    """
+    now = datetime.datetime.now()
+    key = (now.strftime('%Y-%m') if period == 'month' else now.strftime('%Y'), job_json.ledger_version(user_id))
+    cached = _charts.get((str(user_id), period))
+
+    if cached is None or cached['key'] != key:
+        title, categories, months = await _chart_data(user_id, period, now)
+        png = await job_pool.run_in_process(render_chart, title, categories, months)
+        cached = {"key": key, "png": png, "file_id": None}
+        _charts[(str(user_id), period)] = cached
+    elif cached['file_id'] is not None:
+        return await send(cached['file_id'])
+
+    result = await send(InputFile(io.BytesIO(cached['png']), filename=f'chart_{period}.png'))
+    if result is not None and result.photo:
+        cached['file_id'] = result.photo[-1].file_id
+    return result
+
+
+def drop_user(user_id):
+    """
+    Функция для удаления графиков пользователя из кэша (используется при сбросе данных)
+    """
+    for period in PERIODS:
+        _charts.pop((str(user_id), period), None)
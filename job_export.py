@@ -0,0 +1,97 @@
+import os
+import datetime
+
+import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+
+import job_json
+import job_pool
+import job_aggregates
+
+# Название листа со сводкой по категориям
+PIVOT_SHEET_NAME = 'Сводка'
+# Заголовки столбцов на листах с операциями
+HEADERS = ('Дата', 'Время', 'Тип', 'Категория', 'Сумма', 'Описание')
+
+
+def _export_path(user_id):
+    return f'user_files/{user_id}/{user_id}_history.xlsx'
+
+
+def _header_row(sheet, titles):
+    bold = Font(bold=True)
+    row = []
+    for title in titles:
+        cell = WriteOnlyCell(sheet, value=title)
+        cell.font = bold
+        row.append(cell)
+    return row
+
+
+def write_history(user_id, file_path):
+    """
+    Функция для потоковой выгрузки всей истории операций пользователя в Excel
+    :param user_id: ID пользователя
+    :param file_path: Путь, по которому сохраняется книга
+
+    :type user_id: int
+    :type file_path: str
+
+    :return: Количество выгруженных операций. В книге по листу на каждый год (операции в порядке журнала)
+    и лист PIVOT_SHEET_NAME с суммами категорий по годам.
+
+    Примечание:
+    - Функция блокирующая и вызывается в пуле процессов через `job_pool.run_in_process()`.
+    - Книга создается в режиме write_only: строки пишутся во временные файлы листов сразу по мере чтения
+      журнала (`job_json.iter_transactions()`), поэтому память не зависит от длины истории — в ней держатся
+      только суммы для сводки (год x категория).
+    - Книга пишется во временный файл, который затем подменяет основной.
+    """
+    workbook = openpyxl.Workbook(write_only=True)
+    pivot = {}
+    count = 0
+
+    years = job_json.ledger_years(user_id)
+    for year in years:
+        sheet = workbook.create_sheet(str(year))
+        sheet.column_dimensions['F'].width = 40
+        sheet.append(_header_row(sheet, HEADERS))
+        totals = pivot.setdefault(year, {})
+        for date_str, time_str, entry in job_json.iter_transactions(user_id, year):
+            date_cell = WriteOnlyCell(sheet, value=datetime.datetime.strptime(date_str, "%d.%m.%Y").date())
+            date_cell.number_format = 'DD.MM.YYYY'
+            sheet.append([date_cell, time_str, entry['type'], entry['category'], entry['amount'], entry['description']])
+            totals[entry['category']] = totals.get(entry['category'], 0) + entry['amount']
+            count += 1
+
+    sheet = workbook.create_sheet(PIVOT_SHEET_NAME)
+    sheet.column_dimensions['A'].width = 25
+    sheet.append(_header_row(sheet, ['Категория'] + [str(year) for year in years] + ['Всего']))
+    categories = sorted({category for totals in pivot.values() for category in totals},
+                        key=lambda category: (category not in job_aggregates.INCOME_CATEGORIES, category))
+    for category in categories:
+        sums = [pivot[year].get(category, 0) for year in years]
+        sheet.append([category] + sums + [sum(sums)])
+
+    tmp_path = f'{file_path}.tmp'
+    workbook.save(tmp_path)
+    os.replace(tmp_path, file_path)
+    return count
+
+
+async def export_history(user_id):
+    """
+    Асинхронная функция для выгрузки всей истории пользователя
+    :param user_id: ID пользователя
+
+    :type user_id: int
+
+    :return: Кортеж (путь к файлу, количество операций). Журнал при необходимости сначала переводится
+    в новый формат, затем книга собирается в пуле процессов, не блокируя цикл событий бота.
+    """
+    if job_json.STORAGE_BACKEND == 'jsonl':
+        await job_json.ensure_ledger(user_id)
+    file_path = _export_path(user_id)
+    count = await job_pool.run_in_process(write_history, user_id, file_path)
+    return file_path, count
@@ -0,0 +1,111 @@
+import os
+import json
+import asyncio
+import hashlib
+import logging
+
+from aiogram.types import InputFile
+
+import job_cache
+
+# Кэш file_id в памяти: id пользователя -> {ключ файла: {file_id, mtime_ns, size, sha256}}; вытесненный
+# пользователь при следующей отправке читается из file_ids.json заново
+_file_ids = job_cache.LRUCache()
+
+
+def _cache_path(user_id):
+    return f'user_files/{user_id}/file_ids.json'
+
+
+def _load(user_id):
+    key = str(user_id)
+    data = _file_ids.get(key)
+    if data is None:
+        file_path = _cache_path(user_id)
+        data = {}
+        if os.path.exists(file_path):
+            with open(file_path, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+        _file_ids[key] = data
+    return data
+
+
+def _save(user_id, data):
+    file_path = _cache_path(user_id)
+    if os.path.isdir(os.path.dirname(file_path)):
+        with open(file_path, 'w', encoding='utf-8') as file:
+            json.dump(data, file)
+
+
+def _sha256(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def _cached_file_id(user_id, name, file_path):
+    """
+    Функция для поиска file_id, который Telegram вернул при прошлой отправке этого же содержимого
+    :return: file_id или None. Если время изменения и размер файла не поменялись, файл не читается; иначе
+    сравнивается хэш содержимого (книга могла быть пересохранена без изменений).
+    """
+    data = _load(user_id)
+    entry = data.get(name)
+    if entry is None:
+        return None
+    stat = os.stat(file_path)
+    if entry['mtime_ns'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+        return entry['file_id']
+    if entry['sha256'] == await asyncio.to_thread(_sha256, file_path):
+        entry['mtime_ns'], entry['size'] = stat.st_mtime_ns, stat.st_size
+        _save(user_id, data)
+        return entry['file_id']
+    return None
+
+
+async def send_document(user_id, file_path, send, name=None):
+    """
+    Функция для отправки файла пользователю с повторным использованием file_id
+    :param user_id: ID пользователя
+    :param file_path: Путь к отправляемому файлу
+    :param send: Корутина отправки документа, например `message.answer_document`
+    :param name: Ключ файла в кэше (по умолчанию — имя файла)
+
+    :type user_id: int
+    :type file_path: str
+    :type send: callable
+    :type name: str
+
+    :return: Сообщение Telegram с документом. Если файл не менялся с прошлой отправки, он отправляется по file_id
+    без повторной загрузки; иначе загружается, а полученный file_id запоминается в user_files/{id}/file_ids.json.
+    """
+    name = name or os.path.basename(file_path)
+    file_id = await _cached_file_id(user_id, name, file_path)
+    if file_id is not None:
+        try:
+            return await send(file_id)
+        except Exception as e:
+            logging.warning(f"Не удалось отправить {file_path} по file_id, файл будет загружен заново: {e}")
+
+    stat = os.stat(file_path)
+    sha256 = await asyncio.to_thread(_sha256, file_path)
+    result = await send(InputFile(file_path))
+    if result is not None and result.document is not None:
+        data = _load(user_id)
+        data[name] = {
+            "file_id": result.document.file_id,
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "sha256": sha256
+        }
+        _save(user_id, data)
+    return result
+
+
+def drop_user(user_id):
+    """
+    Функция для удаления сохраненных file_id пользователя из памяти (используется при сбросе данных)
+    """
+    _file_ids.pop(str(user_id), None)
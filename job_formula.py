@@ -0,0 +1,312 @@
+import re
+import math
+
+from openpyxl.utils import column_index_from_string, get_column_letter
+
+# Поддерживаемые функции формул таблицы (остальные формулы не вычисляются, их значение — None)
+FUNCTIONS = ('SUM', 'AVERAGE', 'ROUND', 'MIN', 'MAX')
+
+_TOKEN = re.compile(r'\s*(?:(?P<number>\d+(?:\.\d+)?)'
+                    r'|(?P<range>\$?[A-Z]{1,3}\$?\d+:\$?[A-Z]{1,3}\$?\d+)'
+                    r'|(?P<cell>\$?[A-Z]{1,3}\$?\d+)'
+                    r'|(?P<func>[A-Z]+)\('
+                    r'|(?P<op>[-+*/(),]))')
+
+# Разобранные формулы: текст формулы -> (дерево, ячейки, от которых она зависит). У всех таблиц одна разметка,
+# поэтому каждая формула разбирается один раз на процесс.
+_parsed = {}
+
+
+class FormulaError(ValueError):
+    """
+    Исключение для формул, которые движок не умеет разбирать
+    """
+
+
+def _tokenize(text):
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = _TOKEN.match(text, position)
+        if match is None:
+            raise FormulaError(f"Не удалось разобрать формулу {text!r} с позиции {position}")
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind).replace('$', '')))
+        position = match.end()
+    return tokens
+
+
+def _expand(cell_range):
+    first, last = cell_range.split(':')
+    first_column, first_row = _split(first)
+    last_column, last_row = _split(last)
+    return [f'{get_column_letter(column)}{row}'
+            for row in range(min(first_row, last_row), max(first_row, last_row) + 1)
+            for column in range(min(first_column, last_column), max(first_column, last_column) + 1)]
+
+
+def _split(address):
+    letters = address.rstrip('0123456789')
+    return column_index_from_string(letters), int(address[len(letters):])
+
+
+class _Parser:
+    """
+    Разбор формулы рекурсивным спуском: выражение := слагаемое (+|- слагаемое)*,
+    слагаемое := множитель (*|/ множитель)*, множитель := -множитель | число | ячейка | функция(...) | (выражение)
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def take(self, value=None):
+        token = self.peek()
+        if token[0] is None or (value is not None and token[1] != value):
+            raise FormulaError(f"Ожидалось {value or 'продолжение формулы'}, получено {token[1]!r}")
+        self.position += 1
+        return token
+
+    def expression(self):
+        node = self.term()
+        while self.peek()[1] in ('+', '-') and self.peek()[0] == 'op':
+            node = ('binary', self.take()[1], node, self.term())
+        return node
+
+    def term(self):
+        node = self.factor()
+        while self.peek()[1] in ('*', '/') and self.peek()[0] == 'op':
+            node = ('binary', self.take()[1], node, self.factor())
+        return node
+
+    def factor(self):
+        kind, value = self.take()
+        if kind == 'op' and value == '-':
+            return ('negative', self.factor())
+        if kind == 'op' and value == '+':
+            return self.factor()
+        if kind == 'number':
+            return ('number', float(value) if '.' in value else int(value))
+        if kind == 'cell':
+            return ('cell', value)
+        if kind == 'range':
+            return ('range', _expand(value))
+        if kind == 'func':
+            if value not in FUNCTIONS:
+                raise FormulaError(f"Функция {value} не поддерживается")
+            arguments = []
+            if self.peek()[1] != ')':
+                arguments.append(self.expression())
+                while self.peek()[1] == ',':
+                    self.take(',')
+                    arguments.append(self.expression())
+            self.take(')')
+            return ('function', value, arguments)
+        if kind == 'op' and value == '(':
+            node = self.expression()
+            self.take(')')
+            return node
+        raise FormulaError(f"Неожиданный элемент формулы {value!r}")
+
+
+def _references(node, found):
+    kind = node[0]
+    if kind == 'cell':
+        found.add(node[1])
+    elif kind == 'range':
+        found.update(node[1])
+    elif kind == 'negative':
+        _references(node[1], found)
+    elif kind == 'binary':
+        _references(node[2], found)
+        _references(node[3], found)
+    elif kind == 'function':
+        for argument in node[2]:
+            _references(argument, found)
+    return found
+
+
+def parse(formula):
+    """
+    Функция для разбора формулы вида '=SUM(C3:C6)' или '=C8-C30'
+    :return: Кортеж (дерево формулы, frozenset адресов ячеек, от которых она зависит). Результат кэшируется.
+    Если формула не поддерживается, выбрасывается FormulaError.
+    """
+    if formula not in _parsed:
+        parser = _Parser(_tokenize(formula.lstrip('=')))
+        tree = parser.expression()
+        if parser.position != len(parser.tokens):
+            raise FormulaError(f"Лишние элементы в формуле {formula!r}")
+        _parsed[formula] = (tree, frozenset(_references(tree, set())))
+    return _parsed[formula]
+
+
+def _number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return value
+
+
+def _round(value, digits=0):
+    # Как в Excel: половина округляется от нуля (встроенный round() округляет к четному)
+    factor = 10 ** int(digits)
+    result = math.floor(abs(value) * factor + 0.5) / factor
+    result = math.copysign(result, value)
+    return int(result) if digits <= 0 else result
+
+
+def evaluate(node, value_of):
+    """
+    Функция для вычисления дерева формулы
+    :param node: Дерево из parse()
+    :param value_of: Функция, возвращающая значение ячейки по адресу
+
+    :return: Число или None (ошибка вычисления, например деление на ноль или AVERAGE без чисел)
+    """
+    kind = node[0]
+    if kind == 'number':
+        return node[1]
+    if kind == 'cell':
+        value = value_of(node[1])
+        # Пустая ячейка в арифметике считается нулем, как в Excel
+        return 0 if value is None else _number(value)
+    if kind == 'range':
+        raise FormulaError("Диапазон можно использовать только как аргумент функции")
+    if kind == 'negative':
+        value = evaluate(node[1], value_of)
+        return None if value is None else -value
+    if kind == 'binary':
+        left, right = evaluate(node[2], value_of), evaluate(node[3], value_of)
+        if left is None or right is None:
+            return None
+        if node[1] == '+':
+            return left + right
+        if node[1] == '-':
+            return left - right
+        if node[1] == '*':
+            return left * right
+        return left / right if right else None
+
+    name, arguments = node[1], node[2]
+    if name == 'ROUND':
+        value = evaluate(arguments[0], value_of)
+        digits = evaluate(arguments[1], value_of) if len(arguments) > 1 else 0
+        return None if value is None or digits is None else _round(value, digits)
+    # Функции над наборами значений: в диапазонах учитываются только числа, пустые ячейки пропускаются
+    values = []
+    for argument in arguments:
+        if argument[0] == 'range':
+            values += [number for number in (_number(value_of(address)) for address in argument[1])
+                       if number is not None]
+        else:
+            value = evaluate(argument, value_of)
+            if value is None:
+                return None
+            values.append(value)
+    if name == 'SUM':
+        return sum(values)
+    if not values:
+        return None if name == 'AVERAGE' else 0
+    if name == 'AVERAGE':
+        return sum(values) / len(values)
+    return min(values) if name == 'MIN' else max(values)
+
+
+class SheetFormulas:
+    """
+    Граф формул одного листа с кэшем вычисленных значений
+    :param sheet: Лист openpyxl
+
+    Логика работы:
+    1. При создании формулы листа разбираются (с общим кэшем разбора), для каждой ячейки запоминаются формулы,
+    которые от нее зависят, и строится топологический порядок формул.
+    2. Все формулы вычисляются один раз, значения хранятся в `values`.
+    3. После изменения ячеек `update()` пересчитывает только зависящие от них формулы (транзитивно) в топологическом
+    порядке: изменение суммы категории за месяц затрагивает итог месяца, остаток, и столбцы P-R этих строк.
+
+    Примечание:
+    - Формулы в самой книге не меняются, чтобы Excel продолжал их пересчитывать.
+    - Формулы с неподдерживаемыми функциями и циклические ссылки не вычисляются (значение None).
+    """
+
+    def __init__(self, sheet):
+        self.sheet = sheet
+        self.formulas = {}
+        self.dependents = {}
+        self.values = {}
+        for row in sheet.iter_rows():
+            for cell in row:
+                if isinstance(cell.value, str) and cell.value.startswith('='):
+                    try:
+                        tree, references = parse(cell.value)
+                    except FormulaError:
+                        self.values[cell.coordinate] = None
+                        continue
+                    self.formulas[cell.coordinate] = tree
+                    for reference in references:
+                        self.dependents.setdefault(reference, set()).add(cell.coordinate)
+        self.order = self._topological_order()
+        self.position = {address: index for index, address in enumerate(self.order)}
+        for address in self.order:
+            self.values[address] = self._compute(address)
+
+    def _topological_order(self):
+        # Алгоритм Кана по зависимостям между формулами; ячейки из циклов в порядок не попадают
+        pending = {address: sum(1 for reference in parse(self.sheet[address].value)[1] if reference in self.formulas)
+                   for address in self.formulas}
+        ready = [address for address, count in pending.items() if not count]
+        order = []
+        while ready:
+            address = ready.pop()
+            order.append(address)
+            for dependent in self.dependents.get(address, ()):
+                pending[dependent] -= 1
+                if not pending[dependent]:
+                    ready.append(dependent)
+        ordered = set(order)
+        for address in self.formulas:
+            if address not in ordered:
+                self.values[address] = None
+        return order
+
+    def _value_of(self, address):
+        if address in self.formulas or address in self.values:
+            return self.values.get(address)
+        return self.sheet[address].value
+
+    def _compute(self, address):
+        try:
+            return evaluate(self.formulas[address], self._value_of)
+        except (FormulaError, TypeError, OverflowError):
+            return None
+
+    def value(self, address):
+        """
+        Функция для получения значения ячейки: для формулы — вычисленное значение из кэша, иначе — значение ячейки
+        """
+        if address in self.values:
+            return self.values[address]
+        return self.sheet[address].value
+
+    def update(self, addresses):
+        """
+        Функция для пересчета формул после изменения ячеек
+        :param addresses: Адреса измененных ячеек
+
+        :return: Список пересчитанных формул. Пересчитываются только формулы, зависящие от addresses.
+        """
+        affected = set()
+        stack = list(addresses)
+        while stack:
+            for dependent in self.dependents.get(stack.pop(), ()):
+                if dependent not in affected:
+                    affected.add(dependent)
+                    stack.append(dependent)
+        recalculated = sorted((address for address in affected if address in self.position), key=self.position.get)
+        for address in recalculated:
+            self.values[address] = self._compute(address)
+        return recalculated
@@ -0,0 +1,209 @@
+import os
+import copy
+import json
+import time
+import typing
+import asyncio
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+from aiogram.dispatcher.storage import BaseStorage
+
+# Путь к базе состояний по умолчанию
+FSM_STORAGE_PATH = os.getenv('FSM_STORAGE_PATH', 'user_files/fsm.sqlite3')
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище состояний FSM в SQLite вместо MemoryStorage
+    :param path: Путь к файлу базы
+    :param ttl: Через сколько секунд без изменений состояние считается брошенным и удаляется
+    :param cache_size: Сколько состояний одновременно держится в памяти
+    :param flush_interval: Как часто (в секундах) накопленные изменения записываются в базу одной пачкой
+
+    :type path: str
+    :type ttl: float
+    :type cache_size: int
+    :type flush_interval: float
+
+    Примечание:
+    - Незаписанные изменения живут в памяти не дольше flush_interval секунд; при остановке бота (close) они
+    записываются сразу.
+    - Память ограничена cache_size записями: давно не использованные состояния вытесняются, при необходимости
+    после записи в базу, и при следующем обращении читаются из нее снова.
+    """
+
+    def __init__(self, path=FSM_STORAGE_PATH, ttl=24 * 60 * 60, cache_size=10000, flush_interval=2.0):
+        self.path = path
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        # (chat, user) -> {'state', 'data', 'updated'}; порядок соответствует давности использования
+        self._cache = OrderedDict()
+        self._dirty = set()
+        self._flusher = None
+        self._db_lock = threading.Lock()
+
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS fsm (
+                chat TEXT NOT NULL,
+                user TEXT NOT NULL,
+                state TEXT,
+                data TEXT NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (chat, user)
+            );
+            CREATE INDEX IF NOT EXISTS idx_fsm_updated ON fsm (updated);
+        """)
+
+    # --- работа с базой (выполняется в отдельном потоке) ---
+
+    def _select(self, key):
+        with self._db_lock:
+            return self._connection.execute(
+                "SELECT state, data, updated FROM fsm WHERE chat = ? AND user = ?", key).fetchone()
+
+    def _write(self, rows, deleted, expired_before):
+        with self._db_lock, self._connection:
+            if rows:
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO fsm (chat, user, state, data, updated) VALUES (?, ?, ?, ?, ?)", rows)
+            if deleted:
+                self._connection.executemany("DELETE FROM fsm WHERE chat = ? AND user = ?", deleted)
+            self._connection.execute("DELETE FROM fsm WHERE updated < ?", (expired_before,))
+
+    # --- кэш ---
+
+    def _is_empty(self, entry):
+        return entry['state'] is None and not entry['data']
+
+    async def _get_entry(self, chat, user):
+        chat, user = map(str, self.check_address(chat=chat, user=user))
+        key = (chat, user)
+        entry = self._cache.get(key)
+        if entry is None:
+            row = await asyncio.to_thread(self._select, key)
+            entry = {'state': None, 'data': {}, 'updated': time.time()}
+            if row is not None:
+                entry = {'state': row[0], 'data': json.loads(row[1]), 'updated': row[2]}
+            self._cache[key] = entry
+            await self._evict()
+        else:
+            self._cache.move_to_end(key)
+
+        # Брошенное состояние (старше ttl) считается сброшенным
+        if not self._is_empty(entry) and time.time() - entry['updated'] > self.ttl:
+            entry['state'], entry['data'] = None, {}
+            self._dirty.add(key)
+        return key, entry
+
+    def _touch(self, key, entry):
+        entry['updated'] = time.time()
+        self._dirty.add(key)
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.ensure_future(self._flush_later())
+
+    async def _evict(self):
+        if len(self._cache) <= self.cache_size:
+            return
+        if self._dirty:
+            await self.flush()
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    async def flush(self):
+        """
+        Записывает все накопленные изменения в базу одной транзакцией и удаляет из нее просроченные состояния
+        """
+        rows, deleted = [], []
+        for key in self._dirty:
+            entry = self._cache.get(key)
+            if entry is None:
+                continue
+            if self._is_empty(entry):
+                deleted.append(key)
+            else:
+                rows.append(key + (entry['state'], json.dumps(entry['data'], ensure_ascii=False), entry['updated']))
+        self._dirty.clear()
+        try:
+            await asyncio.to_thread(self._write, rows, deleted, time.time() - self.ttl)
+        except Exception as e:
+            logging.error(f"Ошибка при записи состояний FSM в {self.path}: {e}")
+        # Пустые состояния в памяти не нужны
+        for key in deleted:
+            entry = self._cache.get(key)
+            if entry is not None and self._is_empty(entry):
+                del self._cache[key]
+
+    # --- интерфейс BaseStorage ---
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        _, entry = await self._get_entry(chat, user)
+        return entry['state'] if entry['state'] is not None else self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        _, entry = await self._get_entry(chat, user)
+        return copy.deepcopy(entry['data'])
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.Optional[typing.AnyStr] = None):
+        key, entry = await self._get_entry(chat, user)
+        entry['state'] = self.resolve_state(state)
+        self._touch(key, entry)
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        key, entry = await self._get_entry(chat, user)
+        entry['data'] = copy.deepcopy(data or {})
+        self._touch(key, entry)
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None,
+                          **kwargs):
+        key, entry = await self._get_entry(chat, user)
+        entry['data'].update(data or {}, **kwargs)
+        self._touch(key, entry)
+
+    async def reset_state(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          with_data: typing.Optional[bool] = True):
+        key, entry = await self._get_entry(chat, user)
+        entry['state'] = None
+        if with_data:
+            entry['data'] = {}
+        self._touch(key, entry)
+
+    async def close(self):
+        if self._flusher is not None and not self._flusher.done():
+            self._flusher.cancel()
+        await self.flush()
+        self._cache.clear()
+        with self._db_lock:
+            self._connection.close()
+
+    async def wait_closed(self):
+        pass
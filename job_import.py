@@ -0,0 +1,191 @@
+import io
+import asyncio
+import datetime
+
+import pandas as pd
+
+import job_wal
+import job_json
+import job_aggregates
+
+# Возможные названия столбцов выписки (сравниваются без учета регистра)
+COLUMN_ALIASES = {
+    'date': ('дата операции', 'дата', 'date', 'дата платежа', 'transaction date'),
+    'amount': ('сумма операции', 'сумма', 'amount', 'сумма платежа'),
+    'category': ('категория', 'category', 'mcc категория'),
+    'description': ('описание', 'назначение платежа', 'description', 'комментарий'),
+}
+
+# Ключевые слова в категории или описании банка -> категория бота
+CATEGORY_KEYWORDS = {
+    'зарплат': 'Зп на карточку', 'аванс': 'Зп на карточку',
+    'аренд': 'Жилье', 'ипотек': 'Жилье',
+    'жкх': 'Коммуналка', 'коммунал': 'Коммуналка',
+    'супермаркет': 'Еда', 'продукт': 'Еда', 'кафе': 'Еда', 'ресторан': 'Еда', 'фастфуд': 'Еда',
+    'транспорт': 'Проезд', 'такси': 'Проезд', 'метро': 'Проезд', 'топливо': 'Проезд', 'азс': 'Проезд',
+    'интернет': 'Интернет',
+    'связь': 'Сотовая связь', 'мобильн': 'Сотовая связь',
+    'одежд': 'Одежда', 'обув': 'Одежда',
+    'аптек': 'Медикаменты', 'медицин': 'Медикаменты', 'здоровье': 'Медикаменты',
+    'кредит': 'Процент кредита',
+    'дом и ремонт': 'Хоз расходы', 'хозяйств': 'Хоз расходы',
+    'электроник': 'Техника', 'техник': 'Техника',
+    'красот': 'Парикмахерская', 'парикмахер': 'Парикмахерская',
+    'развлечен': 'Развлечения', 'кино': 'Развлечения', 'отдых': 'Развлечения',
+    'образован': 'Обучение', 'курс': 'Обучение', 'книг': 'Обучение',
+    'подар': 'Подарки', 'цвет': 'Подарки',
+}
+
+
+def parse_mapping(text):
+    """
+    Функция для разбора пользовательского сопоставления столбцов из подписи к файлу
+    :param text: Строка вида "дата=Дата операции; сумма=Сумма; категория=Категория; описание=Комментарий"
+
+    :type text: str
+
+    :return: Словарь {поле: название столбца} с полями date, amount, category, description
+    """
+    fields = {'дата': 'date', 'сумма': 'amount', 'категория': 'category', 'описание': 'description'}
+    mapping = {}
+    for part in (text or '').split(';'):
+        if '=' in part:
+            field, column = part.split('=', 1)
+            field = fields.get(field.strip().lower(), field.strip().lower())
+            mapping[field] = column.strip()
+    return mapping
+
+
+def _find_column(frame, field, mapping):
+    if field in mapping:
+        if mapping[field] not in frame.columns:
+            raise ValueError(f"В выписке нет столбца '{mapping[field]}'.")
+        return mapping[field]
+    columns = {str(column).strip().lower(): column for column in frame.columns}
+    for alias in COLUMN_ALIASES[field]:
+        if alias in columns:
+            return columns[alias]
+    return None
+
+
+def map_category(text, is_income):
+    """
+    Функция для сопоставления категории банка с категорией бота
+    :param text: Категория и описание операции из выписки
+    :param is_income: Является ли операция доходом
+
+    :type text: str
+    :type is_income: bool
+
+    :return: Категория бота. Нераспознанные расходы попадают в 'Прочие', доходы — в 'Другие'.
+    """
+    text = str(text).lower()
+    for keyword, category in CATEGORY_KEYWORDS.items():
+        if keyword in text and (category in job_aggregates.INCOME_CATEGORIES) == is_income:
+            return category
+    return 'Другие' if is_income else 'Прочие'
+
+
+def parse_statement(content, file_name, mapping=None):
+    """
+    Функция для разбора банковской выписки в формате CSV или XLSX
+    :param content: Содержимое файла
+    :param file_name: Имя файла (по расширению определяется формат)
+    :param mapping: Сопоставление столбцов {date, amount, category, description} (см. parse_mapping)
+
+    :type content: bytes
+    :type file_name: str
+    :type mapping: dict
+
+    :return: Список операций {date, time, type, category, amount, description}. Отрицательная сумма — расход,
+    положительная — доход.
+
+    Примечание:
+    - Функция блокирующая (pandas), поэтому вызывается через `asyncio.to_thread()`.
+    - CSV читается с автоопределением разделителя; даты разбираются в формате «день.месяц.год».
+    """
+    mapping = mapping or {}
+    if file_name.lower().endswith(('.xlsx', '.xls')):
+        frame = pd.read_excel(io.BytesIO(content))
+    else:
+        text = content.decode('utf-8-sig', errors='replace')
+        frame = pd.read_csv(io.StringIO(text), sep=None, engine='python')
+
+    date_column = _find_column(frame, 'date', mapping)
+    amount_column = _find_column(frame, 'amount', mapping)
+    if date_column is None or amount_column is None:
+        raise ValueError("Не удалось найти столбцы даты и суммы. Укажите их в подписи к файлу, например: "
+                         "дата=Дата операции; сумма=Сумма")
+    category_column = _find_column(frame, 'category', mapping)
+    description_column = _find_column(frame, 'description', mapping)
+
+    dates = pd.to_datetime(frame[date_column], dayfirst=True, errors='coerce', format='mixed')
+    amounts = pd.to_numeric(frame[amount_column].astype(str).str.replace(' ', '').str.replace('\xa0', '')
+                            .str.replace(',', '.'), errors='coerce')
+    valid = dates.notna() & amounts.notna() & (amounts != 0)
+    categories = frame[category_column].fillna('').astype(str) if category_column is not None else None
+    descriptions = frame[description_column].fillna('').astype(str) if description_column is not None else None
+
+    entries = []
+    for index in frame.index[valid]:
+        amount = round(float(amounts[index]), 2)
+        is_income = amount > 0
+        bank_text = ' '.join(part[index] for part in (categories, descriptions) if part is not None)
+        entries.append({
+            "date": dates[index].strftime("%d.%m.%Y"),
+            "time": dates[index].strftime("%H:%M:%S"),
+            "type": 'Доход' if is_income else 'Расход',
+            "category": map_category(bank_text, is_income),
+            "amount": int(abs(amount)) if abs(amount).is_integer() else abs(amount),
+            "description": descriptions[index] if descriptions is not None and descriptions[index] else None
+        })
+    return entries
+
+
+def _spread_times(entries, existing):
+    """
+    Функция для разведения операций с одинаковыми датой и временем (в выписках время часто не указано)
+    :return: Время повторяющихся операций сдвигается на секунды вперед, чтобы ни одна не потерялась в журнале,
+    где операция определяется датой и временем.
+    """
+    for entry in entries:
+        taken = existing.setdefault(entry['date'], set())
+        moment = datetime.datetime.strptime(entry['time'], "%H:%M:%S")
+        while moment.strftime("%H:%M:%S") in taken:
+            moment += datetime.timedelta(seconds=1)
+        entry['time'] = moment.strftime("%H:%M:%S")
+        taken.add(entry['time'])
+
+
+async def import_statement(user_id, content, file_name, mapping=None):
+    """
+    Асинхронная функция для импорта банковской выписки в журнал и таблицу пользователя
+    :param user_id: ID пользователя
+    :param content: Содержимое файла выписки
+    :param file_name: Имя файла выписки
+    :param mapping: Сопоставление столбцов (см. parse_mapping)
+
+    :type user_id: int
+    :type content: bytes
+    :type file_name: str
+    :type mapping: dict
+
+    :return: Количество импортированных операций.
+
+    Логика работы:
+    1. Выписка разбирается pandas в отдельном потоке.
+    2. Все операции одной записью попадают в журнал намерений `job_wal.record_many()`, затем одной пачкой
+    дописываются в журнал `job_json.add_transactions()`.
+    3. Месячные итоги обновляются одной записью, а суммы операций текущего года добавляются в Excel-таблицу
+    за одну загрузку и одно сохранение `job_xls.record_many()`.
+    """
+    entries = await asyncio.to_thread(parse_statement, content, file_name, mapping)
+    if not entries:
+        return 0
+
+    ledger = await job_json.load_ledger(user_id)
+    _spread_times(entries, {date_str: set(day) for date_str, day in ledger.items()})
+
+    # Если пул Excel занят (job_io.BusyError), выписка не попадет никуда, включая журнал намерений
+    await job_wal.record_many(user_id, entries)
+    return len(entries)
@@ -0,0 +1,129 @@
+import os
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+# Количество потоков для чтения и записи Excel-книг
+XLS_IO_WORKERS = int(os.getenv('XLS_IO_WORKERS', 2))
+# Сколько задач может ждать свободного потока; сверх этого запросы пользователей отклоняются
+XLS_IO_QUEUE_SIZE = int(os.getenv('XLS_IO_QUEUE_SIZE', 32))
+
+# Ответ пользователю, когда очередь заполнена
+BUSY_TEXT = "Сейчас бот перегружен. Пожалуйста, повторите попытку через несколько секунд."
+
+
+class BusyError(Exception):
+    """
+    Исключение, которое выбрасывается, когда очередь исполнителя заполнена
+    """
+
+
+class BoundedExecutor:
+    """
+    Отдельный пул потоков с ограниченной очередью и метриками
+    :param name: Название пула (используется в именах потоков и метриках)
+    :param workers: Количество потоков
+    :param queue_size: Сколько задач может ждать свободного потока
+
+    :type name: str
+    :type workers: int
+    :type queue_size: int
+
+    Примечание:
+    - Задачи не делят потоки с `asyncio.to_thread()` и другими блокирующими вызовами бота.
+    - Если ожидающих задач уже queue_size, новая задача пользователя отклоняется с BusyError (backpressure),
+      а не встает в бесконечную очередь. Фоновые задачи (сохранение книг) передаются с reject=False
+      и принимаются всегда, чтобы изменения не терялись.
+    - Метрики считаются в потоке цикла событий и не требуют блокировок.
+    """
+
+    def __init__(self, name, workers, queue_size):
+        self.name = name
+        self.workers = workers
+        self.queue_size = queue_size
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        # Задачи, отправленные в пул и еще не завершенные (выполняющиеся и ожидающие)
+        self._pending = 0
+        self._stats = {
+            "submitted": 0, "rejected": 0, "errors": 0, "max_queue_depth": 0,
+            "wait_total": 0.0, "wait_max": 0.0, "run_total": 0.0, "run_max": 0.0
+        }
+
+    @property
+    def queue_depth(self):
+        return max(0, self._pending - self.workers)
+
+    def saturated(self):
+        return self.queue_depth >= self.queue_size
+
+    async def run(self, func, *args, reject=True, **kwargs):
+        """
+        Асинхронная функция для выполнения блокирующей функции в пуле
+        :param func: Блокирующая функция
+        :param reject: Отклонять ли задачу, если очередь заполнена
+
+        :type func: callable
+        :type reject: bool
+
+        :return: Результат функции. Если reject=True и очередь заполнена, выбрасывается BusyError.
+        """
+        if reject and self.saturated():
+            self._stats["rejected"] += 1
+            raise BusyError(f"Очередь {self.name} заполнена ({self.queue_depth} задач)")
+
+        def call():
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timings.append((started, time.perf_counter()))
+
+        timings = []
+        submitted = time.perf_counter()
+        self._pending += 1
+        self._stats["submitted"] += 1
+        self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], self.queue_depth)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+        except Exception:
+            self._stats["errors"] += 1
+            raise
+        finally:
+            self._pending -= 1
+            if timings:
+                started, finished = timings[0]
+                self._record(started - submitted, finished - started)
+
+    def _record(self, wait, run):
+        self._stats["wait_total"] += wait
+        self._stats["wait_max"] = max(self._stats["wait_max"], wait)
+        self._stats["run_total"] += run
+        self._stats["run_max"] = max(self._stats["run_max"], run)
+
+    def metrics(self):
+        """
+        Функция для получения метрик пула
+        :return: Словарь: текущая и максимальная глубина очереди, число задач (принятых, отклоненных, с ошибкой),
+        среднее и максимальное время ожидания потока и выполнения в секундах.
+        """
+        completed = max(1, self._stats["submitted"] - self._pending)
+        return {
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self._stats["max_queue_depth"],
+            "submitted": self._stats["submitted"],
+            "rejected": self._stats["rejected"],
+            "errors": self._stats["errors"],
+            "wait_avg": self._stats["wait_total"] / completed,
+            "wait_max": self._stats["wait_max"],
+            "run_avg": self._stats["run_total"] / completed,
+            "run_max": self._stats["run_max"]
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+# Пул для загрузки и сохранения Excel-книг (job_xls)
+xls_executor = BoundedExecutor('xls-io', XLS_IO_WORKERS, XLS_IO_QUEUE_SIZE)
@@ -0,0 +1,137 @@
+import os
+import pickle
+import sqlite3
+import threading
+
+from apscheduler.job import Job
+from apscheduler.jobstores.base import BaseJobStore, JobLookupError, ConflictingIdError
+from apscheduler.util import datetime_to_utc_timestamp, utc_timestamp_to_datetime
+
+# Путь к базе задач планировщика по умолчанию
+JOBSTORE_PATH = os.getenv('JOBSTORE_PATH', 'user_files/jobs.sqlite3')
+
+
+class SQLiteJobStore(BaseJobStore):
+    """
+    Постоянное хранилище задач APScheduler в SQLite (аналог SQLAlchemyJobStore без зависимости от SQLAlchemy)
+    :param path: Путь к файлу базы
+    :param pickle_protocol: Версия протокола pickle для состояния задач
+
+    :type path: str
+    :type pickle_protocol: int
+
+    Примечание:
+    - Время следующего запуска задачи переживает перезапуск бота: пропущенный за время остановки запуск
+    планировщик выполнит при старте (с coalesce=True — один раз, сколько бы запусков ни было пропущено).
+    - Задача хранится как ссылка на функцию 'модуль:функция', поэтому функция должна быть доступна по импорту.
+    """
+
+    def __init__(self, path=JOBSTORE_PATH, pickle_protocol=pickle.HIGHEST_PROTOCOL):
+        super().__init__()
+        self.path = path
+        self.pickle_protocol = pickle_protocol
+        self._connection = None
+        self._db_lock = threading.Lock()
+
+    def start(self, scheduler, alias):
+        super().start(scheduler, alias)
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self._connection = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS apscheduler_jobs (
+                id TEXT PRIMARY KEY,
+                next_run_time REAL,
+                job_state BLOB NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_apscheduler_jobs_next_run_time ON apscheduler_jobs (next_run_time);
+        """)
+
+    def lookup_job(self, job_id):
+        with self._db_lock:
+            row = self._connection.execute("SELECT job_state FROM apscheduler_jobs WHERE id = ?",
+                                           (job_id,)).fetchone()
+        return self._reconstitute_job(row[0]) if row else None
+
+    def get_due_jobs(self, now):
+        return self._get_jobs("WHERE next_run_time <= ?", (datetime_to_utc_timestamp(now),))
+
+    def get_next_run_time(self):
+        with self._db_lock:
+            row = self._connection.execute(
+                "SELECT next_run_time FROM apscheduler_jobs WHERE next_run_time IS NOT NULL "
+                "ORDER BY next_run_time LIMIT 1").fetchone()
+        return utc_timestamp_to_datetime(row[0]) if row else None
+
+    def get_all_jobs(self):
+        jobs = self._get_jobs()
+        self._fix_paused_jobs_sorting(jobs)
+        return jobs
+
+    def add_job(self, job):
+        try:
+            with self._db_lock, self._connection:
+                self._connection.execute(
+                    "INSERT INTO apscheduler_jobs (id, next_run_time, job_state) VALUES (?, ?, ?)",
+                    (job.id, datetime_to_utc_timestamp(job.next_run_time),
+                     pickle.dumps(job.__getstate__(), self.pickle_protocol)))
+        except sqlite3.IntegrityError:
+            raise ConflictingIdError(job.id)
+
+    def update_job(self, job):
+        with self._db_lock, self._connection:
+            cursor = self._connection.execute(
+                "UPDATE apscheduler_jobs SET next_run_time = ?, job_state = ? WHERE id = ?",
+                (datetime_to_utc_timestamp(job.next_run_time), pickle.dumps(job.__getstate__(), self.pickle_protocol),
+                 job.id))
+        if cursor.rowcount == 0:
+            raise JobLookupError(job.id)
+
+    def remove_job(self, job_id):
+        with self._db_lock, self._connection:
+            cursor = self._connection.execute("DELETE FROM apscheduler_jobs WHERE id = ?", (job_id,))
+        if cursor.rowcount == 0:
+            raise JobLookupError(job_id)
+
+    def remove_all_jobs(self):
+        with self._db_lock, self._connection:
+            self._connection.execute("DELETE FROM apscheduler_jobs")
+
+    def shutdown(self):
+        with self._db_lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def _reconstitute_job(self, job_state):
+        job_state = pickle.loads(job_state)
+        job_state['jobstore'] = self
+        job = Job.__new__(Job)
+        job.__setstate__(job_state)
+        job._scheduler = self._scheduler
+        job._jobstore_alias = self._alias
+        return job
+
+    def _get_jobs(self, condition='', params=()):
+        jobs = []
+        failed_job_ids = []
+        with self._db_lock:
+            rows = self._connection.execute(
+                f"SELECT id, job_state FROM apscheduler_jobs {condition} ORDER BY next_run_time", params).fetchall()
+        for job_id, job_state in rows:
+            try:
+                jobs.append(self._reconstitute_job(job_state))
+            except BaseException:
+                self._logger.exception(f"Не удалось восстановить задачу {job_id}, она удаляется")
+                failed_job_ids.append((job_id,))
+
+        # Задачи, которые не удалось восстановить (например, функция переименована), удаляются
+        if failed_job_ids:
+            with self._db_lock, self._connection:
+                self._connection.executemany("DELETE FROM apscheduler_jobs WHERE id = ?", failed_job_ids)
+        return jobs
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} (path={self.path})>'
@@ -1,19 +1,742 @@
 import json
 import os
+import struct
+import asyncio
 import aiofiles
 import datetime
+import itertools
 
+from aiogram.utils.markdown import escape_md
 
-async def description_operation(user_id, type_operation, category, amount, date_str, time_str, description=None):
+import job_lock
+import job_cache
+import job_sqlite
+import job_metrics
+import job_registry
+import job_ledger_bin
+
+# Хранилище транзакций: 'jsonl' — журнал в папке пользователя, 'sqlite' — общая база job_sqlite.SQLITE_PATH
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'jsonl')
+# Формат журнала в папке пользователя: 'jsonl' — текстовые разделы ledger/ГГГГ-ММ.jsonl,
+# 'binary' — компактные ledger/ГГГГ-ММ.bin (job_ledger_bin)
+LEDGER_FORMAT = os.getenv('LEDGER_FORMAT', 'jsonl')
+# Количество записей-поправок (изменений описания), после которого журнал пользователя уплотняется
+COMPACT_THRESHOLD = 200
+# Раздел журнала для записей с датой не в формате "%d.%m.%Y"
+UNKNOWN_PERIOD = '0000-00'
+
+# Счетчики поправок, записанных с момента последнего уплотнения журнала
+_amendments_count = {}
+# Разделы, в которые с момента последнего уплотнения дописывались поправки: id пользователя -> {'ГГГГ-ММ'}
+_amended_periods = {}
+# Пользователи, для которых уже проверена необходимость миграции со старого формата
+_migrated_users = set()
+# Готовые отчеты за день: id пользователя -> {"date": дата, "times": время операций, "parts": строки отчета}
+_daily_reports = job_cache.LRUCache()
+# Версии журналов: id пользователя -> номер версии (по нему кэши аналитики понимают, что данные устарели)
+_versions = job_cache.LRUCache()
+# Источник номеров версий: номера общие для всех пользователей и не повторяются (см. ledger_version())
+_version_numbers = itertools.count(1)
+
+
+def _index_busy(key, index):
+    # Индекс с выданными, но еще не записанными ID нельзя перечитать из файла: ID были бы выданы повторно
+    return job_lock.is_locked(key, 'json') or index['next_id'] != max(index['entries'], default=0) + 1
+
+
+# Индексы операций: id пользователя -> {"entries": {ID: (секунды, смещение)}, "moments": занятые секунды,
+# "next_id": следующий ID}
+_indexes = job_cache.LRUCache(busy=_index_busy)
+
+# Запись индекса {id}.idx: ID операции, дата и время операции (секунды от job_ledger_bin.EPOCH), смещение в разделе
+# журнала (раздел определяется по дате операции)
+_INDEX_ENTRY = struct.Struct('<QqQ')
+
+
+def _ledger_dir(user_id):
+    return f'user_files/{user_id}/ledger'
+
+
+def _extension(ledger_format=None):
+    return 'bin' if (ledger_format or LEDGER_FORMAT) == 'binary' else 'jsonl'
+
+
+def _partition_path(user_id, period, ledger_format=None):
+    return f'{_ledger_dir(user_id)}/{period}.{_extension(ledger_format)}'
+
+
+def _single_file_path(user_id, ledger_format=None):
+    # Журнал одним файлом {id}.jsonl / {id}.bin (до разбиения по месяцам); используется только при миграции
+    return f'user_files/{user_id}/{user_id}.{_extension(ledger_format)}'
+
+
+def _legacy_path(user_id):
+    return f'user_files/{user_id}/{user_id}.json'
+
+
+def _index_path(user_id):
+    return f'user_files/{user_id}/{user_id}.idx'
+
+
+def _period(date_str):
+    """
+    Функция для определения раздела журнала по дате операции
+    :return: Строка 'ГГГГ-ММ'. Для даты не в формате "%d.%m.%Y" — раздел UNKNOWN_PERIOD.
+    """
+    if isinstance(date_str, str) and len(date_str) == 10 and date_str[2] == '.' and date_str[5] == '.':
+        return f'{date_str[6:]}-{date_str[3:5]}'
+    return UNKNOWN_PERIOD
+
+
+def _moment_period(moment):
+    return _period(job_ledger_bin.from_timestamp(moment)[0])
+
+
+def _periods(user_id, ledger_format=None):
+    """
+    Функция для получения списка разделов журнала пользователя
+    :return: Отсортированный список 'ГГГГ-ММ' (по имени файла, без чтения самих разделов)
+    """
+    suffix = f'.{_extension(ledger_format)}'
+    try:
+        names = os.listdir(_ledger_dir(user_id))
+    except FileNotFoundError:
+        return []
+    return sorted(name[:-len(suffix)] for name in names if name.endswith(suffix))
+
+
+def _periods_between(user_id, start, end):
+    # Разделы, пересекающиеся с периодом [start, end] (datetime); остальные разделы не читаются
+    first, last = f'{start.year:04d}-{start.month:02d}', f'{end.year:04d}-{end.month:02d}'
+    return [period for period in _periods(user_id) if first <= period <= last]
+
+
+def _has_ledger(user_id):
+    return bool(_periods(user_id))
+
+
+def _bump_version(user_id):
+    _versions[str(user_id)] = next(_version_numbers)
+
+
+def ledger_version(user_id):
+    """
+    Функция для получения версии журнала пользователя
+    :return: Число, которое меняется при каждом добавлении операции, изменении описания и сбросе данных.
+    Кэши, построенные по журналу, сравнивают с ним свою версию вместо перечитывания журнала.
+
+    Примечание:
+    - Версии хранятся для job_cache.CACHE_SIZE пользователей. Пользователь, версия которого вытеснена,
+    получает новый, еще не выданный номер: кэши, построенные по прежней версии, перестраиваются, а не считаются
+    актуальными.
+    """
+    key = str(user_id)
+    if key not in _versions:
+        _bump_version(user_id)
+    return _versions[key]
+
+
+def _dump_record(record):
+    return json.dumps(record, ensure_ascii=False) + '\n'
+
+
+def _encode_records(records, ledger_format=None):
+    # Байты записей для журнала выбранного формата (сигнатуру нового двоичного файла добавляет вызывающий код)
+    if (ledger_format or LEDGER_FORMAT) == 'binary':
+        return job_ledger_bin.encode_records(records)
+    return ''.join(_dump_record(record) for record in records).encode('utf-8')
+
+
+def _moment(record):
+    try:
+        return job_ledger_bin.to_timestamp(record['date'], record['time'])
+    except (KeyError, ValueError, TypeError):
+        return None
+
+
+def _fold_records(records):
     """
-    Функция для создания json-файла и добавления в него новых данных о транзакциях
+    Функция для свертки записей журнала: поправки описаний применяются к самим операциям, повторы отбрасываются
+    :return: Список записей "add" в порядке журнала (ID операций сохраняются)
+    """
+    folded = {}
+    for record in records:
+        key = (record['date'], record['time'])
+        if record['op'] == 'add':
+            if key not in folded:
+                folded[key] = dict(record)
+        elif record['op'] == 'describe' and key in folded:
+            folded[key]['description'] = record['description']
+    return list(folded.values())
+
+
+def _apply_record(data, record):
+    """
+    Функция для применения одной записи журнала к словарю транзакций
+    :param data: Словарь транзакций в формате {дата: {время: операция}}
+    :param record: Запись журнала (добавление операции или поправка описания)
+
+    :type data: dict
+    :type record: dict
+
+    :return: Изменяет словарь data на месте. Повторная операция с тем же временем игнорируется, как и раньше,
+    а поправка к несуществующей операции пропускается.
+    """
+    date_str = record['date']
+    time_str = record['time']
+    if record['op'] == 'add':
+        day = data.setdefault(date_str, {})
+        if time_str not in day:
+            day[time_str] = {
+                "description": record.get('description'),
+                "type": record['type'],
+                "category": record['category'],
+                "amount": record['amount']
+            }
+    elif record['op'] == 'describe':
+        if date_str in data and time_str in data[date_str]:
+            data[date_str][time_str]['description'] = record['description']
+
+
+def _records_from_data(data):
+    """
+    Функция для преобразования словаря транзакций в записи журнала (используется при миграции и уплотнении)
+    :param data: Словарь транзакций в формате {дата: {время: операция}}
+
+    :type data: dict
+
+    :return: Генератор записей журнала вида {"op": "add", ...}
+    """
+    for date_str, day in data.items():
+        for time_str, entry in day.items():
+            yield {
+                "op": "add",
+                "date": date_str,
+                "time": time_str,
+                "description": entry.get('description'),
+                "type": entry.get('type'),
+                "category": entry.get('category'),
+                "amount": entry.get('amount')
+            }
+
+
+def _group_by_period(records):
+    groups = {}
+    for record in records:
+        groups.setdefault(_period(record['date']), []).append(record)
+    return groups
+
+
+async def _write_partition(user_id, period, records, ledger_format=None):
+    """
+    Функция для атомарной перезаписи одного раздела журнала (под блокировкой 'json')
+    :return: Строки индекса (ID, секунды, смещение) для операций раздела
+    """
+    ledger_format = ledger_format or LEDGER_FORMAT
+    header = job_ledger_bin.MAGIC if ledger_format == 'binary' else b''
+    pieces = []
+    rows = []
+    offset = len(header)
+    for record in records:
+        piece = _encode_records([record], ledger_format)
+        moment = _moment(record) if record['op'] == 'add' else None
+        if moment is not None:
+            rows.append((record['id'], moment, offset))
+        pieces.append(piece)
+        offset += len(piece)
+
+    file_path = _partition_path(user_id, period, ledger_format)
+    tmp_path = f'{file_path}.tmp'
+    content = header + b''.join(pieces)
+    os.makedirs(_ledger_dir(user_id), exist_ok=True)
+    async with aiofiles.open(tmp_path, 'wb') as file:
+        await file.write(content)
+    os.replace(tmp_path, file_path)
+    job_metrics.add_bytes('job_json', 'write', len(content))
+    return rows
+
+
+def _assign_missing_ids(user_id, records):
+    # Операциям без ID (из старых журналов) назначаются новые ID в порядке записей
+    index = _indexes.get(str(user_id))
+    next_id = max([index['next_id'] if index else 1] +
+                  [record['id'] + 1 for record in records if record.get('id') is not None])
+    for record in records:
+        if record['op'] == 'add' and record.get('id') is None:
+            record['id'] = next_id
+            next_id += 1
+    return next_id
+
+
+async def _write_records(user_id, records, ledger_format=None):
+    """
+    Функция для полной перезаписи журнала по разделам 'ГГГГ-ММ' (миграция, перевод формата, построение индекса)
+    :return: Записи раскладываются по разделам месяца операции, каждый раздел пишется атомарно (во временный файл,
+    который затем подменяет основной). Разделы этого формата, в которые не попало ни одной записи, удаляются.
+    Операциям без ID назначаются новые ID, а индекс {id}.idx перезаписывается по новым смещениям записей.
+    """
+    records = list(records)
+    next_id = _assign_missing_ids(user_id, records)
+    groups = _group_by_period(records)
+    rows = []
+    for period in sorted(groups):
+        rows += await _write_partition(user_id, period, groups[period], ledger_format)
+    for period in _periods(user_id, ledger_format):
+        if period not in groups:
+            os.remove(_partition_path(user_id, period, ledger_format))
+    await _write_index(user_id, rows, next_id)
+
+
+def _make_index(rows, next_id=1):
+    entries = {tx_id: (moment, offset) for tx_id, moment, offset in rows}
+    return {
+        "entries": entries,
+        "moments": {moment for moment, _ in entries.values()},
+        "next_id": max([next_id] + [tx_id + 1 for tx_id in entries])
+    }
+
+
+def _read_index_file(user_id):
+    with open(_index_path(user_id), 'rb') as file:
+        buffer = file.read()
+    # Недописанная последняя запись индекса (сбой во время записи) отбрасывается
+    usable = len(buffer) - len(buffer) % _INDEX_ENTRY.size
+    return list(_INDEX_ENTRY.iter_unpack(buffer[:usable]))
+
+
+async def _write_index(user_id, rows, next_id=1):
+    # Индекс перезаписывается атомарно и сразу заменяет индекс в памяти
+    _indexes[str(user_id)] = _make_index(rows, next_id)
+    if not os.path.isdir(os.path.dirname(_index_path(user_id))):
+        return
+    tmp_path = f'{_index_path(user_id)}.tmp'
+    async with aiofiles.open(tmp_path, 'wb') as file:
+        await file.write(b''.join(_INDEX_ENTRY.pack(*row) for row in rows))
+    os.replace(tmp_path, _index_path(user_id))
+
+
+async def _append_index(user_id, rows):
+    index = _indexes[str(user_id)]
+    for tx_id, moment, offset in rows:
+        index['entries'][tx_id] = (moment, offset)
+    async with aiofiles.open(_index_path(user_id), 'ab') as file:
+        await file.write(b''.join(_INDEX_ENTRY.pack(*row) for row in rows))
+
+
+async def _load_index(user_id):
+    """
+    Функция для получения индекса операций пользователя (вызывается под блокировкой 'json')
+    :return: Индекс из памяти. При первом обращении он читается из {id}.idx (24 байта на операцию, без разбора
+    журнала), а если файла нет — строится заново `_reindex_unlocked()`. При STORAGE_BACKEND='sqlite' ID хранятся
+    в самой базе, и индекс всегда строится по ним. В памяти индексы хранятся для job_cache.CACHE_SIZE
+    пользователей; вытесненный индекс при следующем обращении читается заново.
+    """
+    key = str(user_id)
+    if key not in _indexes:
+        if STORAGE_BACKEND == 'sqlite':
+            await _reindex_unlocked(user_id)
+        elif os.path.exists(_index_path(user_id)):
+            _indexes[key] = _make_index(await asyncio.to_thread(_read_index_file, user_id))
+        else:
+            await _reindex_unlocked(user_id)
+    return _indexes[key]
+
+
+async def _reindex_unlocked(user_id):
+    """
+    Функция для построения индекса операций (первое обращение к журналу без {id}.idx, под блокировкой 'json')
+    :return: Журнал перезаписывается в свернутом виде, как при уплотнении, а операциям без ID назначаются ID
+    в порядке журнала. Для базы SQLite индекс строится по столбцу tx_id (`job_sqlite.assign_ids()`), смещения
+    не используются (0). Операциям, записанным в базу до появления столбца, ID переносятся из прежнего файла
+    {id}.idx, поэтому уже отправленные кнопки "Добавить описание" продолжают указывать на свои операции.
+    """
+    if STORAGE_BACKEND == 'sqlite':
+        known = {}
+        if os.path.exists(_index_path(user_id)):
+            known = {job_ledger_bin.from_timestamp(moment): tx_id
+                     for tx_id, moment, _ in await asyncio.to_thread(_read_index_file, user_id)}
+        transactions = await asyncio.to_thread(job_sqlite.assign_ids, user_id, known)
+        await _write_index(user_id, [(tx_id, _moment({"date": date_str, "time": time_str}), 0)
+                                     for tx_id, date_str, time_str in transactions
+                                     if _moment({"date": date_str, "time": time_str}) is not None])
+    elif _has_ledger(user_id):
+        records = await asyncio.to_thread(list, _iter_records(user_id))
+        await _write_records(user_id, _fold_records(records))
+        _amendments_count[str(user_id)] = 0
+        _amended_periods.pop(str(user_id), None)
+    else:
+        await _write_index(user_id, [])
+
+
+def _assign_unlocked(index, record):
+    """
+    Функция для назначения новой операции ID и свободной секунды (под блокировкой 'json')
+    :return: Если в эту секунду у пользователя уже есть операция, время сдвигается на ближайшую свободную секунду,
+    поэтому операции, добавленные в одну секунду, не теряются.
+    """
+    moment = job_ledger_bin.to_timestamp(record['date'], record['time'])
+    while moment in index['moments']:
+        moment += 1
+    index['moments'].add(moment)
+    record['date'], record['time'] = job_ledger_bin.from_timestamp(moment)
+    record['id'] = index['next_id']
+    index['next_id'] += 1
+
+
+async def ensure_ledger(user_id):
+    """
+    Функция для однократной миграции журнала пользователя в разделы user_files/{id}/ledger/ГГГГ-ММ
+    :param user_id: id пользователя
+
+    :type user_id: string
+
+    :return: Если разделов текущего формата еще нет, в них переносится (по порядку проверки):
+    1. Разделы другого формата (LEDGER_FORMAT изменился) — через `_convert_unlocked()`.
+    2. Журнал одним файлом {id}.jsonl или {id}.bin — файл переименовывается в *.bak.
+    3. Старый формат {id}.json (вложенный словарь дата/время) — файл переименовывается в {id}.json.bak.
+    """
+    if str(user_id) in _migrated_users:
+        return
+    async with job_lock.user_lock(user_id, 'json'):
+        other_format = 'jsonl' if LEDGER_FORMAT == 'binary' else 'binary'
+        legacy_path = _legacy_path(user_id)
+        single_files = [(ledger_format, _single_file_path(user_id, ledger_format))
+                        for ledger_format in (LEDGER_FORMAT, other_format)
+                        if os.path.exists(_single_file_path(user_id, ledger_format))]
+        if _has_ledger(user_id):
+            pass
+        elif _periods(user_id, other_format):
+            await _convert_unlocked(user_id, other_format, LEDGER_FORMAT)
+        elif single_files:
+            ledger_format, file_path = single_files[0]
+            records = await asyncio.to_thread(list, _read_file_records(file_path, ledger_format))
+            await _write_records(user_id, _fold_records(records))
+            os.replace(file_path, f'{file_path}.bak')
+        elif os.path.exists(legacy_path):
+            async with aiofiles.open(legacy_path, 'r', encoding='utf-8') as file:
+                data = json.loads(await file.read())
+            await _write_records(user_id, _records_from_data(data))
+            os.replace(legacy_path, f'{legacy_path}.bak')
+        _migrated_users.add(str(user_id))
+
+
+async def _convert_unlocked(user_id, source_format, target_format):
+    """
+    Функция для перевода журнала пользователя из одного формата в другой (под блокировкой 'json')
+    :return: Количество перенесенных операций. Поправки описаний сворачиваются в сами операции, как при
+    уплотнении, а разделы исходного формата переименовываются в ГГГГ-ММ.jsonl.bak или ГГГГ-ММ.bin.bak.
+    """
+    source_periods = _periods(user_id, source_format)
+    records = _fold_records(await asyncio.to_thread(list, _iter_records(user_id, source_format)))
+    await _write_records(user_id, records, target_format)
+    for period in source_periods:
+        source_path = _partition_path(user_id, period, source_format)
+        os.replace(source_path, f'{source_path}.bak')
+    return len(records)
+
+
+async def _append_record(user_id, record):
+    await ensure_ledger(user_id)
+    async with job_lock.user_lock(user_id, 'json'):
+        await _append_unlocked(user_id, record)
+
+
+def _encode_append(user_id, records):
+    """
+    Функция для подготовки дозаписи в журнал (под блокировкой 'json')
+    :return: Кортеж (словарь {раздел: байты для дозаписи}, смещения записей в их разделах в порядке records).
+    Новый двоичный раздел начинается с сигнатуры.
+    """
+    chunks = {}
+    sizes = {}
+    offsets = []
+    for record in records:
+        period = _period(record['date'])
+        if period not in sizes:
+            file_path = _partition_path(user_id, period)
+            size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+            header = job_ledger_bin.MAGIC if LEDGER_FORMAT == 'binary' and not size else b''
+            chunks[period] = [header]
+            sizes[period] = size + len(header)
+        piece = _encode_records([record])
+        chunks[period].append(piece)
+        offsets.append(sizes[period])
+        sizes[period] += len(piece)
+    return {period: b''.join(pieces) for period, pieces in chunks.items()}, offsets
+
+
+async def _write_append(user_id, chunks):
+    # Вызывается только под блокировкой job_lock.user_lock(user_id, 'json')
+    os.makedirs(_ledger_dir(user_id), exist_ok=True)
+    for period, content in chunks.items():
+        async with aiofiles.open(_partition_path(user_id, period), 'ab') as file:
+            await file.write(content)
+        job_metrics.add_bytes('job_json', 'write', len(content))
+
+
+async def _append_unlocked(user_id, record):
+    chunks, _ = _encode_append(user_id, [record])
+    await _write_append(user_id, chunks)
+
+
+def _is_written(user_id, tx_id, moment, offset):
+    # Записана ли операция из индекса в хранилище (блокирующая): индекс дописывается раньше журнала
+    if STORAGE_BACKEND == 'sqlite':
+        return job_sqlite.fetch_transaction(user_id, tx_id) is not None
+    record = _read_record_at(user_id, moment, offset)
+    return record is not None and record.get('op') == 'add' and record.get('id') == tx_id
+
+
+async def _add_unlocked(user_id, records):
+    """
+    Функция для добавления операций в журнал и индекс (под блокировкой 'json')
+    :return: Список добавленных записей. Операции с уже известным ID пропускаются (повтор из журнала намерений
+    job_wal), операциям без ID назначаются ID и свободные секунды `_assign_unlocked()`.
+
+    Примечание:
+    - Индекс дописывается раньше журнала: после сбоя в нем может остаться ID без записи (такой ID просто не будет
+    найден), но ID записи из журнала всегда есть в индексе и повторно не выдается.
+    - Поэтому операция с ID, который уже есть в индексе, пропускается, только если ее запись действительно есть
+    в журнале (`_is_written()`): иначе операция, доприменяемая из журнала намерений после такого сбоя, была бы
+    потеряна. Проверка читает одну запись и выполняется только при повторном применении.
+    - Смещение в индексе отсчитывается от начала раздела месяца операции.
+    """
+    index = await _load_index(user_id)
+    added = []
+    for record in records:
+        if record.get('id') is None:
+            _assign_unlocked(index, record)
+        elif record['id'] in index['entries'] and await asyncio.to_thread(_is_written, user_id, record['id'],
+                                                                          *index['entries'][record['id']]):
+            continue
+        else:
+            if _moment(record) is not None:
+                index['moments'].add(_moment(record))
+            index['next_id'] = max(index['next_id'], record['id'] + 1)
+        added.append(record)
+    if not added:
+        return added
+
+    if STORAGE_BACKEND == 'sqlite':
+        await _append_index(user_id, [(record['id'], _moment(record), 0) for record in added])
+        await asyncio.to_thread(job_sqlite.insert_transactions, [
+            (user_id, record['date'], record['time'], record['type'], record['category'], record['amount'],
+             record['description'], record['id']) for record in added])
+    else:
+        chunks, offsets = _encode_append(user_id, added)
+        await _append_index(user_id, [(record['id'], _moment(record), offset)
+                                      for record, offset in zip(added, offsets) if _moment(record) is not None])
+        await _write_append(user_id, chunks)
+    _bump_version(user_id)
+    for record in added:
+        await _report_add(user_id, record)
+    # Реестр пользователей запоминает дату последней операции: по нему ежедневная рассылка выбирает активных
+    await job_registry.mark_active(user_id, max(datetime.datetime.strptime(record['date'], "%d.%m.%Y")
+                                                for record in added))
+    return added
+
+
+async def load_ledger(user_id):
+    """
+    Функция для чтения журнала транзакций пользователя
+    :param user_id: id пользователя
+
+    :type user_id: string
+
+    :return: Словарь транзакций в прежнем формате {дата: {время: {description, type, category, amount}}}.
+    Если журнала нет, возвращается пустой словарь. Читаются все разделы, поэтому для отчетов за период
+    следует использовать load_range() и load_day().
+    """
+    if STORAGE_BACKEND == 'sqlite':
+        return await asyncio.to_thread(job_sqlite.fetch_range, user_id)
+    await ensure_ledger(user_id)
+    return await _read_ledger(user_id)
+
+
+async def load_range(user_id, start_date, end_date):
+    """
+    Функция для получения операций пользователя за период
+    :param user_id: id пользователя
+    :param start_date: Первая дата периода в формате "%d.%m.%Y"
+    :param end_date: Последняя дата периода (включительно) в формате "%d.%m.%Y"
+
+    :type user_id: string
+    :type start_date: string
+    :type end_date: string
+
+    :return: Словарь транзакций {дата: {время: операция}} только за указанный период. Читаются только разделы
+    месяцев периода.
+    """
+    if STORAGE_BACKEND == 'sqlite':
+        return await asyncio.to_thread(job_sqlite.fetch_range, user_id, start_date, end_date)
+    start = datetime.datetime.strptime(start_date, "%d.%m.%Y")
+    end = datetime.datetime.strptime(end_date, "%d.%m.%Y")
+    await ensure_ledger(user_id)
+    data = await _read_ledger(user_id, _periods_between(user_id, start, end))
+    return {date_str: day for date_str, day in data.items()
+            if start <= datetime.datetime.strptime(date_str, "%d.%m.%Y") <= end}
+
+
+async def load_day(user_id, date_str):
+    """
+    Функция для получения операций пользователя за один день
+    :param user_id: id пользователя
+    :param date_str: Дата в формате "%d.%m.%Y"
+
+    :type user_id: string
+    :type date_str: string
+
+    :return: Словарь {время: операция}. В базе SQLite это выборка по индексу (user_id, date),
+    в json-журнале — чтение одного раздела (месяца этой даты).
+    """
+    if STORAGE_BACKEND == 'sqlite':
+        data = await asyncio.to_thread(job_sqlite.fetch_range, user_id, date_str, date_str)
+    else:
+        await ensure_ledger(user_id)
+        data = await _read_ledger(user_id, [_period(date_str)])
+    return data.get(date_str, {})
+
+
+async def _read_ledger(user_id, periods=None):
+    """
+    Функция для чтения разделов журнала в словарь транзакций
+    :param periods: Разделы 'ГГГГ-ММ' (None — все разделы)
+    """
+    data = {}
+    for period in _periods(user_id) if periods is None else periods:
+        file_path = _partition_path(user_id, period)
+        if not os.path.exists(file_path):
+            continue
+        if LEDGER_FORMAT == 'binary':
+            # Двоичный раздел читается одним вызовом и разбирается без построчного json.loads
+            async with aiofiles.open(file_path, 'rb') as file:
+                buffer = await file.read()
+            for record in job_ledger_bin.decode_records(buffer):
+                _apply_record(data, record)
+        else:
+            async with aiofiles.open(file_path, 'r', encoding='utf-8') as file:
+                async for line in file:
+                    # Строка без перевода строки в конце — запись, которая дописывается прямо сейчас
+                    if line.endswith('\n') and line.strip():
+                        _apply_record(data, json.loads(line))
+        job_metrics.add_bytes('job_json', 'read', os.path.getsize(file_path))
+    return data
+
+
+def _read_file_records(file_path, ledger_format):
+    if ledger_format == 'binary':
+        yield from job_ledger_bin.read_records(file_path)
+        return
+    with open(file_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            if line.endswith('\n') and line.strip():
+                yield json.loads(line)
+
+
+def _iter_records(user_id, ledger_format=None, periods=None):
+    # Записи разделов по порядку месяцев (блокирующее чтение)
+    ledger_format = ledger_format or LEDGER_FORMAT
+    for period in _periods(user_id, ledger_format) if periods is None else periods:
+        yield from _read_file_records(_partition_path(user_id, period, ledger_format), ledger_format)
+
+
+def ledger_years(user_id):
+    """
+    Функция для получения списка лет, за которые у пользователя есть операции
+    :return: Отсортированный список годов. Годы определяются по именам разделов журнала, сами разделы не читаются.
+    Функция блокирующая и предназначена для отдельного процесса или потока, как и iter_transactions().
+    """
+    if STORAGE_BACKEND == 'sqlite':
+        return sorted({int(date_str[-4:]) for date_str, _, _ in job_sqlite.iter_range(user_id)})
+    return sorted({int(period[:4]) for period in _periods(user_id) if period != UNKNOWN_PERIOD})
+
+
+def iter_transactions(user_id, year=None):
+    """
+    Функция для потокового обхода операций пользователя без загрузки всего журнала в память
+    :param user_id: id пользователя
+    :param year: Год, операции которого нужны (None — вся история)
+
+    :type user_id: string
+    :type year: int
+
+    :return: Генератор кортежей (date_str, time_str, операция) с учетом поправок описаний.
+
+    Примечание:
+    - Функция блокирующая (обычное чтение файла), поэтому вызывается в пуле процессов или через `asyncio.to_thread()`.
+      Миграция со старого формата должна быть выполнена заранее через `ensure_ledger()`.
+    - Читаются только разделы выбранного года, каждый раздел — дважды: первый проход собирает поправки описаний,
+      второй выдает операции. В памяти держатся только поправки и ключи операций одного месяца.
+    """
+    if STORAGE_BACKEND == 'sqlite':
+        start, end = (f'01.01.{year}', f'31.12.{year}') if year is not None else (None, None)
+        yield from job_sqlite.iter_range(user_id, start, end)
+        return
+
+    for period in _periods(user_id):
+        if year is not None and not period.startswith(f'{year:04d}-'):
+            continue
+        # Поправка описания всегда лежит в разделе своей операции, поэтому разделы обходятся независимо
+        descriptions = {}
+        for record in _iter_records(user_id, periods=[period]):
+            if record['op'] == 'describe':
+                descriptions[(record['date'], record['time'])] = record['description']
+
+        seen = set()
+        for record in _iter_records(user_id, periods=[period]):
+            if record['op'] != 'add':
+                continue
+            key = (record['date'], record['time'])
+            if key in seen:
+                continue
+            seen.add(key)
+            yield record['date'], record['time'], {
+                "description": descriptions.get(key, record.get('description')),
+                "type": record['type'],
+                "category": record['category'],
+                "amount": record['amount']
+            }
+
+
+async def compact_ledger(user_id):
+    """
+    Функция для уплотнения журнала: поправки описаний сворачиваются в сами записи операций
+    :param user_id: id пользователя
+
+    :type user_id: string
+
+    :return: Перезаписываются (атомарно) только разделы, в которые с прошлого уплотнения дописывались поправки;
+    если таких сведений нет (после перезапуска бота), уплотняются все разделы. Строки индекса остальных разделов
+    не меняются. Для базы SQLite уплотнение не требуется.
+    """
+    if STORAGE_BACKEND == 'sqlite':
+        return
+    await ensure_ledger(user_id)
+    async with job_lock.user_lock(user_id, 'json'):
+        periods = _amended_periods.pop(str(user_id), None) or set(_periods(user_id))
+        index = await _load_index(user_id)
+        rows = [(tx_id, moment, offset) for tx_id, (moment, offset) in index['entries'].items()
+                if _moment_period(moment) not in periods]
+        for period in sorted(periods):
+            if os.path.exists(_partition_path(user_id, period)):
+                records = await asyncio.to_thread(list, _iter_records(user_id, periods=[period]))
+                rows += await _write_partition(user_id, period, _fold_records(records))
+        await _write_index(user_id, rows, index['next_id'])
+        _amendments_count[str(user_id)] = 0
+
+
+async def description_operation(user_id, type_operation, category, amount, date_str, time_str, description=None,
+                                tx_id=None):
+    """
+    Функция для добавления в журнал пользователя новой записи о транзакции
     :param user_id: id пользователя используется для названия файла
     :param type_operation: тип операции Доход или Расход
     :param category: Категория дохода или расхода
     :param amount: Сумма для добавления в описание
-    :param date_str: Дата, используется как ключ в json-файле
-    :param time_str: Время, используется как ключ в json-файле
+    :param date_str: Дата операции
+    :param time_str: Время операции
     :param description: Описание операции
+    :param tx_id: ID операции, заранее назначенный `reserve()` (None — назначить сейчас)
 
     :type user_id: string
     :type type_operation: string
@@ -22,46 +745,157 @@ async def description_operation(user_id, type_operation, category, amount, date_
     :type date_str: string
     :type time_str: string
     :type description: string
+    :type tx_id: int
 
-    :return: Создается файл если его не было и добавляется информация о транзакциях
+    :return: ID операции. В конец раздела ledger/ГГГГ-ММ.jsonl (месяц операции) дописывается одна строка, а в индекс {id}.idx — ее ID и смещение;
+    остальная история не читается и не перезаписывается. При STORAGE_BACKEND='sqlite' операция вставляется в базу.
+    Строка операции сразу добавляется в готовый отчет за день.
     """
-    new_entry = {
+    record = {
+        "op": "add",
+        "id": tx_id,
+        "date": date_str,
+        "time": time_str,
         "description": description,
         "type": type_operation,
         "category": category,
         "amount": amount
     }
+    if STORAGE_BACKEND == 'jsonl':
+        await ensure_ledger(user_id)
+    async with job_lock.user_lock(user_id, 'json'):
+        await _add_unlocked(user_id, [record])
+    return record['id']
 
-    # Путь к файлу
-    file_path = f'user_files/{user_id}/{user_id}.json'
 
-    # Проверяем, существует ли файл data.json
-    if os.path.exists(file_path):
-        # Читаем существующие данные из файла асинхронно
-        async with aiofiles.open(file_path, 'r', encoding='utf-8') as file:
-            content = await file.read()
-            data = json.loads(content)
-    else:
-        # Инициализируем пустой словарь, если файл не существует
-        data = {}
+async def add_transactions(user_id, entries):
+    """
+    Функция для пакетного добавления операций (используется при импорте выписок)
+    :param user_id: id пользователя
+    :param entries: Список словарей {date, time, type, category, amount, description} и, если ID уже назначен
+    `reserve()`, id
+
+    :type user_id: string
+    :type entries: list
+
+    :return: Все операции дописываются в журнал одной записью в файл (или одной пачкой вставок в SQLite).
+    Операции с ID, который уже есть в индексе, пропускаются.
+    """
+    records = [{
+        "op": "add",
+        "id": entry.get('id'),
+        "date": entry['date'],
+        "time": entry['time'],
+        "description": entry.get('description'),
+        "type": entry['type'],
+        "category": entry['category'],
+        "amount": entry['amount']
+    } for entry in entries]
+    if not records:
+        return
+    if STORAGE_BACKEND == 'jsonl':
+        await ensure_ledger(user_id)
+    async with job_lock.user_lock(user_id, 'json'):
+        await _add_unlocked(user_id, records)
+
+
+async def reserve(user_id, entries):
+    """
+    Функция для заблаговременного назначения ID новым операциям (используется журналом намерений job_wal)
+    :param user_id: id пользователя
+    :param entries: Список словарей операций с ключами date и time
 
-    # Обновляем данные
-    if date_str not in data:
-        data[date_str] = {}
-    if time_str not in data[date_str]:
-        data[date_str][time_str] = new_entry
+    :type user_id: string
+    :type entries: list
+
+    :return: Тот же список: в каждую операцию записывается id, а если ее секунда уже занята — новые date и time.
+    Намерение записывается в job_wal уже с ID, поэтому повторное применение после сбоя не создает дубликатов.
+    """
+    if STORAGE_BACKEND == 'jsonl':
+        await ensure_ledger(user_id)
+    async with job_lock.user_lock(user_id, 'json'):
+        index = await _load_index(user_id)
+        for entry in entries:
+            _assign_unlocked(index, entry)
+    return entries
+
+
+def _read_record_at(user_id, moment, offset):
+    file_path = _partition_path(user_id, _moment_period(moment))
+    if not os.path.exists(file_path):
+        return None
+    if LEDGER_FORMAT == 'binary':
+        return job_ledger_bin.read_record_at(file_path, offset)
+    with open(file_path, 'rb') as file:
+        file.seek(offset)
+        line = file.readline()
+    try:
+        return json.loads(line) if line.endswith(b'\n') else None
+    except ValueError:
+        return None
+
+
+async def find_transaction(user_id, tx_id):
+    """
+    Функция для поиска операции по ID
+    :param user_id: id пользователя
+    :param tx_id: ID операции
+
+    :type user_id: string
+    :type tx_id: int
+
+    :return: Словарь {id, date, time, type, category, amount} или None, если операции нет. По индексу читается
+    одна запись журнала (в SQLite — одна строка по индексу (user_id, date)), история целиком не разбирается.
+    Если запись по смещению не совпадает с ID (индекс устарел после сбоя), индекс один раз перестраивается.
+    """
+    if STORAGE_BACKEND == 'sqlite':
+        # ID хранится в самой базе: операция ищется по уникальному индексу (user_id, tx_id)
+        async with job_lock.user_lock(user_id, 'json'):
+            await _load_index(user_id)
+        return await asyncio.to_thread(job_sqlite.fetch_transaction, user_id, tx_id)
+    await ensure_ledger(user_id)
+    async with job_lock.user_lock(user_id, 'json'):
+        for attempt in range(2):
+            found = (await _load_index(user_id))['entries'].get(tx_id)
+            if found is None:
+                return None
+            moment, offset = found
+            record = await asyncio.to_thread(_read_record_at, user_id, moment, offset)
+            if record is not None and record.get('op') == 'add' and record.get('id') == tx_id:
+                return {key: record.get(key) for key in ('id', 'date', 'time', 'type', 'category', 'amount')}
+            if attempt == 0:
+                await _reindex_unlocked(user_id)
+            else:
+                return None
+
+
+async def set_description(user_id, tx_id, description):
+    """
+    Функция для изменения описания операции по ID (кнопка "Добавить описание")
+    :param user_id: id пользователя
+    :param tx_id: ID операции
+    :param description: Новое описание
+
+    :type user_id: string
+    :type tx_id: int
+    :type description: string
 
-    # Записываем обновленные данные обратно в файл асинхронно
-    async with aiofiles.open(file_path, 'w', encoding='utf-8') as file:
-        await file.write(json.dumps(data, ensure_ascii=False, indent=4))
+    :return: True, если операция найдена и описание записано, иначе False. Дата и время операции берутся
+    из индекса `find_transaction()`, затем поправка дописывается `get_description_text()`.
+    """
+    found = await find_transaction(user_id, tx_id)
+    if found is None:
+        return False
+    await get_description_text(user_id, found['date'], found['time'], description)
+    return True
 
 
 async def get_description_text(user_id, date_str, time_str, description):
     """
     Функция для добавления описания в транзакциях
     :param user_id: id пользователя используется для названия файла
-    :param date_str: Дата, используется как ключ в json-файл
-    :param time_str: Время, используется как ключ в json-файле
+    :param date_str: Дата операции
+    :param time_str: Время операции
     :param description: Описание операции
 
     :type user_id: string
@@ -69,53 +903,211 @@ async def get_description_text(user_id, date_str, time_str, description):
     :type time_str: string
     :type description: string
 
-    :return: Добавляет описания для ранее созданных транзакций
-    """
-    # print(user_id, date_str, time_str, description)
-    # Путь к файлу
-    file_path = f'user_files/{user_id}/{user_id}.json'
-    # Проверяем, существует ли файл data.json
-    if os.path.exists(file_path):
-        # Читаем существующие данные из файла асинхронно
-        async with aiofiles.open(file_path, 'r', encoding='utf-8') as file:
-            content = await file.read()
-            data = json.loads(content)
+    :return: В журнал дописывается запись-поправка с новым описанием. Когда поправок накапливается больше
+    COMPACT_THRESHOLD, журнал уплотняется. При STORAGE_BACKEND='sqlite' описание обновляется в базе.
+    """
+    # Отчет за этот день придется собрать заново, уже с новым описанием
+    report = _daily_reports.get(str(user_id))
+    if report is not None and report['date'] == date_str:
+        del _daily_reports[str(user_id)]
+
+    if STORAGE_BACKEND == 'sqlite':
+        await asyncio.to_thread(job_sqlite.set_description, user_id, date_str, time_str, description)
+        _bump_version(user_id)
+        return
+    await _append_record(user_id, {
+        "op": "describe",
+        "date": date_str,
+        "time": time_str,
+        "description": description
+    })
+    _bump_version(user_id)
+
+    key = str(user_id)
+    _amendments_count[key] = _amendments_count.get(key, 0) + 1
+    _amended_periods.setdefault(key, set()).add(_period(date_str))
+    if _amendments_count[key] >= COMPACT_THRESHOLD:
+        await compact_ledger(user_id)
+
+
+def _format_report_entry(time_str, entry):
+    # Категория и описание вводятся пользователем, поэтому экранируются для MarkdownV2: иначе символ вроде "." или
+    # "(" в описании приводит к BadRequest, и отчет пользователя не отправляется целиком
+    amount = escape_md(f"{entry['amount']:,.0f}".replace(",", " "))
+    description = entry.get('description')
+    description = f"*{escape_md(description)}*" if description else ''
+    return (f"`{time_str}` : *{entry['type']}* на *{amount}₽* "
+            f"*Категория*: {escape_md(entry['category'])}\\. \n*Описание*: {description}\n\n")
+
+
+async def _build_report(user_id, date_str, cached=True):
+    """
+    Функция для сборки отчета за день по сохраненным операциям (вызывается под блокировкой 'json'; при cached=False
+    только читает хранилище и вызывается без нее)
+    :return: Структура отчета {"date", "times", "parts"}, которая сохраняется в кэше _daily_reports
+    (при cached=False — не сохраняется)
+    """
+    if STORAGE_BACKEND == 'sqlite':
+        day = (await asyncio.to_thread(job_sqlite.fetch_range, user_id, date_str, date_str)).get(date_str, {})
     else:
-        # Инициализируем пустой словарь, если файл не существует
-        data = {}
+        day = (await _read_ledger(user_id, [_period(date_str)])).get(date_str, {})
+    report = {
+        "date": date_str,
+        "times": set(day),
+        "parts": [_format_report_entry(time_str, entry) for time_str, entry in day.items()]
+    }
+    if cached:
+        _daily_reports[str(user_id)] = report
+    return report
 
-    if date_str in data and time_str in data[date_str]:
-        data[date_str][time_str]['description'] = description
-        # Записываем обновленные данные обратно в файл асинхронно
-    async with aiofiles.open(file_path, 'w', encoding='utf-8') as file:
-        await file.write(json.dumps(data, ensure_ascii=False, indent=4))
 
+async def _report_add(user_id, record):
+    """
+    Функция для инкрементального обновления отчета за день после добавления операции (под блокировкой 'json')
+    :return: Если отчет за дату операции уже собран, в него дописывается одна строка. Если операция сегодняшняя,
+    а отчета еще нет, он собирается один раз — дальше поддерживается добавлением строк.
+    """
+    report = _daily_reports.get(str(user_id))
+    if report is not None and report['date'] == record['date']:
+        if record['time'] not in report['times']:
+            report['times'].add(record['time'])
+            report['parts'].append(_format_report_entry(record['time'], record))
+    elif record['date'] == datetime.datetime.now().strftime("%d.%m.%Y"):
+        await _build_report(user_id, record['date'])
 
-async def read_and_process_file(user_id: str):
-    current_time = datetime.datetime.now()
-    date_str = current_time.strftime("%d.%m.%Y")
 
-    # Путь к файлу
-    file_path = f'user_files/{user_id}/{user_id}.json'
+async def read_and_process_file(user_id: str, date_str: str = None, read_only: bool = False):
+    """
+    Функция для получения отчета пользователя за текущий день в формате MarkdownV2
+    :param user_id: id пользователя
+    :param date_str: Дата отчета в формате "%d.%m.%Y" (по умолчанию — текущая дата сервера; рассылка передает
+    местную дату пользователя)
+    :param read_only: Только читать журнал. True передает процесс, в котором операции не записываются
+    (основной процесс при работе с процессами-обработчиками `job_workers`).
 
-    # Проверяем, существует ли файл data.json
-    if os.path.exists(file_path):
-        # Читаем существующие данные из файла асинхронно
-        async with aiofiles.open(file_path, 'r', encoding='utf-8') as file:
-            content = await file.read()
-            data = json.loads(content)
+    :type user_id: string
+    :type date_str: string
+    :type read_only: bool
 
-        dict_keys = data.get(date_str, {}).keys()
+    :return: Текст отчета. Если отчет за сегодня уже поддерживается в памяти, он возвращается без чтения журнала;
+    иначе собирается один раз и кэшируется до следующего изменения описания.
+
+    Примечание:
+    - При read_only=True журнал не переводится в разделы (`ensure_ledger()`), кэш отчетов не используется,
+    а отчет собирается чтением разделов без блокировки. Блокировки `job_lock` действуют только внутри процесса,
+    поэтому изменять журнал, который пишет процесс-обработчик пользователя, здесь нельзя, а кэш этого процесса
+    не узнал бы о его операциях. Недописанная последняя запись раздела при чтении пропускается.
+    - Журнал, еще не переведенный в разделы, в этом режиме не читается (возвращается None, и рассылка пропускает
+    пользователя): операции за день записывает процесс-обработчик, а он переводит журнал до первой записи.
+    """
+    date_str = date_str or datetime.datetime.now().strftime("%d.%m.%Y")
 
-        f = date_str.replace(".", "\.")
-        f = f'*{f}*\n'
+    if STORAGE_BACKEND == 'jsonl' and not read_only:
+        await ensure_ledger(user_id)
 
-        for i in dict_keys:
-            save_data = data[date_str][i]
-            amount = f"{save_data['amount']:,.0f}".replace(",", " ")
-            f += (f"`{i}` : *{save_data['type']}* на *{amount}₽* "
-                  f"*Категория*: {save_data['category']}\. \n*Описание*: *{save_data['description']}*\n\n")
+    # Проверяем, существует ли журнал пользователя
+    if STORAGE_BACKEND == 'sqlite' or _has_ledger(user_id):
+        if read_only:
+            report = await _build_report(user_id, date_str, cached=False)
+        else:
+            report = _daily_reports.get(str(user_id))
+            if report is None or report['date'] != date_str:
+                async with job_lock.user_lock(user_id, 'json'):
+                    report = await _build_report(user_id, date_str)
 
-        return f
+        f = date_str.replace(".", "\\.")
+        return ''.join([f'*{f}*\n'] + report['parts'])
+    elif read_only:
+        return None
     else:
-        return f"Файл для пользователя {user_id} не найден."
+        return f"Файл для пользователя {user_id} не найден\\."
+
+
+async def reset_user(user_id):
+    """
+    Функция для удаления всех операций пользователя (используется при сбросе данных)
+    :param user_id: id пользователя
+
+    :type user_id: string
+
+    :return: Удаляет строки пользователя из базы SQLite и сбрасывает служебное состояние журнала.
+    Сами файлы в папке пользователя удаляются вызывающим кодом.
+    """
+    if STORAGE_BACKEND == 'sqlite':
+        await asyncio.to_thread(job_sqlite.delete_user, user_id)
+    _amendments_count.pop(str(user_id), None)
+    _amended_periods.pop(str(user_id), None)
+    _migrated_users.discard(str(user_id))
+    _daily_reports.pop(str(user_id), None)
+    _indexes.pop(str(user_id), None)
+    _bump_version(user_id)
+
+
+async def import_to_sqlite(folder_path='user_files'):
+    """
+    Функция для массового переноса json-журналов всех пользователей в базу SQLite
+    :param folder_path: Папка, в которой лежат папки пользователей
+
+    :type folder_path: string
+
+    :return: Количество перенесенных операций. Журналы (и старые {id}.json) читаются как обычно, ID операций
+    сохраняются в столбце tx_id, а вставка идет пачками через job_sqlite.insert_transactions().
+    """
+    imported = 0
+    for user_id in os.listdir(folder_path):
+        if not os.path.isdir(os.path.join(folder_path, user_id)):
+            continue
+        await ensure_ledger(user_id)
+        # ID операций переносятся вместе с ними, чтобы кнопки "Добавить описание" продолжали работать
+        records = _fold_records(await asyncio.to_thread(list, _iter_records(user_id)))
+        rows = [(user_id, record['date'], record['time'], record['type'], record['category'], record['amount'],
+                 record.get('description'), record.get('id')) for record in records]
+        imported += await asyncio.to_thread(job_sqlite.insert_transactions, rows)
+    return imported
+
+
+async def convert_ledger(user_id, target_format=None):
+    """
+    Функция для перевода журнала пользователя в другой формат
+    :param user_id: id пользователя
+    :param target_format: 'binary' или 'jsonl' (по умолчанию — LEDGER_FORMAT)
+
+    :type user_id: string
+    :type target_format: string
+
+    :return: Количество перенесенных записей (0, если журнал уже в нужном формате или его нет).
+    Старый формат {id}.json переносится как обычно через ensure_ledger().
+    """
+    target_format = target_format or LEDGER_FORMAT
+    source_format = 'jsonl' if target_format == 'binary' else 'binary'
+    await ensure_ledger(user_id)
+    async with job_lock.user_lock(user_id, 'json'):
+        if _periods(user_id, target_format) or not _periods(user_id, source_format):
+            return 0
+        converted = await _convert_unlocked(user_id, source_format, target_format)
+        _amendments_count.pop(str(user_id), None)
+        _amended_periods.pop(str(user_id), None)
+        _migrated_users.discard(str(user_id))
+    return converted
+
+
+async def convert_all(folder_path='user_files', target_format=None):
+    """
+    Функция для массового перевода журналов всех пользователей в другой формат (python job_ledger_bin.py binary)
+    :param folder_path: Папка, в которой лежат папки пользователей
+    :param target_format: 'binary' или 'jsonl' (по умолчанию — LEDGER_FORMAT)
+
+    :type folder_path: string
+    :type target_format: string
+
+    :return: Количество переведенных журналов.
+
+    Примечание:
+    - Бот читает только журнал формата LEDGER_FORMAT; журнал другого формата он переводит сам при первом
+    обращении, поэтому после смены LEDGER_FORMAT запускать перевод заранее не обязательно.
+    """
+    converted = 0
+    for user_id in os.listdir(folder_path):
+        if os.path.isdir(os.path.join(folder_path, user_id)) and await convert_ledger(user_id, target_format):
+            converted += 1
+    return converted
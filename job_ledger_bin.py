@@ -0,0 +1,239 @@
+import json
+import struct
+import datetime
+
+# Сигнатура в начале двоичного журнала {id}.bin
+MAGIC = b'FLB1'
+
+# Коды типов и категорий операций. Коды записаны в файлах журналов, поэтому существующие значения нельзя
+# переставлять или удалять — новые добавляются только в конец.
+TYPES = ('Доход', 'Расход')
+CATEGORIES = ("Зп на руки", "Зп на карточку", "Шабашки", "Другие",
+              "Жилье", "Коммуналка", "Еда", "Проезд", "Интернет", "Сотовая связь", "Одежда", "Медикаменты",
+              "Процент кредита", "Хоз расходы", "Техника", "Парикмахерская", "Развлечения", "Обучение",
+              "Подарки", "Прочие")
+
+OPS = ('add', 'describe')
+
+# Признаки записи
+FLAG_DESCRIPTION = 1       # после заголовка идет описание (u16 длина + UTF-8)
+FLAG_FRACTION = 2          # сумма хранится в сотых долях (дробная сумма из выписки)
+FLAG_TYPE_INLINE = 4       # тип не из TYPES: записан строкой (u8 длина + UTF-8)
+FLAG_CATEGORY_INLINE = 8   # категория не из CATEGORIES: записана строкой (u8 длина + UTF-8)
+FLAG_ID = 16               # сразу после заголовка идет ID операции (u64)
+FLAG_JSON = 128            # запись не укладывается в двоичный формат и целиком хранится как JSON
+
+# Заголовок записи: длина записи без этого поля, операция, признаки, секунды от EPOCH, код типа, код категории, сумма
+_HEADER = struct.Struct('<IBBqBBq')
+_SHORT = struct.Struct('<B')
+_LONG = struct.Struct('<H')
+_LENGTH = struct.Struct('<I')
+_ID = struct.Struct('<Q')
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+_TYPE_CODES = {name: code for code, name in enumerate(TYPES)}
+_CATEGORY_CODES = {name: code for code, name in enumerate(CATEGORIES)}
+_OP_CODES = {name: code for code, name in enumerate(OPS)}
+
+
+def to_timestamp(date_str, time_str):
+    """
+    Функция для перевода даты и времени операции в целое число секунд от EPOCH
+    """
+    moment = datetime.datetime.strptime(f'{date_str} {time_str}', "%d.%m.%Y %H:%M:%S")
+    return (moment - EPOCH) // datetime.timedelta(seconds=1)
+
+
+def from_timestamp(timestamp):
+    """
+    Функция для обратного перевода числа секунд в строки даты ("%d.%m.%Y") и времени ("%H:%M:%S")
+    """
+    moment = EPOCH + datetime.timedelta(seconds=timestamp)
+    return moment.strftime("%d.%m.%Y"), moment.strftime("%H:%M:%S")
+
+
+def _encode_json(record):
+    body = json.dumps(record, ensure_ascii=False).encode('utf-8')
+    return _HEADER.pack(_HEADER.size - _LENGTH.size + len(body), 0, FLAG_JSON, 0, 0, 0, 0) + body
+
+
+def encode_record(record):
+    """
+    Функция для упаковки одной записи журнала в двоичный вид
+    :param record: Запись журнала {"op": "add" | "describe", date, time, ...} в том же виде, что и в {id}.jsonl
+
+    :type record: dict
+
+    :return: Байты записи. Дата и время хранятся одним целым числом секунд, тип и категория — однобайтовыми кодами,
+    сумма — целым числом; строки пишутся только для описания и для значений, которых нет в таблицах кодов.
+    Запись, которую нельзя так упаковать (например, без суммы или с нестандартной датой), сохраняется как JSON.
+    """
+    try:
+        op = _OP_CODES[record['op']]
+        timestamp = to_timestamp(record['date'], record['time'])
+    except (KeyError, ValueError, TypeError):
+        return _encode_json(record)
+
+    flags = 0
+    tail = b''
+    if record.get('id') is not None:
+        if not isinstance(record['id'], int) or record['id'] < 0:
+            return _encode_json(record)
+        flags |= FLAG_ID
+        tail += _ID.pack(record['id'])
+    type_code = category_code = amount = 0
+    if record['op'] == 'add':
+        amount = record.get('amount')
+        if isinstance(amount, float):
+            if round(amount * 100) / 100 != amount:
+                return _encode_json(record)
+            flags |= FLAG_FRACTION
+            amount = round(amount * 100)
+        elif not isinstance(amount, int) or isinstance(amount, bool):
+            return _encode_json(record)
+
+        type_operation, category = record.get('type'), record.get('category')
+        if not isinstance(type_operation, str) or not isinstance(category, str):
+            return _encode_json(record)
+        if type_operation in _TYPE_CODES:
+            type_code = _TYPE_CODES[type_operation]
+        else:
+            flags |= FLAG_TYPE_INLINE
+            encoded = type_operation.encode('utf-8')
+            if len(encoded) > 255:
+                return _encode_json(record)
+            tail += _SHORT.pack(len(encoded)) + encoded
+        if category in _CATEGORY_CODES:
+            category_code = _CATEGORY_CODES[category]
+        else:
+            flags |= FLAG_CATEGORY_INLINE
+            encoded = category.encode('utf-8')
+            if len(encoded) > 255:
+                return _encode_json(record)
+            tail += _SHORT.pack(len(encoded)) + encoded
+
+    description = record.get('description')
+    if description is not None:
+        if not isinstance(description, str):
+            return _encode_json(record)
+        encoded = description.encode('utf-8')
+        if len(encoded) > 65535:
+            return _encode_json(record)
+        flags |= FLAG_DESCRIPTION
+        tail += _LONG.pack(len(encoded)) + encoded
+
+    return _HEADER.pack(_HEADER.size - _LENGTH.size + len(tail), op, flags, timestamp, type_code, category_code,
+                        amount) + tail
+
+
+def encode_records(records, with_magic=False):
+    """
+    Функция для упаковки набора записей
+    :param with_magic: Добавить ли сигнатуру MAGIC (для нового или перезаписываемого файла)
+
+    :return: Байты для записи или дозаписи в {id}.bin
+    """
+    content = b''.join(encode_record(record) for record in records)
+    return MAGIC + content if with_magic else content
+
+
+def decode_records(buffer):
+    """
+    Функция для распаковки двоичного журнала
+    :param buffer: Содержимое файла {id}.bin целиком
+
+    :type buffer: bytes
+
+    :return: Генератор записей в том же виде, что и строки {id}.jsonl. Недописанная последняя запись
+    (файл читается во время дозаписи) пропускается, как строка без перевода строки в json-журнале.
+
+    Примечание:
+    - Строки дат и времени собираются арифметикой по секундам, а строка даты кэшируется на время чтения,
+    поэтому разбор не вызывает strptime/strftime на каждую запись.
+    """
+    if not buffer:
+        return
+    if buffer[:len(MAGIC)] != MAGIC:
+        raise ValueError("Файл не является двоичным журналом операций")
+    view = memoryview(buffer)
+    end = len(buffer)
+    offset = len(MAGIC)
+    days = {}
+    while offset + _HEADER.size <= end:
+        length, op, flags, timestamp, type_code, category_code, amount = _HEADER.unpack_from(view, offset)
+        record_end = offset + _LENGTH.size + length
+        if record_end > end:
+            break
+        position = offset + _HEADER.size
+        offset = record_end
+        if flags & FLAG_JSON:
+            yield json.loads(bytes(view[position:record_end]).decode('utf-8'))
+            continue
+
+        day, seconds = divmod(timestamp, 86400)
+        date_str = days.get(day)
+        if date_str is None:
+            date_str = days[day] = (EPOCH + datetime.timedelta(days=day)).strftime("%d.%m.%Y")
+        time_str = f'{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}'
+
+        record = {"op": OPS[op], "date": date_str, "time": time_str}
+        if flags & FLAG_ID:
+            record["id"] = _ID.unpack_from(view, position)[0]
+            position += _ID.size
+        if op == 0:
+            if flags & FLAG_TYPE_INLINE:
+                size = view[position]
+                type_operation = bytes(view[position + 1:position + 1 + size]).decode('utf-8')
+                position += 1 + size
+            else:
+                type_operation = TYPES[type_code]
+            if flags & FLAG_CATEGORY_INLINE:
+                size = view[position]
+                category = bytes(view[position + 1:position + 1 + size]).decode('utf-8')
+                position += 1 + size
+            else:
+                category = CATEGORIES[category_code]
+            record["type"] = type_operation
+            record["category"] = category
+            record["amount"] = amount / 100 if flags & FLAG_FRACTION else amount
+        if flags & FLAG_DESCRIPTION:
+            size = _LONG.unpack_from(view, position)[0]
+            record["description"] = bytes(view[position + 2:position + 2 + size]).decode('utf-8')
+        else:
+            record["description"] = None
+        yield record
+
+
+def read_records(file_path):
+    """
+    Функция для чтения всех записей двоичного журнала (блокирующая)
+    :return: Генератор записей; файл читается одним вызовом read()
+    """
+    with open(file_path, 'rb') as file:
+        buffer = file.read()
+    yield from decode_records(buffer)
+
+
+def read_record_at(file_path, offset):
+    """
+    Функция для чтения одной записи по смещению в файле (блокирующая)
+    :return: Запись или None, если по смещению нет целой записи
+    """
+    with open(file_path, 'rb') as file:
+        file.seek(offset)
+        header = file.read(_LENGTH.size)
+        if len(header) < _LENGTH.size:
+            return None
+        chunk = header + file.read(_LENGTH.unpack(header)[0])
+    return next(decode_records(MAGIC + chunk), None)
+
+
+if __name__ == "__main__":
+    # Перевод журналов всех пользователей в другой формат: python job_ledger_bin.py [binary|jsonl]
+    import sys
+    import asyncio
+    import job_json
+
+    target = sys.argv[1] if len(sys.argv) > 1 else 'binary'
+    print(f"Переведено журналов: {asyncio.run(job_json.convert_all(target_format=target))}")
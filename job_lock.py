@@ -0,0 +1,51 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+# Активные блокировки: (id пользователя, ресурс) -> [asyncio.Lock, количество ожидающих и владеющих корутин]
+_locks = {}
+
+
+@asynccontextmanager
+async def user_lock(user_id, resource):
+    """
+    Асинхронный контекстный менеджер для последовательной записи данных одного пользователя
+    :param user_id: ID пользователя, данные которого изменяются
+    :param resource: Название защищаемого ресурса ('json' для журнала операций, 'xls' для Excel-таблицы)
+
+    :type user_id: int
+    :type resource: str
+
+    :return: Пока блок выполняется, другие изменения того же ресурса того же пользователя ждут своей очереди
+    (asyncio.Lock отдает блокировку в порядке обращения). Разные пользователи и разные ресурсы друг друга не ждут.
+
+    Примечание:
+    - Блокировка не реентерабельна: внутри блока нельзя повторно запрашивать тот же ресурс того же пользователя.
+    - Блокировка удаляется из словаря, как только ее никто не держит и не ждет, поэтому память не растет
+    с количеством пользователей.
+    """
+    key = (str(user_id), resource)
+    entry = _locks.get(key)
+    if entry is None:
+        entry = _locks[key] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _locks[key]
+
+
+def active_locks():
+    """
+    Функция возвращает количество блокировок, которые сейчас кем-то удерживаются или ожидаются
+    """
+    return len(_locks)
+
+
+def is_locked(user_id, resource):
+    """
+    Функция возвращает True, если ресурс пользователя сейчас кем-то удерживается или ожидается
+    """
+    return (str(user_id), resource) in _locks
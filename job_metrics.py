@@ -0,0 +1,230 @@
+import os
+import time
+import bisect
+import logging
+import functools
+import inspect
+
+from aiohttp import web
+from aiogram.dispatcher.handler import Handler
+
+# Порт HTTP-сервера с метриками в формате Prometheus (0 — сервер не запускается)
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+
+# Границы корзин гистограмм задержек в секундах
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+# Гистограммы: название -> Histogram
+_histograms = {}
+# Счетчики прочитанных и записанных байт: (источник, направление) -> байты
+_io_bytes = {}
+# Дополнительные источники метрик: название -> функция, возвращающая словарь {метрика: число}
+_gauges = {}
+
+
+class Histogram:
+    """
+    Гистограмма задержек с фиксированными корзинами BUCKETS
+    Запись значения — один bisect и три сложения, поэтому гистограммы можно держать включенными постоянно.
+    Перцентили оцениваются по корзинам с линейной интерполяцией внутри корзины.
+    """
+
+    __slots__ = ('counts', 'count', 'total', 'errors')
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.errors = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def percentile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            if cumulative + count >= rank and count:
+                lower = BUCKETS[index - 1] if index else 0.0
+                upper = BUCKETS[index] if BUCKETS[index] != float('inf') else lower * 2 or 1.0
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return BUCKETS[-2]
+
+
+def observe(name, seconds, error=False):
+    """
+    Функция для записи одного измерения
+    :param name: Название операции, например 'handler.start_command' или 'job_json.load_ledger'
+    :param seconds: Длительность в секундах
+    :param error: Завершилась ли операция исключением
+    """
+    histogram = _histograms.get(name)
+    if histogram is None:
+        histogram = _histograms[name] = Histogram()
+    histogram.observe(seconds)
+    if error:
+        histogram.errors += 1
+
+
+def add_bytes(source, direction, amount):
+    """
+    Функция для учета прочитанных или записанных байт
+    :param source: Источник, например 'job_json' или 'job_xls'
+    :param direction: 'read' или 'write'
+    :param amount: Количество байт
+    """
+    key = (source, direction)
+    _io_bytes[key] = _io_bytes.get(key, 0) + amount
+
+
+def register_gauges(name, collect):
+    """
+    Функция для подключения внешнего источника метрик (например, метрик пула job_io.xls_executor)
+    :param name: Префикс метрик
+    :param collect: Функция без аргументов, возвращающая словарь {метрика: число}
+    """
+    _gauges[name] = collect
+
+
+def timed(name, func):
+    """
+    Функция для оборачивания корутины замером времени и подсчетом ошибок
+    :return: Корутина с той же сигнатурой (functools.wraps сохраняет ее для aiogram)
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        error = False
+        try:
+            return await func(*args, **kwargs)
+        except BaseException:
+            error = True
+            raise
+        finally:
+            observe(name, time.perf_counter() - started, error)
+
+    wrapper.__wrapped_metrics__ = True
+    return wrapper
+
+
+def instrument_dispatcher(dispatcher):
+    """
+    Функция для подключения замеров ко всем зарегистрированным обработчикам диспетчера
+    :param dispatcher: Диспетчер aiogram
+
+    :return: Каждый обработчик заменяется оберткой `timed('handler.<имя>')`. Вызывается после регистрации
+    всех обработчиков.
+    """
+    for handler in vars(dispatcher).values():
+        if not isinstance(handler, Handler):
+            continue
+        for handler_obj in handler.handlers:
+            if not getattr(handler_obj.handler, '__wrapped_metrics__', False):
+                handler_obj.handler = timed(f'handler.{handler_obj.handler.__name__}', handler_obj.handler)
+
+
+def instrument_module(module):
+    """
+    Функция для подключения замеров ко всем публичным корутинам модуля (job_json, job_xls)
+    :return: Функции заменяются в самом модуле, поэтому замеряются и вызовы изнутри модуля.
+    """
+    for attribute, func in list(vars(module).items()):
+        if attribute.startswith('_') or not inspect.iscoroutinefunction(func):
+            continue
+        if getattr(func, '__module__', None) != module.__name__ or getattr(func, '__wrapped_metrics__', False):
+            continue
+        setattr(module, attribute, timed(f'{module.__name__}.{attribute}', func))
+
+
+def snapshot():
+    """
+    Функция для получения текущих значений всех метрик
+    :return: Словарь {"latency": {название: {count, errors, avg, p50, p95, p99}}, "io_bytes": {...}, "gauges": {...}}
+    """
+    latency = {}
+    for name, histogram in sorted(_histograms.items()):
+        latency[name] = {
+            "count": histogram.count,
+            "errors": histogram.errors,
+            "avg": histogram.total / histogram.count if histogram.count else 0.0,
+            "p50": histogram.percentile(0.5),
+            "p95": histogram.percentile(0.95),
+            "p99": histogram.percentile(0.99)
+        }
+    gauges = {}
+    for name, collect in _gauges.items():
+        try:
+            gauges.update({f'{name}_{metric}': value for metric, value in collect().items()})
+        except Exception as e:
+            logging.warning(f"Не удалось получить метрики {name}: {e}")
+    return {"latency": latency, "io_bytes": dict(_io_bytes), "gauges": gauges}
+
+
+def render_text():
+    """
+    Функция для краткого текстового отчета (для служебной команды бота)
+    """
+    data = snapshot()
+    lines = ["Задержки, мс (кол-во / ошибки / p50 / p95 / p99):"]
+    for name, values in data["latency"].items():
+        lines.append(f"{name}: {values['count']} / {values['errors']} / {values['p50'] * 1000:.1f} / "
+                     f"{values['p95'] * 1000:.1f} / {values['p99'] * 1000:.1f}")
+    lines.append("\nВвод-вывод, байт:")
+    lines += [f"{source} {direction}: {amount}" for (source, direction), amount in sorted(data["io_bytes"].items())]
+    if data["gauges"]:
+        lines.append("")
+        lines += [f"{name}: {value:.4f}" if isinstance(value, float) else f"{name}: {value}"
+                  for name, value in data["gauges"].items()]
+    return '\n'.join(lines)
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def render_prometheus():
+    """
+    Функция для выгрузки метрик в текстовом формате Prometheus
+    """
+    lines = ["# TYPE bot_latency_seconds histogram"]
+    for name, histogram in sorted(_histograms.items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS, histogram.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'bot_latency_seconds_bucket{{name="{_label(name)}",le="{le}"}} {cumulative}')
+        lines.append(f'bot_latency_seconds_sum{{name="{_label(name)}"}} {histogram.total}')
+        lines.append(f'bot_latency_seconds_count{{name="{_label(name)}"}} {histogram.count}')
+    lines.append("# TYPE bot_errors_total counter")
+    for name, histogram in sorted(_histograms.items()):
+        lines.append(f'bot_errors_total{{name="{_label(name)}"}} {histogram.errors}')
+    lines.append("# TYPE bot_io_bytes_total counter")
+    for (source, direction), amount in sorted(_io_bytes.items()):
+        lines.append(f'bot_io_bytes_total{{source="{_label(source)}",direction="{direction}"}} {amount}')
+    lines.append("# TYPE bot_gauge gauge")
+    for name, value in snapshot()["gauges"].items():
+        lines.append(f'bot_gauge{{name="{_label(name)}"}} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+async def start_server(port=METRICS_PORT, host=METRICS_HOST):
+    """
+    Функция для запуска локального HTTP-сервера с метриками по адресу /metrics
+    :return: web.AppRunner (для остановки через cleanup()). Сервер слушает только host (по умолчанию 127.0.0.1).
+    """
+    async def handle(request):
+        return web.Response(text=render_prometheus(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
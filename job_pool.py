@@ -0,0 +1,66 @@
+import os
+import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# Количество процессов для тяжелой работы (сборка и экспорт таблиц, графики)
+PROCESS_POOL_SIZE = int(os.getenv('PROCESS_POOL_SIZE', os.cpu_count() or 1))
+
+_pool = None
+# Размер пула этого процесса (процессы-обработчики `job_workers` делят PROCESS_POOL_SIZE между собой)
+_max_workers = PROCESS_POOL_SIZE
+
+
+def get_pool():
+    """
+    Функция для получения общего пула процессов (создается при первом обращении)
+    :return: ProcessPoolExecutor. Процессы запускаются методом spawn, чтобы не наследовать состояние
+    цикла событий и потоков основного процесса.
+    """
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=_max_workers, mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+
+def split(processes):
+    """
+    Функция для деления пула между процессами-обработчиками (вызывается в каждом из них до первой задачи)
+    :param processes: Количество процессов-обработчиков
+
+    :type processes: int
+
+    :return: Пул процесса получает PROCESS_POOL_SIZE // processes процессов (не меньше одного), поэтому всего
+    на машине их не больше PROCESS_POOL_SIZE, а не PROCESS_POOL_SIZE на каждый процесс-обработчик. Один пул на все
+    процессы невозможен: ProcessPoolExecutor не передается в другой процесс.
+    """
+    global _max_workers
+    _max_workers = max(1, PROCESS_POOL_SIZE // processes)
+
+
+async def run_in_process(func, *args, **kwargs):
+    """
+    Асинхронная функция для выполнения блокирующей функции в пуле процессов
+    :param func: Функция уровня модуля (она передается в дочерний процесс по имени)
+    :param args: Позиционные аргументы функции
+    :param kwargs: Именованные аргументы функции
+
+    :type func: callable
+
+    :return: Результат функции. Цикл событий бота в это время продолжает обрабатывать других пользователей.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_pool(), functools.partial(func, *args, **kwargs))
+
+
+def shutdown():
+    """
+    Функция для остановки пула процессов (вызывается при остановке бота)
+    """
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True)
+        _pool = None
+# Размер пула этого процесса (процессы-обработчики `job_workers` делят PROCESS_POOL_SIZE между собой)
+_max_workers = PROCESS_POOL_SIZE
@@ -0,0 +1,277 @@
+import os
+import asyncio
+import sqlite3
+import datetime
+import threading
+
+import job_cache
+
+# Путь к реестру пользователей (ID, дата последней операции, часовой пояс и время ежедневного отчета)
+REGISTRY_PATH = os.getenv('REGISTRY_PATH', 'user_files/registry.sqlite3')
+# Часовой пояс и время ежедневного отчета новых пользователей. Значения записываются в реестр при создании
+# столбцов, поэтому у уже зарегистрированных пользователей они потом не меняются вместе с переменными окружения.
+DEFAULT_TIMEZONE = os.getenv('DEFAULT_TIMEZONE', 'Europe/Moscow')
+DEFAULT_DELIVERY_TIME = os.getenv('DEFAULT_DELIVERY_TIME', '23:00')
+
+_connection = None
+# Соединение используется из разных потоков (asyncio.to_thread), поэтому доступ к нему сериализуется
+_connection_lock = threading.Lock()
+# Уже записанные даты последней операции: id пользователя -> дата в ISO-формате. Повторная операция за тот же
+# день не обращается к базе (для вытесненного пользователя запрос к базе просто повторится).
+_last_active = job_cache.LRUCache()
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    registered TEXT NOT NULL,
+    last_active TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_users_last_active ON users (last_active);
+"""
+
+# Столбцы расписания отчета, которых нет в реестрах, созданных до их появления
+_SCHEDULE_COLUMNS = (
+    ('timezone', DEFAULT_TIMEZONE),
+    ('delivery_time', DEFAULT_DELIVERY_TIME),
+)
+_SCHEDULE_INDEX = "CREATE INDEX IF NOT EXISTS idx_users_delivery ON users (timezone, delivery_time, last_active)"
+
+
+def _to_iso(date):
+    # Дата хранится в ISO-формате, чтобы сравнение строк совпадало со сравнением дат
+    if isinstance(date, str):
+        return datetime.datetime.strptime(date, "%d.%m.%Y").strftime("%Y-%m-%d")
+    return date.strftime("%Y-%m-%d")
+
+
+def _connect():
+    """
+    Функция для получения (и при первом вызове — создания) соединения с реестром
+    :return: Объект sqlite3.Connection. Реестр работает в режиме WAL, поэтому процессы-обработчики
+    (job_workers) могут писать в него одновременно.
+    """
+    global _connection
+    if _connection is None:
+        folder = os.path.dirname(REGISTRY_PATH)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        _connection = sqlite3.connect(REGISTRY_PATH, check_same_thread=False, timeout=30)
+        _connection.execute("PRAGMA journal_mode=WAL")
+        _connection.execute("PRAGMA synchronous=NORMAL")
+        _connection.executescript(_SCHEMA)
+        _migrate(_connection)
+    return _connection
+
+
+def _migrate(connection):
+    # Добавляет столбцы расписания (значение по умолчанию подставляется и в уже существующие строки)
+    existing = {row[1] for row in connection.execute("PRAGMA table_info(users)")}
+    with connection:
+        for column, default in _SCHEDULE_COLUMNS:
+            if column not in existing:
+                quoted = default.replace("'", "''")
+                connection.execute(f"ALTER TABLE users ADD COLUMN {column} TEXT NOT NULL DEFAULT '{quoted}'")
+        connection.execute(_SCHEDULE_INDEX)
+
+
+def _upsert(user_id, iso_date):
+    # Дата последней операции только увеличивается: импорт старой выписки ее не сдвигает назад
+    with _connection_lock:
+        connection = _connect()
+        with connection:
+            connection.execute(
+                "INSERT INTO users (user_id, registered, last_active) VALUES (?, ?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET last_active = excluded.last_active "
+                "WHERE users.last_active IS NULL OR users.last_active < excluded.last_active",
+                (str(user_id), _to_iso(datetime.datetime.now()), iso_date))
+
+
+async def mark_active(user_id, date=None):
+    """
+    Функция для отметки операции пользователя в реестре
+    :param user_id: ID пользователя
+    :param date: Дата операции: datetime или строка "%d.%m.%Y" (по умолчанию — текущая)
+
+    :type user_id: int
+    :type date: datetime.datetime | str
+
+    :return: В реестр записывается дата операции, если она позже уже записанной. Первая операция за день
+    обновляет одну строку по первичному ключу, остальные операции этого дня отсекаются по `_last_active`.
+    """
+    iso_date = _to_iso(date or datetime.datetime.now())
+    key = str(user_id)
+    if _last_active.get(key, '') >= iso_date:
+        return
+    await asyncio.to_thread(_upsert, user_id, iso_date)
+    _last_active[key] = iso_date
+
+
+def register(user_id):
+    """
+    Функция для добавления пользователя в реестр без даты операции (команда /start)
+    """
+    with _connection_lock:
+        connection = _connect()
+        with connection:
+            connection.execute("INSERT OR IGNORE INTO users (user_id, registered) VALUES (?, ?)",
+                               (str(user_id), _to_iso(datetime.datetime.now())))
+
+
+def reset(user_id):
+    """
+    Функция для сброса даты последней операции пользователя (используется при сбросе данных)
+    """
+    _last_active.pop(str(user_id), None)
+    with _connection_lock:
+        connection = _connect()
+        with connection:
+            connection.execute("UPDATE users SET last_active = NULL WHERE user_id = ?", (str(user_id),))
+
+
+def set_schedule(user_id, timezone=None, delivery_time=None):
+    """
+    Функция для изменения часового пояса и времени ежедневного отчета пользователя
+    :param user_id: ID пользователя
+    :param timezone: Название часового пояса IANA, например 'Asia/Yekaterinburg' (None — не менять)
+    :param delivery_time: Местное время отчета "%H:%M" (None — не менять)
+
+    :type user_id: int
+    :type timezone: str
+    :type delivery_time: str
+
+    :return: Значения должны быть проверены заранее (см. job_schedule.parse_timezone() и parse_time()).
+    Если пользователя еще нет в реестре, он добавляется.
+    """
+    with _connection_lock:
+        connection = _connect()
+        with connection:
+            connection.execute("INSERT OR IGNORE INTO users (user_id, registered) VALUES (?, ?)",
+                               (str(user_id), _to_iso(datetime.datetime.now())))
+            if timezone is not None:
+                connection.execute("UPDATE users SET timezone = ? WHERE user_id = ?", (timezone, str(user_id)))
+            if delivery_time is not None:
+                connection.execute("UPDATE users SET delivery_time = ? WHERE user_id = ?",
+                                   (delivery_time, str(user_id)))
+
+
+def get_schedule(user_id):
+    """
+    Функция для получения расписания отчета пользователя
+    :return: Кортеж (часовой пояс, время "%H:%M"); для пользователя не из реестра — значения по умолчанию
+    """
+    with _connection_lock:
+        row = _connect().execute("SELECT timezone, delivery_time FROM users WHERE user_id = ?",
+                                 (str(user_id),)).fetchone()
+    return tuple(row) if row else (DEFAULT_TIMEZONE, DEFAULT_DELIVERY_TIME)
+
+
+def timezones():
+    """
+    Функция для получения списка часовых поясов пользователей из реестра
+    :return: Список различных часовых поясов. Пояса перебираются прыжками по индексу расписания (следующий пояс —
+    MIN(timezone) больше предыдущего), поэтому запрос стоит O(число поясов), а не O(число пользователей).
+    """
+    with _connection_lock:
+        return [row[0] for row in _connect().execute(
+            "WITH RECURSIVE zones (name) AS ("
+            "SELECT MIN(timezone) FROM users "
+            "UNION ALL SELECT (SELECT MIN(timezone) FROM users WHERE timezone > zones.name) FROM zones "
+            "WHERE zones.name IS NOT NULL) "
+            "SELECT name FROM zones WHERE name IS NOT NULL")]
+
+
+def iter_due(timezone, start_time, end_time, date_str):
+    """
+    Функция для потокового обхода пользователей, которым пора отправить отчет
+    :param timezone: Часовой пояс пользователей
+    :param start_time: Начало интервала местного времени "%H:%M" (включительно)
+    :param end_time: Конец интервала местного времени "%H:%M" (не включительно)
+    :param date_str: Местная дата отчета в формате "%d.%m.%Y"
+
+    :type timezone: str
+    :type start_time: str
+    :type end_time: str
+    :type date_str: str
+
+    :return: Генератор кортежей (ID пользователя, время отчета) для пользователей пояса timezone со временем
+    отчета в интервале и операциями за date_str. Выборка идет по индексу (timezone, delivery_time, last_active).
+    Функция блокирующая и предназначена для отдельного потока.
+
+    Примечание:
+    - Операции помечаются местным временем пользователя (`job_schedule.local_now()`), поэтому last_active
+    и date_str — даты одного часового пояса.
+    """
+    with _connection_lock:
+        cursor = _connect().execute(
+            "SELECT user_id, delivery_time FROM users "
+            "WHERE timezone = ? AND delivery_time >= ? AND delivery_time < ? AND last_active >= ?",
+            (timezone, start_time, end_time, _to_iso(date_str)))
+        for user_id, delivery_time in cursor:
+            yield user_id, delivery_time
+
+
+def iter_active(date_str):
+    """
+    Функция для потокового обхода пользователей, у которых есть операции за указанную дату
+    :param date_str: Дата в формате "%d.%m.%Y"
+
+    :type date_str: str
+
+    :return: Генератор ID пользователей. Выборка идет по индексу last_active и читается из курсора по мере обхода,
+    поэтому стоимость пропорциональна числу активных пользователей, а не всех. Операции с более поздней датой
+    (например, из выписки) тоже учитываются: отчет за день таких пользователей просто собирается как обычно.
+    Функция блокирующая и предназначена для отдельного потока, как и job_sqlite.iter_range().
+    """
+    with _connection_lock:
+        cursor = _connect().execute("SELECT user_id FROM users WHERE last_active >= ?", (_to_iso(date_str),))
+        for (user_id,) in cursor:
+            yield user_id
+
+
+async def active_users(date_str):
+    """
+    Функция для получения списка пользователей с операциями за дату (для ежедневной рассылки)
+    :return: Список ID пользователей из `iter_active()`; выборка выполняется вне цикла событий
+    """
+    return await asyncio.to_thread(lambda: list(iter_active(date_str)))
+
+
+def _latest_activity(folder):
+    # Дата последнего изменения файлов пользователя (разделов журнала ledger и файлов в самой папке)
+    moments = [os.path.getmtime(os.path.join(root, name)) for root, _, names in os.walk(folder) for name in names]
+    return datetime.datetime.fromtimestamp(max(moments)) if moments else None
+
+
+def populate(folder_path='user_files'):
+    """
+    Функция для первоначального заполнения реестра по папкам пользователей
+    :param folder_path: Папка, в которой лежат папки пользователей
+
+    :type folder_path: str
+
+    :return: Количество добавленных пользователей. Папки обходятся только если реестр пуст (первый запуск
+    после обновления); дата последней операции оценивается по времени изменения журнала. Функция блокирующая.
+    """
+    with _connection_lock:
+        connection = _connect()
+        if connection.execute("SELECT 1 FROM users LIMIT 1").fetchone() is not None:
+            return 0
+        rows = []
+        if os.path.isdir(folder_path):
+            for user_id in os.listdir(folder_path):
+                folder = os.path.join(folder_path, user_id)
+                if os.path.isdir(folder):
+                    latest = _latest_activity(folder)
+                    rows.append((user_id, _to_iso(datetime.datetime.now()), latest and _to_iso(latest)))
+        with connection:
+            connection.executemany("INSERT OR IGNORE INTO users (user_id, registered, last_active) VALUES (?, ?, ?)",
+                                   rows)
+    return len(rows)
+
+
+def close():
+    global _connection
+    with _connection_lock:
+        if _connection is not None:
+            _connection.close()
+            _connection = None
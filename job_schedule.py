@@ -0,0 +1,247 @@
+import os
+import zlib
+import asyncio
+import logging
+import datetime
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.cron import CronTrigger
+
+import job_json
+import job_registry
+import job_broadcast
+from job_jobstore import SQLiteJobStore
+
+# Длина слота рассылки в минутах (делитель 60): отчеты пользователей, чье время попадает в слот, рассылаются в нем
+SLOT_MINUTES = int(os.getenv('REPORT_SLOT_MINUTES', 15))
+# Разброс отправки внутри слота в секундах; запас до конца слота оставлен на саму отправку
+JITTER_SECONDS = int(os.getenv('REPORT_JITTER_SECONDS', SLOT_MINUTES * 60 - 60))
+# За сколько часов назад доставляются отчеты, пропущенные за время остановки бота
+CATCHUP_HOURS = float(os.getenv('REPORT_CATCHUP_HOURS', 6))
+# Файл с концом последнего обработанного интервала (UTC)
+SLOT_CHECKPOINT = os.getenv('REPORT_SLOT_CHECKPOINT', 'user_files/report_slot.checkpoint')
+
+# ID задачи рассылки в хранилище планировщика
+JOB_ID = 'daily_reports'
+
+UTC = datetime.timezone.utc
+
+# Параметры рассылки, заданные в setup(): {"send": корутина отправки, "checkpoint_path": контрольная точка,
+# "read_only": отчеты только читаются}
+_settings = {}
+
+
+def parse_time(text):
+    """
+    Функция для проверки времени отчета
+    :return: Время в виде "%H:%M" (например, '9:05' -> '09:05'). Для неверного значения выбрасывается ValueError.
+    """
+    return datetime.datetime.strptime(text.strip(), "%H:%M").strftime("%H:%M")
+
+
+def parse_timezone(name):
+    """
+    Функция для проверки названия часового пояса
+    :return: Название пояса IANA (например, 'Europe/Moscow'). Для неизвестного пояса выбрасывается ValueError.
+    """
+    try:
+        return str(ZoneInfo(name.strip()))
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"Неизвестный часовой пояс {name!r}")
+
+
+def local_now(user_id, now=None):
+    """
+    Функция для получения текущего местного времени пользователя (блокирующая: пояс читается из реестра)
+    :param user_id: ID пользователя
+    :param now: Текущий момент (UTC); по умолчанию — текущее время
+
+    :type user_id: int
+    :type now: datetime.datetime
+
+    :return: datetime без часового пояса в поясе пользователя из `job_registry.get_schedule()`.
+
+    Примечание:
+    - Этим временем помечаются операции (и дата последней операции в реестре), а отчеты выбираются и собираются
+    по местной дате пользователя. Поэтому операция, внесенная после отправки отчета, но до местной полуночи,
+    попадает в отчет за свою местную дату, а внесенная после местной полуночи — в отчет следующего дня,
+    независимо от часового пояса сервера.
+    """
+    timezone, _ = job_registry.get_schedule(user_id)
+    try:
+        zone = ZoneInfo(timezone)
+    except (ZoneInfoNotFoundError, ValueError):
+        zone = ZoneInfo(job_registry.DEFAULT_TIMEZONE)
+    return (now or datetime.datetime.now(UTC)).astimezone(zone).replace(tzinfo=None)
+
+
+def slot_start(moment):
+    """
+    Функция для определения начала слота, в который попадает момент времени
+    """
+    return moment.replace(minute=moment.minute - moment.minute % SLOT_MINUTES, second=0, microsecond=0)
+
+
+def jitter(user_id):
+    """
+    Функция для получения сдвига отправки отчета пользователя внутри слота
+    :return: Число секунд от 0 до JITTER_SECONDS. Сдвиг вычисляется по ID (crc32), поэтому он постоянен
+    для пользователя и равномерно распределяет пользователей одного слота по его длине.
+    """
+    return zlib.crc32(str(user_id).encode()) % max(1, JITTER_SECONDS)
+
+
+def _local_ranges(zone, start, end):
+    """
+    Функция для перевода интервала UTC [start, end) в интервалы местного времени пояса
+    :return: Список кортежей (дата "%d.%m.%Y", начало "%H:%M", конец "%H:%M"); интервал, переходящий через
+    полночь, делится по датам, а конец суток записывается как '24:00'.
+    """
+    ranges = []
+    local_start, local_end = start.astimezone(zone), end.astimezone(zone)
+    day = local_start.date()
+    while day <= local_end.date():
+        first = local_start.strftime("%H:%M") if day == local_start.date() else '00:00'
+        last = local_end.strftime("%H:%M") if day == local_end.date() else '24:00'
+        if first < last:
+            ranges.append((day.strftime("%d.%m.%Y"), first, last))
+        day += datetime.timedelta(days=1)
+    return ranges
+
+
+def _due_users(start, end):
+    """
+    Функция для выбора отчетов, которые нужно отправить в интервале UTC [start, end) (блокирующая)
+    :return: Список кортежей (момент отправки UTC, ID пользователя, местная дата отчета), упорядоченный по моменту.
+    Момент отправки — начало слота, в который попадает местное время отчета пользователя, плюс его сдвиг `jitter()`.
+    Пользователи без операций за свою местную дату не выбираются.
+    """
+    due = []
+    for name in job_registry.timezones():
+        try:
+            zone = ZoneInfo(name)
+        except (ZoneInfoNotFoundError, ValueError):
+            logging.error(f"В реестре пользователей неизвестный часовой пояс {name!r}")
+            continue
+        for date_str, first, last in _local_ranges(zone, start, end):
+            day = datetime.datetime.strptime(date_str, "%d.%m.%Y")
+            for user_id, delivery_time in job_registry.iter_due(name, first, last, date_str):
+                hour, minute = map(int, delivery_time.split(':'))
+                local = day.replace(hour=hour, minute=minute, tzinfo=zone)
+                moment = slot_start(local.astimezone(UTC)) + datetime.timedelta(seconds=jitter(user_id))
+                due.append((moment, user_id, date_str))
+    due.sort()
+    return due
+
+
+def _read_checkpoint():
+    if not os.path.exists(SLOT_CHECKPOINT):
+        return None
+    with open(SLOT_CHECKPOINT, 'r', encoding='utf-8') as file:
+        text = file.read().strip()
+    try:
+        return datetime.datetime.fromisoformat(text)
+    except ValueError:
+        return None
+
+
+def _write_checkpoint(moment):
+    tmp_path = f'{SLOT_CHECKPOINT}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        file.write(moment.isoformat())
+    os.replace(tmp_path, SLOT_CHECKPOINT)
+
+
+async def deliver_due(send, checkpoint_path=None, now=None, read_only=False):
+    """
+    Функция для рассылки отчетов, время которых наступило
+    :param send: Корутина send(chat_id, text) для отправки сообщения
+    :param checkpoint_path: Файл контрольной точки рассылки (см. `job_broadcast.broadcast()`)
+    :param now: Текущий момент (UTC); по умолчанию — текущее время
+    :param read_only: Собирать отчеты только чтением журналов (см. `job_json.read_and_process_file()`)
+
+    :type send: callable
+    :type checkpoint_path: str
+    :type now: datetime.datetime
+    :type read_only: bool
+
+    :return: Счетчики рассылки `job_broadcast.broadcast()`.
+
+    Логика работы:
+    1. Обрабатывается интервал UTC от конца предыдущего обработанного интервала (SLOT_CHECKPOINT, не раньше
+    CATCHUP_HOURS назад) до конца текущего слота. Обычно это один слот; после простоя — все пропущенные слоты.
+    2. Для каждого часового пояса из реестра интервал переводится в местное время, и по индексу выбираются
+    пользователи с временем отчета в нем и операциями за свою местную дату (`_due_users()`).
+    3. Отчеты рассылаются по порядку моментов отправки: перед сборкой отчета обработчик ждет момента
+    пользователя, поэтому нагрузка распределяется по слоту, а не приходится на его начало.
+    4. После рассылки конец интервала записывается в SLOT_CHECKPOINT. Если рассылку прервать, повторный запуск
+    обработает тот же интервал, а уже доставленные отчеты пропустит по контрольной точке рассылки.
+    """
+    now = now or datetime.datetime.now(UTC)
+    end = slot_start(now) + datetime.timedelta(minutes=SLOT_MINUTES)
+    start = _read_checkpoint() or slot_start(now)
+    start = max(start, end - datetime.timedelta(hours=CATCHUP_HOURS))
+    if start >= end:
+        return {'sent': 0, 'skipped': 0, 'failed': 0, 'resumed': 0}
+
+    due = await asyncio.to_thread(_due_users, start, end)
+    plan = {user_id: (moment, date_str) for moment, user_id, date_str in due}
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+
+    async def make_text(chat_id):
+        moment, date_str = plan[chat_id]
+        delay = (moment - now).total_seconds() - (loop.time() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return await job_json.read_and_process_file(chat_id, date_str, read_only=read_only)
+
+    stats = await job_broadcast.broadcast([user_id for _, user_id, _ in due], make_text, send,
+                                          run_id=start.isoformat(), checkpoint_path=checkpoint_path)
+    _write_checkpoint(end)
+    logging.info(f"Рассылка отчетов за {start:%H:%M}-{end:%H:%M} UTC завершена: {stats}")
+    return stats
+
+
+async def tick():
+    """
+    Функция, которую планировщик запускает в начале каждого слота
+    """
+    if not _settings:
+        logging.warning("Рассылка отчетов не настроена: job_schedule.setup() не вызывался")
+        return
+    await deliver_due(_settings['send'], _settings['checkpoint_path'], read_only=_settings['read_only'])
+
+
+def setup(send, checkpoint_path=None, read_only=False):
+    """
+    Функция для запуска планировщика рассылки отчетов
+    :param send: Корутина send(chat_id, text) для отправки сообщения
+    :param checkpoint_path: Файл контрольной точки рассылки
+    :param read_only: Собирать отчеты только чтением журналов. True — если операции записывает другой процесс
+    (процессы-обработчики `job_workers`): журналы изменяет только он, а кэш этого процесса о них не узнает.
+
+    :type send: callable
+    :type checkpoint_path: str
+    :type read_only: bool
+
+    :return: Запущенный `AsyncIOScheduler`.
+
+    Примечание:
+    - Задачи хранятся в SQLite (`job_jobstore.SQLiteJobStore`), поэтому время следующего запуска переживает
+    перезапуск. Задача добавляется заново, только если ее нет или изменилась длина слота: иначе сохраненный
+    запуск, пропущенный за время остановки, был бы потерян.
+    - coalesce=True: сколько бы запусков ни было пропущено, после перезапуска выполняется один, а он сам
+    охватывает все пропущенные слоты (см. `deliver_due()`). max_instances=1 не дает двум рассылкам идти одновременно.
+    """
+    _settings.update(send=send, checkpoint_path=checkpoint_path, read_only=read_only)
+    scheduler = AsyncIOScheduler(timezone=UTC, jobstores={'default': SQLiteJobStore()},
+                                 job_defaults={'coalesce': True, 'max_instances': 1,
+                                               'misfire_grace_time': int(CATCHUP_HOURS * 3600)})
+    scheduler.start()
+    trigger = CronTrigger(minute=f'*/{SLOT_MINUTES}', timezone=UTC)
+    job = scheduler.get_job(JOB_ID)
+    if job is None or str(job.trigger) != str(trigger):
+        scheduler.add_job(tick, trigger, id=JOB_ID, replace_existing=True)
+    return scheduler
@@ -0,0 +1,280 @@
+import os
+import sqlite3
+import datetime
+import threading
+
+# Путь к базе данных с транзакциями всех пользователей
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'user_files/transactions.sqlite3')
+# Сколько строк вставляется одним executemany при массовом импорте
+BATCH_SIZE = 1000
+
+_connection = None
+# Соединение используется из разных потоков (asyncio.to_thread), поэтому доступ к нему сериализуется
+_connection_lock = threading.Lock()
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    date TEXT NOT NULL,
+    time TEXT NOT NULL,
+    type TEXT,
+    category TEXT,
+    amount NUMERIC,
+    description TEXT,
+    UNIQUE (user_id, date, time)
+);
+CREATE INDEX IF NOT EXISTS idx_transactions_user_date ON transactions (user_id, date);
+CREATE INDEX IF NOT EXISTS idx_transactions_user_category ON transactions (user_id, category);
+"""
+# ID операции пользователя (кнопка "Добавить описание"); в базах, созданных до его появления, столбца нет
+_TX_ID_INDEX = "CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_user_tx ON transactions (user_id, tx_id)"
+
+
+def _to_iso(date_str):
+    # "%d.%m.%Y" не сортируется как строка, поэтому в базе дата хранится в ISO-формате
+    return datetime.datetime.strptime(date_str, "%d.%m.%Y").strftime("%Y-%m-%d")
+
+
+def _from_iso(iso_str):
+    return datetime.datetime.strptime(iso_str, "%Y-%m-%d").strftime("%d.%m.%Y")
+
+
+def _connect():
+    """
+    Функция для получения (и при первом вызове — создания) соединения с базой данных
+    :return: Объект sqlite3.Connection. База работает в режиме WAL, поэтому чтение не блокирует запись.
+    """
+    global _connection
+    if _connection is None:
+        folder = os.path.dirname(SQLITE_PATH)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        _connection = sqlite3.connect(SQLITE_PATH, check_same_thread=False)
+        _connection.execute("PRAGMA journal_mode=WAL")
+        _connection.execute("PRAGMA synchronous=NORMAL")
+        _connection.executescript(_SCHEMA)
+        _migrate(_connection)
+    return _connection
+
+
+def _migrate(connection):
+    # Добавляет столбец ID операций; у уже записанных операций он пуст до assign_ids().
+    # Базу одновременно открывают несколько процессов (job_workers), поэтому столбец мог добавить другой процесс.
+    existing = {row[1] for row in connection.execute("PRAGMA table_info(transactions)")}
+    with connection:
+        if 'tx_id' not in existing:
+            try:
+                connection.execute("ALTER TABLE transactions ADD COLUMN tx_id INTEGER")
+            except sqlite3.OperationalError as e:
+                if 'duplicate column' not in str(e):
+                    raise
+        connection.execute(_TX_ID_INDEX)
+
+
+def insert_transactions(rows):
+    """
+    Функция для пакетной вставки транзакций
+    :param rows: Итерируемый набор кортежей (user_id, date_str, time_str, type, category, amount, description, tx_id),
+    где date_str в формате "%d.%m.%Y", а tx_id — ID операции пользователя (None — будет назначен `assign_ids()`)
+
+    :type rows: iterable
+
+    :return: Количество вставленных строк. Строки вставляются пачками по BATCH_SIZE в одной транзакции на пачку.
+    Повторная операция того же пользователя с той же датой и временем игнорируется, как и в json-журнале.
+    """
+    inserted = 0
+    batch = []
+    with _connection_lock:
+        connection = _connect()
+        for user_id, date_str, time_str, type_operation, category, amount, description, tx_id in rows:
+            batch.append((str(user_id), _to_iso(date_str), time_str, type_operation, category, amount, description,
+                          tx_id))
+            if len(batch) >= BATCH_SIZE:
+                inserted += _insert_batch(connection, batch)
+                batch = []
+        if batch:
+            inserted += _insert_batch(connection, batch)
+    return inserted
+
+
+def _insert_batch(connection, batch):
+    with connection:
+        cursor = connection.executemany(
+            "INSERT OR IGNORE INTO transactions (user_id, date, time, type, category, amount, description, tx_id) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", batch)
+    return cursor.rowcount
+
+
+def set_description(user_id, date_str, time_str, description):
+    """
+    Функция для изменения описания одной транзакции (поиск идет по уникальному индексу)
+    """
+    with _connection_lock:
+        connection = _connect()
+        with connection:
+            connection.execute(
+                "UPDATE transactions SET description = ? WHERE user_id = ? AND date = ? AND time = ?",
+                (description, str(user_id), _to_iso(date_str), time_str))
+
+
+def assign_ids(user_id, known=None):
+    """
+    Функция для получения ID всех операций пользователя с назначением недостающих
+    :param user_id: ID пользователя
+    :param known: Уже выданные ID операций без ID в базе: {(date_str, time_str): ID} (например, из файла индекса
+    job_json, по которому были созданы кнопки "Добавить описание")
+
+    :type user_id: int
+    :type known: dict
+
+    :return: Список кортежей (ID, date_str, time_str) в порядке даты и времени. Операциям без ID (записанным
+    до появления столбца tx_id) ID берется из known, а если его там нет — назначается следующий по порядку дат.
+    Назначенные ID сразу сохраняются в базе, поэтому при потере индекса job_json они не меняются.
+    """
+    known = known or {}
+    with _connection_lock:
+        connection = _connect()
+        rows = connection.execute("SELECT rowid, tx_id, date, time FROM transactions WHERE user_id = ? "
+                                  "ORDER BY date, time", (str(user_id),)).fetchall()
+        used = {tx_id for _, tx_id, _, _ in rows if tx_id is not None}
+        next_id = max(used | set(known.values()) | {0}) + 1
+        assigned = []
+        result = []
+        for rowid, tx_id, iso_date, time_str in rows:
+            date_str = _from_iso(iso_date)
+            if tx_id is None:
+                tx_id = known.get((date_str, time_str))
+                if tx_id is None or tx_id in used:
+                    tx_id = next_id
+                    next_id += 1
+                used.add(tx_id)
+                assigned.append((tx_id, rowid))
+            result.append((tx_id, date_str, time_str))
+        if assigned:
+            with connection:
+                connection.executemany("UPDATE transactions SET tx_id = ? WHERE rowid = ?", assigned)
+    return result
+
+
+def fetch_transaction(user_id, tx_id):
+    """
+    Функция для выборки одной операции пользователя по ID (по уникальному индексу (user_id, tx_id))
+    :return: Словарь {id, date, time, type, category, amount} или None, если операции нет
+    """
+    with _connection_lock:
+        row = _connect().execute(
+            "SELECT date, time, type, category, amount FROM transactions WHERE user_id = ? AND tx_id = ?",
+            (str(user_id), tx_id)).fetchone()
+    if row is None:
+        return None
+    return {"id": tx_id, "date": _from_iso(row[0]), "time": row[1], "type": row[2], "category": row[3],
+            "amount": row[4]}
+
+
+def fetch_range(user_id, start_date=None, end_date=None):
+    """
+    Функция для выборки транзакций пользователя за период по индексу (user_id, date)
+    :param user_id: ID пользователя
+    :param start_date: Первая дата периода в формате "%d.%m.%Y" (None — без ограничения)
+    :param end_date: Последняя дата периода включительно в формате "%d.%m.%Y" (None — без ограничения)
+
+    :type user_id: int
+    :type start_date: str
+    :type end_date: str
+
+    :return: Словарь транзакций в формате журнала {дата: {время: {description, type, category, amount}}},
+    упорядоченный по дате и времени.
+    """
+    query = "SELECT date, time, type, category, amount, description FROM transactions WHERE user_id = ?"
+    params = [str(user_id)]
+    if start_date is not None:
+        query += " AND date >= ?"
+        params.append(_to_iso(start_date))
+    if end_date is not None:
+        query += " AND date <= ?"
+        params.append(_to_iso(end_date))
+    query += " ORDER BY date, time"
+
+    with _connection_lock:
+        rows = _connect().execute(query, params).fetchall()
+
+    data = {}
+    for iso_date, time_str, type_operation, category, amount, description in rows:
+        data.setdefault(_from_iso(iso_date), {})[time_str] = {
+            "description": description,
+            "type": type_operation,
+            "category": category,
+            "amount": amount
+        }
+    return data
+
+
+def iter_range(user_id, start_date=None, end_date=None):
+    """
+    Функция для потокового обхода транзакций пользователя за период (используется при экспорте всей истории)
+    :param user_id: ID пользователя
+    :param start_date: Первая дата периода в формате "%d.%m.%Y" (None — без ограничения)
+    :param end_date: Последняя дата периода включительно в формате "%d.%m.%Y" (None — без ограничения)
+
+    :return: Генератор кортежей (date_str, time_str, операция) в порядке даты и времени. Строки читаются
+    из курсора по мере обхода, выборка целиком в память не загружается. Функция предназначена для отдельного
+    процесса или потока: соединение удерживается на все время обхода.
+    """
+    query = "SELECT date, time, type, category, amount, description FROM transactions WHERE user_id = ?"
+    params = [str(user_id)]
+    if start_date is not None:
+        query += " AND date >= ?"
+        params.append(_to_iso(start_date))
+    if end_date is not None:
+        query += " AND date <= ?"
+        params.append(_to_iso(end_date))
+    query += " ORDER BY date, time"
+
+    with _connection_lock:
+        cursor = _connect().execute(query, params)
+        for iso_date, time_str, type_operation, category, amount, description in cursor:
+            yield _from_iso(iso_date), time_str, {
+                "description": description,
+                "type": type_operation,
+                "category": category,
+                "amount": amount
+            }
+
+
+def fetch_by_category(user_id, category):
+    """
+    Функция для выборки всех транзакций пользователя одной категории по индексу (user_id, category)
+    :return: Список кортежей (date_str, time_str, type, amount, description)
+    """
+    with _connection_lock:
+        rows = _connect().execute(
+            "SELECT date, time, type, amount, description FROM transactions "
+            "WHERE user_id = ? AND category = ? ORDER BY date, time", (str(user_id), category)).fetchall()
+    return [(_from_iso(row[0]),) + tuple(row[1:]) for row in rows]
+
+
+def delete_user(user_id):
+    """
+    Функция для удаления всех транзакций пользователя (используется при сбросе данных)
+    """
+    with _connection_lock:
+        connection = _connect()
+        with connection:
+            connection.execute("DELETE FROM transactions WHERE user_id = ?", (str(user_id),))
+
+
+def close():
+    global _connection
+    with _connection_lock:
+        if _connection is not None:
+            _connection.close()
+            _connection = None
+
+
+if __name__ == "__main__":
+    # Массовый перенос существующих json-журналов из папки user_files в базу: python job_sqlite.py
+    import asyncio
+    import job_json
+
+    print(f"Импортировано операций: {asyncio.run(job_json.import_to_sqlite())}")
@@ -0,0 +1,263 @@
+import os
+import json
+import asyncio
+import logging
+import datetime
+
+import job_xls
+import job_json
+import job_lock
+import job_aggregates
+
+# После скольких записей журнал намерений пользователя проверяется на уже учтенные записи и сокращается
+CHECKPOINT_EVERY = int(os.getenv('WAL_CHECKPOINT_EVERY', 50))
+
+# Следующий номер записи: id пользователя -> номер
+_next_seqs = {}
+# Количество записей, добавленных с последнего сокращения журнала: id пользователя -> количество
+_written = {}
+# Пользователи, у которых применение записи не завершилось (будет повторено при следующей операции)
+_incomplete = set()
+
+
+def _wal_path(user_id):
+    return f'user_files/{user_id}/wal.jsonl'
+
+
+def _read_entries(user_id):
+    """
+    Функция для чтения журнала намерений пользователя
+    :return: Список записей {seq, date, time, type, category, amount, description}. Недописанная последняя
+    строка (сбой во время записи) пропускается: такое намерение не было подтверждено и не применялось.
+    """
+    file_path = _wal_path(user_id)
+    if not os.path.exists(file_path):
+        return []
+    entries = []
+    with open(file_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            if line.endswith('\n') and line.strip():
+                entries.append(json.loads(line))
+    return entries
+
+
+def _append_entries(user_id, entries):
+    # Запись сбрасывается на диск (fsync) до того, как намерение начнет применяться
+    with open(_wal_path(user_id), 'a', encoding='utf-8') as file:
+        file.write(''.join(json.dumps(entry, ensure_ascii=False) + '\n' for entry in entries))
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def _rewrite_entries(user_id, entries):
+    file_path = _wal_path(user_id)
+    tmp_path = f'{file_path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        file.write(''.join(json.dumps(entry, ensure_ascii=False) + '\n' for entry in entries))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, file_path)
+
+
+async def _allocate(user_id, count):
+    """
+    Функция для выделения номеров новых записей (вызывается под блокировкой 'wal')
+    :return: Первый выделенный номер. При первом обращении нумерация продолжается с наибольшего номера
+    в журнале намерений и в месячных суммах, поэтому после сокращения журнала номера не повторяются.
+    """
+    key = str(user_id)
+    if key not in _next_seqs:
+        entries = await asyncio.to_thread(_read_entries, user_id)
+        last = max([entry['seq'] for entry in entries] + [await job_aggregates.applied_seq(user_id)])
+        _next_seqs[key] = last + 1
+    first = _next_seqs[key]
+    _next_seqs[key] += count
+    return first
+
+
+async def _log(user_id, entries):
+    async with job_lock.user_lock(user_id, 'wal'):
+        first = await _allocate(user_id, len(entries))
+        for offset, entry in enumerate(entries):
+            entry['seq'] = first + offset
+        await asyncio.to_thread(_append_entries, user_id, entries)
+        _written[str(user_id)] = _written.get(str(user_id), 0) + len(entries)
+    return entries
+
+
+async def record(user_id, type_operation, category, amount, date_str, time_str, description=None):
+    """
+    Функция для учета одной операции во всех хранилищах через журнал намерений
+    :param user_id: ID пользователя
+    :param type_operation: Тип операции: 'Доход' или 'Расход'
+    :param category: Категория операции
+    :param amount: Сумма операции
+    :param date_str: Дата операции в формате "%d.%m.%Y"
+    :param time_str: Время операции в формате "%H:%M:%S"
+    :param description: Описание операции
+
+    :type user_id: int
+    :type type_operation: str
+    :type category: str
+    :type amount: int
+    :type date_str: str
+    :type time_str: str
+    :type description: str
+
+    :return: ID операции (для кнопки "Добавить описание")
+
+    Логика работы:
+    1. Если таблица пользователя создана, книга заранее загружается в кэш: при занятом пуле Excel
+    (`job_io.BusyError`) операция отклоняется, ничего не записав.
+    2. Операции назначается ID (и свободная секунда, если эта уже занята) `job_json.reserve()`.
+    Намерение (операция, ее ID и номер seq) дописывается в user_files/{id}/wal.jsonl и сбрасывается на диск.
+    3. Операция добавляется в журнал операций `job_json.description_operation()`.
+    4. Операция учитывается в месячных суммах и книге `job_xls.data_validator()`; оба запоминают seq
+    (суммы — в той же атомарной записи файла, книга — в своем свойстве при отложенном сохранении).
+
+    Примечание:
+    - Если процесс упадет после шага 2, операция будет доприменена `recover()` при следующем запуске:
+    журнал операций пропускает уже известные ID, а суммы и книга — записи с номером не больше своего.
+    - Поэтому сохранение книги можно откладывать (job_xls.FLUSH_DELAY): до сохранения ее изменения
+    восстанавливаются из журнала намерений.
+    - Шаги 2-4 выполняются под блокировкой 'wal_apply', поэтому записи применяются строго в порядке номеров.
+    Иначе запись с меньшим номером могла бы примениться позже большей, и восстановление по "номер больше
+    учтенного" пропустило бы ее или учло бы другую дважды.
+    """
+    key = str(user_id)
+    if key in _incomplete:
+        await recover_user(user_id)
+    await job_xls.preload(user_id)
+    entry = {"date": date_str, "time": time_str, "type": type_operation, "category": category,
+             "amount": amount, "description": description}
+    await job_json.reserve(user_id, [entry])
+    async with job_lock.user_lock(user_id, 'wal_apply'):
+        await _log(user_id, [entry])
+        try:
+            await job_json.description_operation(user_id, type_operation, category, amount, entry['date'],
+                                                 entry['time'], description, tx_id=entry['id'])
+            await job_xls.data_validator(user_id, category, amount, seq=entry['seq'],
+                                         date=datetime.datetime.strptime(entry['date'], "%d.%m.%Y"))
+        except Exception:
+            # Намерение уже записано: оно будет доприменено при следующей операции пользователя или запуске бота
+            _incomplete.add(key)
+            raise
+    await _checkpoint(user_id)
+    return entry['id']
+
+
+async def record_many(user_id, entries):
+    """
+    Функция для пакетного учета операций через журнал намерений (используется при импорте выписок)
+    :param user_id: ID пользователя
+    :param entries: Список словарей {date, time, type, category, amount, description}
+
+    :type user_id: int
+    :type entries: list
+
+    :return: Все операции записываются в журнал намерений одной записью на диск, затем одной пачкой в журнал
+    операций и одной пачкой в суммы и книгу (с номером последней записи пачки).
+    """
+    if not entries:
+        return
+    key = str(user_id)
+    if key in _incomplete:
+        await recover_user(user_id)
+    await job_xls.preload(user_id)
+    reserved = await job_json.reserve(user_id, [dict(entry) for entry in entries])
+    async with job_lock.user_lock(user_id, 'wal_apply'):
+        logged = await _log(user_id, reserved)
+        try:
+            await job_json.add_transactions(user_id, logged)
+            items = [(datetime.datetime.strptime(entry['date'], "%d.%m.%Y"), entry['category'], entry['amount'])
+                     for entry in logged]
+            await job_xls.record_many(user_id, items, seq=logged[-1]['seq'])
+        except Exception:
+            _incomplete.add(key)
+            raise
+    await _checkpoint(user_id)
+
+
+async def _checkpoint(user_id, force=False):
+    """
+    Функция для сокращения журнала намерений: записи, учтенные во всех хранилищах, удаляются
+    :return: Учтенной считается запись с номером не больше номера в месячных суммах и (если таблица создана)
+    номера в сохраненной на диск книге. Проверка выполняется раз в CHECKPOINT_EVERY записей.
+    """
+    key = str(user_id)
+    if not force and _written.get(key, 0) < CHECKPOINT_EVERY:
+        return
+    applied = await job_aggregates.applied_seq(user_id)
+    if job_xls.is_materialized(user_id):
+        saved = job_xls.saved_seq(user_id)
+        if saved is None:
+            return
+        applied = min(applied, saved)
+    async with job_lock.user_lock(user_id, 'wal'):
+        entries = await asyncio.to_thread(_read_entries, user_id)
+        remaining = [entry for entry in entries if entry['seq'] > applied]
+        if len(remaining) != len(entries):
+            await asyncio.to_thread(_rewrite_entries, user_id, remaining)
+        _written[key] = len(remaining)
+
+
+async def recover_user(user_id):
+    """
+    Функция для доприменения записей журнала намерений одного пользователя
+    :param user_id: ID пользователя
+
+    :type user_id: int
+
+    :return: Количество доприменных записей. Записи с номером больше номера в месячных суммах добавляются
+    в журнал операций (уже записанные ID он пропускает) и в суммы; книга догоняет свой номер через `job_xls.replay()`.
+    После этого журнал намерений сокращается.
+    """
+    _incomplete.discard(str(user_id))
+    entries = await asyncio.to_thread(_read_entries, user_id)
+    if not entries:
+        return 0
+    async with job_lock.user_lock(user_id, 'wal_apply'):
+        applied = await job_aggregates.applied_seq(user_id)
+        pending = [entry for entry in entries if entry['seq'] > applied]
+        if pending:
+            await job_json.add_transactions(user_id, pending)
+            await job_aggregates.add_many(user_id, [
+                (datetime.datetime.strptime(entry['date'], "%d.%m.%Y"), entry['category'], entry['amount'])
+                for entry in pending], seq=pending[-1]['seq'])
+        replayed = await job_xls.replay(user_id, [
+            (entry['seq'], datetime.datetime.strptime(entry['date'], "%d.%m.%Y"), entry['category'], entry['amount'])
+            for entry in entries])
+    await _checkpoint(user_id, force=True)
+    return max(len(pending), replayed)
+
+
+async def recover(folder_path='user_files'):
+    """
+    Функция для восстановления после сбоя (вызывается при запуске бота)
+    :param folder_path: Папка, в которой лежат папки пользователей
+
+    :type folder_path: str
+
+    :return: Количество доприменных записей по всем пользователям
+    """
+    recovered = 0
+    if not os.path.isdir(folder_path):
+        return recovered
+    for user_id in os.listdir(folder_path):
+        if os.path.exists(os.path.join(folder_path, user_id, 'wal.jsonl')):
+            try:
+                recovered += await recover_user(user_id)
+            except Exception as e:
+                logging.error(f"Не удалось восстановить операции пользователя {user_id}: {e}")
+    if recovered:
+        logging.warning(f"Из журнала намерений восстановлено операций: {recovered}")
+    return recovered
+
+
+def drop_user(user_id):
+    """
+    Функция для удаления служебного состояния журнала намерений пользователя (используется при сбросе данных)
+    """
+    _next_seqs.pop(str(user_id), None)
+    _written.pop(str(user_id), None)
+    _incomplete.discard(str(user_id))
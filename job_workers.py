@@ -0,0 +1,240 @@
+import os
+import sys
+import signal
+import asyncio
+import logging
+import functools
+import importlib
+import multiprocessing
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher, types
+
+import job_pool
+import job_metrics
+
+# Количество процессов-обработчиков обновлений (0 — все обновления обрабатываются в основном процессе, как раньше)
+WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', 0))
+# Источник обновлений: 'polling' — опрос getUpdates, 'webhook' — локальный HTTP-сервер
+RUN_MODE = os.getenv('RUN_MODE', 'polling')
+# Параметры локального сервера для режима webhook
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+# Внешний адрес, который регистрируется в Telegram (если пусто, webhook настраивается вручную, например через прокси)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+# Таймаут long polling в секундах
+POLLING_TIMEOUT = 20
+
+
+def shard_for(user_id, workers):
+    """
+    Функция для выбора процесса-обработчика пользователя
+    :return: Номер процесса. Все обновления одного пользователя всегда попадают в один процесс, поэтому
+    его операции выполняются по порядку, а кэши и блокировки пользователя живут только в этом процессе.
+    """
+    return int(user_id) % workers
+
+
+def update_user_id(data):
+    """
+    Функция для определения пользователя, от которого пришло обновление
+    :param data: Обновление Telegram в виде словаря
+
+    :type data: dict
+
+    :return: ID пользователя (поле from, а если его нет — chat вложенного объекта) или 0 для обновлений без
+    пользователя.
+    """
+    for value in data.values():
+        if isinstance(value, dict):
+            source = value.get('from') or value.get('chat') or value.get('user')
+            if isinstance(source, dict) and 'id' in source:
+                return source['id']
+    return 0
+
+
+def _resolve(target):
+    """
+    Функция для получения объекта по строке вида "модуль:атрибут"
+    :return: Объект. Если модуль — это запущенный скрипт (`python main.py`), берется уже выполненный модуль
+    __main__: дочерний процесс spawn выполняет скрипт под этим именем, и повторный import создал бы второй
+    диспетчер и второе хранилище состояний.
+    """
+    module_name, attribute = target.split(':')
+    main_module = sys.modules.get('__main__')
+    main_file = getattr(main_module, '__file__', None) or ''
+    if os.path.splitext(os.path.basename(main_file))[0] == module_name:
+        module = main_module
+    else:
+        module = importlib.import_module(module_name)
+    return getattr(module, attribute)
+
+
+async def _process_after(previous, dispatcher, data):
+    if previous is not None:
+        await asyncio.wait([previous])
+    try:
+        await dispatcher.process_update(types.Update.to_object(data))
+    except Exception as e:
+        logging.error(f"Ошибка при обработке обновления {data.get('update_id')}: {e}")
+
+
+def _forget(tails, user_id, task):
+    if tails.get(user_id) is task:
+        del tails[user_id]
+
+
+async def _worker_loop(dispatcher, queue, on_shutdown, metrics_port=0):
+    """
+    Цикл процесса-обработчика: берет обновления из очереди и передает их диспетчеру
+    :return: Обновления разных пользователей обрабатываются параллельно, а обновления одного пользователя —
+    строго по очереди (каждое ждет завершения предыдущего). Получив None, процесс дожидается начатой
+    обработки, вызывает on_shutdown и закрывает хранилище состояний. Если задан metrics_port, метрики
+    процесса отдаются на этом порту.
+    """
+    Bot.set_current(dispatcher.bot)
+    Dispatcher.set_current(dispatcher)
+    if metrics_port:
+        await job_metrics.start_server(metrics_port)
+    # id пользователя -> задача его последнего обновления
+    tails = {}
+    while True:
+        item = await asyncio.to_thread(queue.get)
+        if item is None:
+            break
+        user_id, data = item
+        task = asyncio.ensure_future(_process_after(tails.get(user_id), dispatcher, data))
+        tails[user_id] = task
+        task.add_done_callback(functools.partial(_forget, tails, user_id))
+
+    if tails:
+        await asyncio.wait(list(tails.values()))
+    if on_shutdown is not None:
+        await on_shutdown(dispatcher)
+    await dispatcher.storage.close()
+    await dispatcher.storage.wait_closed()
+    session = await dispatcher.bot.get_session()
+    await session.close()
+
+
+def _worker_main(index, queue, dispatcher_target, on_shutdown_target, setup_target, workers):
+    # Остановкой процессов управляет основной процесс (через None в очереди), поэтому Ctrl+C здесь игнорируется
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    job_pool.split(workers)
+    if setup_target:
+        _resolve(setup_target)()
+    dispatcher = _resolve(dispatcher_target)
+    on_shutdown = _resolve(on_shutdown_target) if on_shutdown_target else None
+    logging.info(f"Процесс-обработчик {index} запущен (pid {os.getpid()}).")
+    # Метрики у каждого процесса свои: процесс index отдает их на порту METRICS_PORT + 1 + index
+    metrics_port = job_metrics.METRICS_PORT + 1 + index if job_metrics.METRICS_PORT else 0
+    asyncio.get_event_loop().run_until_complete(_worker_loop(dispatcher, queue, on_shutdown, metrics_port))
+
+
+async def _poll(bot, route):
+    """
+    Функция для получения обновлений через long polling и раздачи их процессам-обработчикам
+    """
+    await bot.delete_webhook()
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=POLLING_TIMEOUT)
+        except Exception as e:
+            logging.error(f"Ошибка при получении обновлений: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            route(update.to_python())
+            offset = update.update_id + 1
+
+
+async def _serve_webhook(bot, route):
+    """
+    Функция для приема обновлений на локальном HTTP-сервере и раздачи их процессам-обработчикам
+    """
+    async def handle(request):
+        route(await request.json())
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    if WEBHOOK_URL:
+        await bot.set_webhook(WEBHOOK_URL)
+    logging.info(f"Webhook принимает обновления на {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}.")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def run(bot, dispatcher_target, on_shutdown_target=None, on_startup=None, workers=WORKER_PROCESSES, mode=RUN_MODE,
+        setup_target=None):
+    """
+    Функция для запуска бота с обработкой обновлений в нескольких процессах
+    :param bot: Бот, через которого основной процесс получает обновления
+    :param dispatcher_target: Диспетчер в виде строки "модуль:атрибут" (например "main:dp"); каждый процесс
+    получает его из модуля сам
+    :param on_shutdown_target: Корутина, вызываемая в каждом процессе при остановке, в виде "модуль:атрибут"
+    :param on_startup: Корутина без аргументов, которая запускается в основном процессе (например, планировщик)
+    :param workers: Количество процессов-обработчиков
+    :param mode: 'polling' или 'webhook'
+    :param setup_target: Функция подготовки процесса-обработчика в виде "модуль:атрибут" (например "main:setup"),
+    вызывается в каждом процессе до приема обновлений
+
+    :type bot: Bot
+    :type dispatcher_target: str
+    :type on_shutdown_target: str
+    :type on_startup: callable
+    :type workers: int
+    :type mode: str
+    :type setup_target: str
+
+    Логика работы:
+    1. Запускается workers процессов (методом spawn), у каждого своя очередь обновлений.
+    2. Основной процесс получает обновления (polling или webhook) и кладет каждое в очередь процесса
+    `shard_for(user_id, workers)`, так что у каждого пользователя один процесс и порядок его обновлений сохраняется.
+    3. Тяжелая работа с Excel разных пользователей выполняется в разных процессах и использует несколько ядер.
+    Пул `job_pool` делится между процессами (`job_pool.split()`), поэтому всего в пулах не больше
+    job_pool.PROCESS_POOL_SIZE процессов.
+    4. При остановке (Ctrl+C) каждому процессу отправляется None: он дорабатывает начатые обновления,
+    сохраняет данные и завершается.
+
+    Примечание:
+    - Ежедневная рассылка (on_startup) работает только в основном процессе. Журналы изменяют процессы-обработчики,
+    а блокировки `job_lock` основного процесса им не видны, поэтому отчеты собираются только чтением журналов:
+    без кэша, перевода журналов в разделы и уплотнения (`job_json.read_and_process_file(read_only=True)`).
+    - Дочерние процессы spawn выполняют модуль бота заново, поэтому на уровне модуля он только создает
+    диспетчер и регистрирует обработчики, а хранилище и замеры подключает setup_target.
+    """
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue() for _ in range(workers)]
+    processes = [context.Process(target=_worker_main, name=f'worker-{index}',
+                                 args=(index, queue, dispatcher_target, on_shutdown_target, setup_target, workers))
+                 for index, queue in enumerate(queues)]
+    for process in processes:
+        process.start()
+
+    def route(data):
+        user_id = update_user_id(data)
+        queues[shard_for(user_id, workers)].put((user_id, data))
+
+    loop = asyncio.get_event_loop()
+    if on_startup is not None:
+        loop.create_task(on_startup())
+    try:
+        loop.run_until_complete(_serve_webhook(bot, route) if mode == 'webhook' else _poll(bot, route))
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for process in processes:
+            process.join()
+        session = loop.run_until_complete(bot.get_session())
+        loop.run_until_complete(session.close())
+        logging.info("Процессы-обработчики остановлены.")
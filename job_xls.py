@@ -1,103 +1,586 @@
 import os
-import shutil
 import openpyxl
+import openpyxl.styles
+from openpyxl.styles import Font, PatternFill, Border, Side, Alignment
+from openpyxl.styles.colors import Color
+from openpyxl.formatting.rule import DataBarRule
+from openpyxl.worksheet.table import Table, TableStyleInfo
+from openpyxl.packaging.custom import IntProperty
 import datetime
 import asyncio
+from collections import OrderedDict
 
+import job_io
+import job_lock
+import job_pool
+import job_metrics
+import job_formula
+import job_aggregates
 
-def create_xls(user_id):
+# Сколько книг Excel одновременно держится в памяти (самые давно не использованные вытесняются)
+CACHE_SIZE = int(os.getenv('XLS_CACHE_SIZE', 64))
+# Через сколько секунд после первого изменения книга сохраняется на диск
+FLUSH_DELAY = float(os.getenv('XLS_FLUSH_DELAY', 5))
+
+# Строки категорий в таблице
+CATEGORY_ROWS = {
+    "Зп на руки": '3', "Зп на карточку": '4', "Шабашки": '5', "Другие": '6',
+    "Жилье": '13', "Коммуналка": '14',
+    "Еда": '15', "Проезд": '16',
+    "Интернет": '17', "Сотовая связь": '18',
+    "Одежда": '19', "Медикаменты": '20',
+    "Процент кредита": '21', "Хоз расходы": '22',
+    "Техника": '23', "Парикмахерская": '24',
+    "Развлечения": '25', "Обучение": '26',
+    "Подарки": '27', "Прочие": '28'
+}
+# Подписи категорий в столбце B
+CATEGORY_LABELS = {
+    "Зп на руки": 'Зарплата на руки', "Зп на карточку": 'Зарплата на карточку', "Шабашки": 'Шабашки',
+    "Другие": 'Другие', "Жилье": 'Жилье', "Коммуналка": 'Коммунальные услуги', "Еда": 'Еда', "Проезд": 'Проезд',
+    "Интернет": 'Интернет', "Сотовая связь": 'Сотовая связь', "Одежда": 'Одежда', "Медикаменты": 'Медикаменты',
+    "Процент кредита": 'Проценты по кредитам', "Хоз расходы": 'Хозяйственные расходы', "Техника": 'Покупка техники',
+    "Парикмахерская": 'Парикмахерская', "Развлечения": 'Развлечения и отдых', "Обучение": 'Обучение',
+    "Подарки": 'Подарки и дни рождения', "Прочие": 'Прочие'
+}
+# Столбцы месяцев в таблице (год в таблице начинается с августа)
+MONTH_COLUMNS = {
+    1: 'H', 2: 'I', 3: 'J', 4: 'K',
+    5: 'L', 6: 'M', 7: 'N', 8: 'C',
+    9: 'D', 10: 'E', 11: 'F', 12: 'G'
+}
+
+# Лист сводки за текущий месяц (как в прежнем шаблоне); листы лет стоят перед ним
+SUMMARY_SHEET = 'Сводка'
+
+# Оформление листа года из прежнего шаблона: шрифты, заливки и рамки блоков доходов, расходов и остатка
+_DATA_FONT = Font(name='Century Gothic', size=11)
+_HEADER_FONT = Font(name='Arial Cyr', size=10, bold=True)
+_CENTER = Alignment(horizontal='center')
+_THIN, _MEDIUM, _THICK = Side(style='thin'), Side(style='medium'), Side(style='thick')
+# Блоки листа: (строка заголовка, первая строка, последняя строка, строка итога,
+# заливка подписей и итогов, заливка заголовков месяцев, заливка сумм)
+_SECTIONS = (
+    (2, 3, 6, 8, '0000FF00', '00FFCC00', '00FFFF99'),
+    (12, 13, 28, 30, '00FF99CC', '0000FFFF', '00CCFFFF'),
+)
+_BALANCE_FILLS = ('00FF9900', '00FFFF99')
+_LABEL_FILL = '00CCFFCC'
+
+
+def _fill(color):
+    return PatternFill(fill_type='solid', fgColor=color)
+
+
+# Кэш открытых книг: id пользователя -> workbook, порядок соответствует давности использования
+_workbooks = OrderedDict()
+# Пользователи, у которых книга в памяти изменена, но еще не сохранена: id -> запланированная задача сохранения
+_dirty = {}
+# Загрузки книг, которые выполняются прямо сейчас (чтобы одну книгу не прочитать дважды)
+_loading = {}
+# Книги, которые сейчас сохраняются перед вытеснением из кэша
+_evicting = set()
+# Номер последней записи журнала намерений (job_wal), учтенной в сохраненной на диск книге: id -> номер
+_saved_seqs = {}
+# Графы формул книг из кэша: id пользователя -> {название листа: job_formula.SheetFormulas}
+_formulas = {}
+
+# Свойство книги, в котором хранится номер последней учтенной записи журнала намерений
+WAL_PROPERTY = 'wal_seq'
+
+
+def _get_wal_seq(workbook):
+    properties = workbook.custom_doc_props
+    return properties[WAL_PROPERTY].value if WAL_PROPERTY in properties.names else 0
+
+
+def _set_wal_seq(workbook, seq):
+    # Сохраняется наибольший из учтенных номеров: номер книги не уменьшается
+    properties = workbook.custom_doc_props
+    if WAL_PROPERTY in properties.names:
+        seq = max(seq, properties[WAL_PROPERTY].value)
+        del properties[WAL_PROPERTY]
+    properties.append(IntProperty(name=WAL_PROPERTY, value=seq))
+
+
+def _save_atomic(workbook, file_path):
+    # Книга пишется во временный файл, который затем подменяет основной
+    tmp_path = f'{file_path}.tmp'
+    workbook.save(tmp_path)
+    os.replace(tmp_path, file_path)
+
+
+def _style(cell, font, color, border, alignment=None):
+    cell.font = font
+    cell.fill = _fill(color)
+    cell.border = border
+    if alignment is not None:
+        cell.alignment = alignment
+
+
+def _fill_sheet(sheet, sums):
     """
-    Функция для создания Excel файла для пользователя
-    :param user_id: ID пользователя, для которого создается Excel-файл
+    Функция для разметки и заполнения листа года
+    :param sheet: Пустой лист openpyxl
+    :param sums: Суммы за год в формате {номер месяца: {категория: сумма}}
 
-    :type user_id: int
+    :return: Лист получает ту же разметку и оформление, что и прежний шаблон 'Простой бюджет на месяц1.xlsx'
+    (строки категорий CATEGORY_ROWS, столбцы месяцев MONTH_COLUMNS, итоги в строках 8, 30 и 34, столбцы P-R
+    со средними, заливки и рамки блоков).
+    """
+    for column, width in (('A', 8.8), ('B', 25.1), ('P', 9.6), ('Q', 13.2), ('R', 13.2)):
+        sheet.column_dimensions[column].width = width
+    for column in MONTH_COLUMNS.values():
+        sheet.column_dimensions[column].width = 11.4
+    sheet.sheet_properties.tabColor = Color(theme=6, tint=-0.25)
+    month_cells = [(column, True) for column in 'CDEFGHIJKLMN'] + [(column, False) for column in 'PQR']
 
-    :return: Функция создает папку для пользователя (если она еще не существует), копирует шаблон Excel-файла
-    в эту папку и называет его по ID пользователя.
+    for header_row, first, last, total_row, label_color, header_color, data_color in _SECTIONS:
+        header_border = Border(left=_THICK, right=_THICK, top=_THICK, bottom=_MEDIUM)
+        sheet[f'B{header_row}'] = 'Доходы' if header_row == 2 else 'Расходы'
+        _style(sheet[f'B{header_row}'], _HEADER_FONT, label_color, header_border, _CENTER)
+        for month, column in MONTH_COLUMNS.items():
+            sheet[f'{column}{header_row}'] = job_aggregates.MONTH_NAMES[month]
+        for column, is_month in month_cells:
+            _style(sheet[f'{column}{header_row}'], _HEADER_FONT, header_color if is_month else label_color,
+                   Border(left=_MEDIUM, right=_MEDIUM, top=_THICK, bottom=_MEDIUM) if is_month else header_border,
+                   _CENTER)
+        for column, title_total in zip('PQR', ('Всего', 'Среднее (мес)', 'Среднее (год)')):
+            sheet[f'{column}{header_row}'] = title_total
 
-    Логика работы:
-    1. Определяется папка назначения на основе ID пользователя. Путь файла назначения — это комбинация папки пользователя
-    и его ID.
-    2. Если папка для пользователя не существует, она создается с помощью `os.makedirs()`.
-    3. Шаблонный Excel-файл копируется в папку пользователя под его ID с помощью функции `shutil.copy2()`.
-    4. После успешного копирования выводится сообщение о том, что папка создана и файл скопирован.
+        for row in range(first, last + 1):
+            side_border = Border(left=_THICK, right=_THICK, top=_MEDIUM if row == first else _THIN, bottom=_THIN)
+            _style(sheet[f'B{row}'], _DATA_FONT, _LABEL_FILL, side_border)
+            for column, is_month in month_cells:
+                _style(sheet[f'{column}{row}'], _DATA_FONT, data_color if is_month else _LABEL_FILL,
+                       Border(left=_THIN, right=_THIN, top=side_border.top, bottom=_THIN) if is_month
+                       else side_border)
 
-    Используемые методы:
-    - `os.path.exists()`: Проверяет наличие папки пользователя.
-    - `os.makedirs()`: Создает новую папку для пользователя, если она не существует.
-    - `shutil.copy2()`: Копирует исходный файл в папку назначения, сохраняя метаданные файла.
+        total_border = Border(left=_MEDIUM, right=_MEDIUM, top=_MEDIUM, bottom=_MEDIUM)
+        sheet[f'B{total_row}'] = 'Итого'
+        _style(sheet[f'B{total_row}'], _HEADER_FONT, label_color, total_border, _CENTER)
+        for column, is_month in month_cells:
+            if is_month:
+                sheet[f'{column}{total_row}'] = f'=SUM({column}{first}:{column}{last})'
+                _style(sheet[f'{column}{total_row}'], _DATA_FONT, data_color if header_row == 2 else '00CCFFFF',
+                       total_border)
+            else:
+                _style(sheet[f'{column}{total_row}'], _HEADER_FONT, label_color, total_border, _CENTER)
+
+    sheet['B34'] = 'Остаток'
+    balance_border = Border(left=_MEDIUM, right=_MEDIUM, top=_MEDIUM, bottom=_MEDIUM)
+    _style(sheet['B34'], _HEADER_FONT, _BALANCE_FILLS[0], balance_border, _CENTER)
+    for column, is_month in month_cells:
+        if is_month:
+            sheet[f'{column}34'] = f'={column}8-{column}30'
+            _style(sheet[f'{column}34'], _DATA_FONT, _BALANCE_FILLS[1], balance_border)
+        else:
+            _style(sheet[f'{column}34'], _HEADER_FONT, _BALANCE_FILLS[0], balance_border, _CENTER)
+
+    for category, row in CATEGORY_ROWS.items():
+        sheet[f'B{row}'] = CATEGORY_LABELS[category]
+        for month, column in MONTH_COLUMNS.items():
+            sheet[f'{column}{row}'] = sums.get(month, {}).get(category, 0)
+
+    for row in [int(row) for row in CATEGORY_ROWS.values()] + [8, 30, 34]:
+        sheet[f'P{row}'] = f'=SUM(C{row}:N{row})'
+        sheet[f'Q{row}'] = f'=ROUND(AVERAGE(C{row}:N{row}),0)'
+        sheet[f'R{row}'] = f'=ROUND(P{row}/12,0)'
+
+
+def _fill_summary(sheet):
+    """
+    Функция для разметки листа 'Сводка' (доходы, расходы и баланс за текущий месяц, как в прежнем шаблоне)
+    :param sheet: Пустой лист openpyxl
+
+    :return: Суммы берутся формулами из строк 8 и 30 листа текущего года (INDIRECT по YEAR(TODAY())), поэтому
+    лист не нужно обновлять при операциях и при смене года. Столбец месяца вычисляется по MONTH(TODAY())
+    с учетом того, что год в таблице начинается с августа (MONTH_COLUMNS).
 
     Примечание:
-    - Шаблонный файл Excel называется 'Простой бюджет на месяц1.xlsx' и должен находиться в той же директории, откуда запускается скрипт.
-    - Путь для папки пользователя создается в формате "user_files/{user_id}/", а сам Excel-файл сохраняется под именем "{user_id}.xlsx".
+    - В шаблоне суммы искались по названию месяца TEXT(TODAY(), "ММММ"), которое зависит от языка Excel,
+    а формулы ссылались на лист '2024'. Здесь месяц определяется по номеру, а лист — по текущему году.
+    """
+    title_color, accent_color = Color(theme=3), Color(theme=4, tint=-0.5)
+    money_format = '#,##0\\ "₽"'
+    sheet.sheet_view.showGridLines = False
+    sheet.sheet_properties.tabColor = Color(theme=2, tint=-0.5)
+    for column, width in (('A', 2.6), ('B', 32.6), ('C', 34.0), ('D', 16.3), ('E', 12.6), ('F', 2.6)):
+        sheet.column_dimensions[column].width = width
+    for row, height in ((1, 45.0), (2, 30.0), (3, 42.0), (4, 39.9), (5, 20.1), (6, 21.0)):
+        sheet.row_dimensions[row].height = height
+
+    sheet['B1'] = 'ПРОСТОЙ БЮДЖЕТ НА МЕСЯЦ'
+    sheet['B1'].font = Font(name='Century Gothic', size=25, color=title_color)
+    sheet['B2'] = 'СООТНОШЕНИЕ РАСХОДОВ И ДОХОДОВ'
+    sheet['B4'] = 'СВОДКА'
+    for address in ('B2', 'B4'):
+        sheet[address].font = Font(name='Century Gothic', size=14, color=title_color)
+
+    # Полоса расходов относительно доходов и их соотношение в процентах
+    sheet.merge_cells('B3:D3')
+    sheet['B3'] = '=C6'
+    sheet['B3'].number_format = money_format
+    sheet['B3'].alignment = Alignment(vertical='center', wrap_text=True)
+    sheet.conditional_formatting.add('B3:D3', DataBarRule(start_type='num', start_value=0, end_type='num',
+                                                          end_value='$B$6', color='00C55A11', showValue=False))
+    sheet['E3'] = '=IF(B6=0,0,C6/B6)'
+    sheet['E3'].number_format = '0%'
+    sheet['E3'].font = Font(name='Century Gothic', size=22, color=accent_color)
+    sheet['E3'].alignment = Alignment(horizontal='right', vertical='center')
+
+    month_offset = 'MOD(MONTH(TODAY())+4,12)+1'
+    for column, title, formula in (
+            ('B', 'Итоговые доходы за месяц',
+             f'=INDEX(INDIRECT("\'"&YEAR(TODAY())&"\'!C8:N8"),1,{month_offset})'),
+            ('C', 'Итоговые расходы за месяц',
+             f'=INDEX(INDIRECT("\'"&YEAR(TODAY())&"\'!C30:N30"),1,{month_offset})'),
+            ('D', 'Баланс', '=B6-C6')):
+        sheet[f'{column}5'] = title
+        sheet[f'{column}5'].font = Font(name='Georgia', size=11, color=accent_color)
+        sheet[f'{column}5'].alignment = Alignment(horizontal='left', vertical='center')
+        sheet[f'{column}6'] = formula
+        sheet[f'{column}6'].font = Font(name='Century Gothic', size=16, color=title_color)
+        sheet[f'{column}6'].number_format = money_format
+        sheet[f'{column}6'].alignment = Alignment(horizontal='left', vertical='top')
+    table = Table(displayName='Сводка', ref='B5:D6')
+    table.tableStyleInfo = TableStyleInfo(name='TableStyleLight9', showRowStripes=False)
+    sheet.add_table(table)
+
+
+def build_workbook(file_path, sums_by_year, wal_seq=0):
+    """
+    Функция для сборки Excel-таблицы пользователя без файла-шаблона
+    :param file_path: Путь, по которому сохраняется книга
+    :param sums_by_year: Суммы в формате {год: {номер месяца: {категория: сумма}}}
+    :param wal_seq: Номер последней записи журнала намерений, учтенной в суммах
+
+    :type file_path: str
+    :type sums_by_year: dict
+    :type wal_seq: int
+
+    :return: Функция создает книгу с листом на каждый год (название листа — год, см. `sheet_name_for()`),
+    заполняет листы `_fill_sheet()`, добавляет после них лист SUMMARY_SHEET (`_fill_summary()`) и сохраняет книгу.
+    Активным остается лист последнего года.
+
+    Примечание:
+    - Функция блокирующая и вызывается в пуле процессов через `job_pool.run_in_process()`.
+    - Книга сначала пишется во временный файл, который затем подменяет основной, поэтому недописанный файл
+    никогда не окажется на месте таблицы.
+    """
+    workbook = openpyxl.Workbook()
+    workbook.remove(workbook.active)
+    for year in sorted(sums_by_year):
+        _fill_sheet(workbook.create_sheet(sheet_name_for(year)), sums_by_year[year])
+    _fill_summary(workbook.create_sheet(SUMMARY_SHEET))
+    workbook.active = len(workbook.sheetnames) - 2
+    _set_wal_seq(workbook, wal_seq)
+    _save_atomic(workbook, file_path)
+
+
+def sheet_name_for(year=None):
+    """
+    Функция для получения названия листа года
+    :param year: Год (по умолчанию — текущий)
+
+    :return: Название листа, например '2025'. Лист '2024' из прежних таблиц совпадает с листом 2024 года.
+    """
+    return str(year or datetime.datetime.now().year)
+
+
+async def _year_sheet(user_id, workbook, year):
+    """
+    Функция для получения листа года с автоматическим созданием нового листа (под блокировкой 'xls')
+    :return: Лист openpyxl. Если листа еще нет (наступил новый год или импортирована выписка за прошлый год),
+    он добавляется в книгу, размечается и заполняется месячными суммами этого года из `job_aggregates`.
+    Лист текущего года становится активным.
+
+    Примечание:
+    - Лист заполняется из сумм, поэтому его нужно создавать до того, как операция попадет в суммы, иначе
+    она будет учтена в листе дважды. data_validator() и record_many() вызывают функцию заранее.
+    """
+    sheet_name = sheet_name_for(year)
+    if sheet_name in workbook.sheetnames:
+        return workbook[sheet_name]
+    # Листы лет идут по порядку: новый лист встает перед первым листом более позднего года или листом сводки
+    position = len(workbook.sheetnames)
+    for index, name in enumerate(workbook.sheetnames):
+        if not name.isdigit() or int(name) > int(sheet_name):
+            position = index
+            break
+    sheet = workbook.create_sheet(sheet_name, position)
+    _fill_sheet(sheet, await job_aggregates.year_summary(user_id, int(sheet_name)))
+    if sheet_name == sheet_name_for():
+        workbook.active = workbook.sheetnames.index(sheet_name)
+    _mark_dirty(user_id)
+    return sheet
+
+
+def _xls_path(user_id):
+    return f'user_files/{user_id}/{user_id}.xlsx'
+
+
+def _is_materialized(user_id):
+    return str(user_id) in _workbooks or os.path.exists(_xls_path(user_id))
+
+
+async def ensure_xls(user_id):
+    """
+    Функция для получения пути к Excel-таблице пользователя, которая создается только по запросу
+    :param user_id: ID пользователя
+
+    :type user_id: int
+
+    :return: Путь к файлу таблицы. Если таблицы еще нет, она собирается в пуле процессов функцией
+    `build_workbook()` по месячным суммам из `job_aggregates`: по листу на каждый год с операциями и на текущий год.
+    Пока пользователь не запросил таблицу, операции учитываются только в журнале и месячных суммах, и файл
+    на диске не создается.
+    """
+    file_path = _xls_path(user_id)
+    async with job_lock.user_lock(user_id, 'xls'):
+        if not _is_materialized(user_id):
+            years = set(await job_aggregates.years(user_id)) | {datetime.datetime.now().year}
+            sums = {year: await job_aggregates.year_summary(user_id, year) for year in years}
+            wal_seq = await job_aggregates.applied_seq(user_id)
+            await job_pool.run_in_process(build_workbook, file_path, sums, wal_seq)
+            _saved_seqs[str(user_id)] = wal_seq
+    return file_path
+
+
+async def _get_workbook(user_id):
+    """
+    Функция для получения книги пользователя из кэша
+    :param user_id: ID пользователя
+
+    :type user_id: int
+
+    :return: Объект workbook. При промахе книга загружается с диска в пуле `job_io.xls_executor`, а самая давно
+    не использованная книга вытесняется из кэша (с сохранением, если в ней есть несохраненные изменения).
+    Если очередь пула заполнена, выбрасывается `job_io.BusyError`.
+    """
+    key = str(user_id)
+    if key in _workbooks:
+        _workbooks.move_to_end(key)
+        return _workbooks[key]
+
+    if key not in _loading:
+        _loading[key] = asyncio.ensure_future(job_io.xls_executor.run(openpyxl.load_workbook, _xls_path(user_id)))
+    try:
+        workbook = await _loading[key]
+    finally:
+        _loading.pop(key, None)
+
+    if key not in _workbooks:
+        _workbooks[key] = workbook
+        _saved_seqs[key] = _get_wal_seq(workbook)
+        job_metrics.add_bytes('job_xls', 'read', os.path.getsize(_xls_path(user_id)))
+        # Вытеснение идет фоновыми задачами: каждая ждет блокировку своего пользователя, а не текущего
+        for evicted_key in list(_workbooks):
+            if len(_workbooks) - len(_evicting) <= CACHE_SIZE:
+                break
+            if evicted_key != key and evicted_key not in _evicting:
+                _evicting.add(evicted_key)
+                asyncio.ensure_future(_evict(evicted_key))
+    return workbook
+
+
+async def _evict(key):
+    try:
+        async with job_lock.user_lock(key, 'xls'):
+            await _save(key)
+            _workbooks.pop(key, None)
+            _formulas.pop(key, None)
+    finally:
+        _evicting.discard(key)
+
+
+def _mark_dirty(user_id):
+    """
+    Функция помечает книгу пользователя измененной и, если сохранение еще не запланировано, планирует его
+    через FLUSH_DELAY секунд. Все изменения, сделанные за это время, сохраняются одной записью.
+    """
+    key = str(user_id)
+    if key not in _dirty:
+        _dirty[key] = asyncio.ensure_future(_delayed_flush(key))
+
+
+async def _delayed_flush(key):
+    await asyncio.sleep(FLUSH_DELAY)
+    await flush_user(key)
+
+
+async def flush_user(user_id):
+    """
+    Функция для немедленного сохранения книги пользователя, если в ней есть несохраненные изменения
+    :param user_id: ID пользователя
+
+    :type user_id: int
+
+    :return: Книга записывается на диск в пуле `job_io.xls_executor` под блокировкой пользователя, поэтому сохранение
+    не пересекается с изменениями ячеек. Вызывается перед отправкой файла пользователю и при остановке бота.
+    """
+    key = str(user_id)
+    if key not in _dirty:
+        return
+    async with job_lock.user_lock(key, 'xls'):
+        await _save(key)
+
+
+async def _save(key):
+    # Вызывается только под блокировкой job_lock.user_lock(key, 'xls')
+    task = _dirty.pop(key, None)
+    if task is None:
+        return
+    if task is not asyncio.current_task():
+        task.cancel()
+    workbook = _workbooks.get(key)
+    if workbook is not None:
+        seq = _get_wal_seq(workbook)
+        # Сохранение не отклоняется даже при заполненной очереди, иначе изменения были бы потеряны
+        await job_io.xls_executor.run(_save_atomic, workbook, _xls_path(key), reject=False)
+        _saved_seqs[key] = seq
+        job_metrics.add_bytes('job_xls', 'write', os.path.getsize(_xls_path(key)))
+
+
+async def flush_all():
+    """
+    Функция для сохранения всех измененных книг (вызывается при остановке бота)
+    """
+    for key in list(_dirty):
+        await flush_user(key)
+
+
+def drop_user(user_id):
+    """
+    Функция для удаления книги пользователя из кэша без сохранения (используется при сбросе данных)
+    :param user_id: ID пользователя
+
+    :type user_id: int
+    """
+    key = str(user_id)
+    task = _dirty.pop(key, None)
+    if task is not None:
+        task.cancel()
+    _workbooks.pop(key, None)
+    _saved_seqs.pop(key, None)
+    _formulas.pop(key, None)
+
+
+def is_materialized(user_id):
+    """
+    Функция для проверки, создана ли уже Excel-таблица пользователя (в кэше или на диске)
     """
+    return _is_materialized(user_id)
 
-    source = 'Простой бюджет на месяц1.xlsx'
-    destination_folder = f"user_files/{user_id}/"
-    destination = f"{destination_folder}/{user_id}.xlsx"
 
-    # Создание папки, если она не существует
-    if not os.path.exists(destination_folder):
-        os.makedirs(destination_folder)
+def saved_seq(user_id):
+    """
+    Функция для получения номера последней записи журнала намерений, учтенной в книге на диске
+    :return: Номер записи или None, если он неизвестен (книга еще не загружалась в этом процессе)
+    """
+    return _saved_seqs.get(str(user_id))
+
+
+async def preload(user_id):
+    """
+    Функция для заблаговременной загрузки книги пользователя в кэш, если таблица уже создана
+    :return: Если пул Excel занят, выбрасывается `job_io.BusyError` — до того, как операция записана куда-либо.
+    """
+    if _is_materialized(user_id):
+        await _get_workbook(user_id)
+
+
+def _sheet_formulas(user_id, workbook, sheet_name):
+    """
+    Функция для получения графа формул листа
+    :return: `job_formula.SheetFormulas`; строится при первом обращении к формуле листа и живет, пока книга в кэше
+    """
+    sheets = _formulas.setdefault(str(user_id), {})
+    if sheet_name not in sheets:
+        sheets[sheet_name] = job_formula.SheetFormulas(workbook[sheet_name])
+    return sheets[sheet_name]
+
 
-    shutil.copy2(source, destination)
-    print('Папка создана и файл скопирован')
+def _recalculate(user_id, sheet_name, addresses):
+    # Пересчитываются только формулы, зависящие от измененных ячеек; если граф еще не построен, пересчитывать нечего
+    formulas = _formulas.get(str(user_id), {}).get(sheet_name)
+    if formulas is not None:
+        formulas.update(addresses)
 
 
-async def get_cell_value(cell_address, user_id, sheet_name='2024'):
+async def get_cell_value(cell_address, user_id, sheet_name=None):
     """
     Асинхронная функция для получения значения из ячейки Excel-файла
     :param cell_address: Адрес ячейки, из которой нужно получить значение (например, 'A1')
     :param user_id: ID пользователя, для которого ищется файл Excel
-    :param sheet_name: Имя листа Excel, с которого нужно получить значение (по умолчанию используется лист '2024')
+    :param sheet_name: Имя листа Excel, с которого нужно получить значение (по умолчанию — лист текущего года)
 
     :type cell_address: str
     :type user_id: int
     :type sheet_name: str
 
-    :return: Возвращает значение ячейки и объект workbook, представляющий Excel-файл.
+    :return: Возвращает значение ячейки и объект workbook, представляющий Excel-файл. Для ячейки с формулой
+    (итоги в строках 8, 30, 34 и столбцах P-R) возвращается ее вычисленное значение из графа формул `job_formula`,
+    а не текст формулы.
 
     Логика работы:
     1. Определяется путь к файлу Excel на основе ID пользователя. Файл должен находиться в папке "user_files/{user_id}/"
     и называться "{user_id}.xlsx".
-    2. Асинхронно открывается файл Excel с помощью `openpyxl.load_workbook()` через вызов `asyncio.to_thread()`, чтобы не блокировать основной поток.
-    3. Из загруженной книги выбирается лист по имени, указанному в параметре `sheet_name` (по умолчанию — '2024').
+    2. Книга берется из кэша `_workbooks`. При первом обращении файл Excel открывается с помощью `openpyxl.load_workbook()`
+    в пуле `job_io.xls_executor`, чтобы не блокировать основной поток, и остается в кэше для следующих запросов.
+    3. Из загруженной книги выбирается лист по имени, указанному в параметре `sheet_name` (по умолчанию — лист
+    текущего года). Если листа года еще нет, он создается `_year_sheet()`.
     4. Из выбранного листа извлекается значение указанной ячейки с помощью `sheet[cell_address].value`.
     5. Возвращается кортеж, содержащий значение ячейки и объект workbook.
 
     Используемые методы:
-    - `asyncio.to_thread()`: Выполняет блокирующие операции (например, чтение файла) в отдельном потоке.
+    - `job_io.xls_executor.run()`: Выполняет блокирующие операции (например, чтение файла) в отдельном пуле потоков.
     - `openpyxl.load_workbook()`: Загружает книгу Excel для работы с ней.
     - `sheet[cell_address].value`: Извлекает значение указанной ячейки из листа.
 
     Примечание:
-    - Если лист с именем, указанным в `sheet_name`, не существует, будет выброшено исключение.
+    - Если лист с именем, указанным в `sheet_name`, не существует и не является годом, будет выброшено исключение.
     - Убедитесь, что файл Excel существует в указанной папке и имеет правильный формат.
     """
 
-    file_path = f'user_files/{user_id}/{user_id}.xlsx'
-    # Открываем файл Excel асинхронно
-    workbook = await asyncio.to_thread(openpyxl.load_workbook, file_path)
+    # Берем книгу из кэша (с диска она читается только при первом обращении)
+    workbook = await _get_workbook(user_id)
 
-    # Выбираем лист по имени
-    sheet = workbook[sheet_name]
+    # Выбираем лист по имени (лист нового года создается при первом обращении)
+    sheet_name = sheet_name or sheet_name_for()
+    if sheet_name.isdigit():
+        sheet = await _year_sheet(user_id, workbook, int(sheet_name))
+    else:
+        sheet = workbook[sheet_name]
 
-    # Получаем значение ячейки
+    # Получаем значение ячейки (для формулы — вычисленное значение из кэша)
     cell_value = sheet[cell_address].value
+    if isinstance(cell_value, str) and cell_value.startswith('='):
+        cell_value = _sheet_formulas(user_id, workbook, sheet_name).value(cell_address)
 
     return cell_value, workbook
 
 
-async def add_value_to_cell(cell_address, value_to_add, user_id, sheet_name='2024'):
-    file_path = f'user_files/{user_id}/{user_id}.xlsx'
+async def add_value_to_cell(cell_address, value_to_add, user_id, sheet_name=None):
     """
     Функция для добавления значения к ячейке и сохранения изменений в файл.
 
     :param user_id: Имя файла которое схоже с id пользователя
-    :param sheet_name: Название листа
+    :param sheet_name: Название листа (по умолчанию — лист текущего года)
     :param cell_address: Адрес ячейки в формате A1, B2 и т.д.
     :param value_to_add: Значение, которое нужно прибавить к существующему значению ячейки
+
+    Изменение вносится в книгу из кэша, а на диск она сохраняется фоновой задачей через FLUSH_DELAY секунд
+    (или раньше — при вытеснении из кэша, вызове flush_user() и остановке бота).
     """
+    # Изменения одного пользователя выполняются строго по очереди
+    async with job_lock.user_lock(user_id, 'xls'):
+        await _add_value_unlocked(cell_address, value_to_add, user_id, sheet_name)
+
+
+async def _add_value_unlocked(cell_address, value_to_add, user_id, sheet_name=None):
+    # Вызывается только под блокировкой job_lock.user_lock(user_id, 'xls')
+    sheet_name = sheet_name or sheet_name_for()
     # Получаем текущее значение ячейки и объект workbook
     cell_value, workbook = await get_cell_value(cell_address, user_id, sheet_name)
 
@@ -111,28 +594,160 @@ async def add_value_to_cell(cell_address, value_to_add, user_id, sheet_name='202
     # Обновляем значение в ячейке
     sheet = workbook[sheet_name]
     sheet[cell_address].value = new_value
+    # Пересчитываем зависящие от ячейки итоги (итог месяца, остаток, столбцы P-R)
+    _recalculate(user_id, sheet_name, [cell_address])
+
+    # Сохранение откладывается: несколько изменений подряд попадут на диск одной записью
+    _mark_dirty(user_id)
+
+
+async def month_totals(user_id, year=None, month=None):
+    """
+    Функция для получения итогов месяца из таблицы пользователя
+    :param user_id: ID пользователя
+    :param year: Год (по умолчанию — текущий)
+    :param month: Номер месяца 1-12 (по умолчанию — текущий)
+
+    :type user_id: int
+    :type year: int
+    :type month: int
+
+    :return: Кортеж (доходы, расходы, остаток) — значения итоговых строк 8, 30 и 34 в столбце месяца.
+
+    Логика работы:
+    1. Если таблица создана, итоги читаются из книги в кэше через `get_cell_value()`: формулы итогов вычисляются
+    графом `job_formula` (он строится при первом чтении и дальше пересчитывается инкрементально при каждой операции),
+    поэтому значения актуальны без сохранения и повторного открытия файла.
+    2. Если таблицы еще нет или пул Excel занят (`job_io.BusyError`), итоги берутся из месячных сумм `job_aggregates`.
+    """
+    now = datetime.datetime.now()
+    year, month = year or now.year, month or now.month
+    if _is_materialized(user_id):
+        column = MONTH_COLUMNS[month]
+        try:
+            async with job_lock.user_lock(user_id, 'xls'):
+                values = [(await get_cell_value(f'{column}{row}', user_id, sheet_name_for(year)))[0]
+                          for row in (8, 30, 34)]
+            return tuple(value or 0 for value in values)
+        except job_io.BusyError:
+            pass
+    income, expense = await job_aggregates.month_totals(user_id, year, month)
+    return income, expense, income - expense
+
+
+async def record_many(user_id, items, seq=None):
+    """
+    Функция для пакетного учета операций (используется при импорте выписок)
+    :param user_id: ID пользователя
+    :param items: Список кортежей (дата, категория, сумма)
+    :param seq: Номер записи журнала намерений (job_wal), которой соответствует пачка
+
+    :type user_id: int
+    :type items: list
+    :type seq: int
 
-    # Сохраняем изменения в файл асинхронно
-    await asyncio.to_thread(workbook.save, file_path)
-
-
-async def data_validator(user_id, button_type, amount):
-    month = datetime.datetime.now().month
-    buttons = {
-        "Зп на руки": '3', "Зп на карточку": '4', "Шабашки": '5', "Другие": '6',
-        "Жилье": '13', "Коммуналка": '14',
-        "Еда": '15', "Проезд": '16',
-        "Интернет": '17', "Сотовая связь": '18',
-        "Одежда": '19', "Медикаменты": '20',
-        "Процент кредита": '21', "Хоз расходы": '22',
-        "Техника": '23', "Парикмахерская": '24',
-        "Развлечения": '25', "Обучение": '26',
-        "Подарки": '27', "Прочие": '28'
-    }
-    month_id = {
-        1: 'H', 2: 'I', 3: 'J', 4: 'K',
-        5: 'L', 6: 'M', 7: 'N', 8: 'C',
-        9: 'D', 10: 'E', 11: 'F', 12: 'G'
-    }
-    await add_value_to_cell(cell_address=f'{month_id[month]}{buttons[button_type]}', value_to_add=amount,
-                            user_id=user_id)
+    :return: Месячные суммы обновляются одной записью. Если таблица пользователя уже создана, суммы операций
+    группируются по листам лет и ячейкам, книга загружается (или берется из кэша) один раз, все ячейки
+    обновляются и книга сразу сохраняется одной записью.
+    """
+    cells = {}
+    for date, category, amount in items:
+        year_cells = cells.setdefault(date.year, {})
+        cell_address = f'{MONTH_COLUMNS[date.month]}{CATEGORY_ROWS[category]}'
+        year_cells[cell_address] = year_cells.get(cell_address, 0) + amount
+
+    async with job_lock.user_lock(user_id, 'xls'):
+        # Книга загружается до изменения сумм: если пул занят, ничего не будет изменено
+        workbook = await _get_workbook(user_id) if _is_materialized(user_id) else None
+        if workbook is not None:
+            # Недостающие листы лет создаются до изменения сумм, чтобы операции пачки не попали в них дважды
+            for year in cells:
+                await _year_sheet(user_id, workbook, year)
+        await job_aggregates.add_many(user_id, items, seq=seq)
+        if workbook is not None:
+            for year, year_cells in cells.items():
+                sheet = workbook[sheet_name_for(year)]
+                for cell_address, value_to_add in year_cells.items():
+                    sheet[cell_address].value = (sheet[cell_address].value or 0) + value_to_add
+                _recalculate(user_id, sheet.title, year_cells)
+            if seq is not None:
+                _set_wal_seq(workbook, seq)
+            _mark_dirty(user_id)
+            await _save(str(user_id))
+
+
+async def data_validator(user_id, button_type, amount, seq=None, date=None):
+    """
+    Функция для учета операции в Excel-таблице пользователя
+    :param user_id: ID пользователя
+    :param button_type: Категория дохода или расхода (текст нажатой кнопки)
+    :param amount: Сумма операции
+    :param seq: Номер записи журнала намерений (job_wal), которой соответствует операция
+    :param date: Дата операции (по умолчанию — текущая)
+
+    :type user_id: int
+    :type button_type: str
+    :type amount: int
+    :type seq: int
+    :type date: datetime.datetime
+
+    :return: Месячные суммы в job_aggregates обновляются инкрементально, чтобы итоги за месяц можно было получить
+    без открытия книги. Если таблица пользователя уже создана, сумма прибавляется и к ячейке категории в столбце
+    месяца операции на листе года операции (первая операция нового года создает его лист); иначе таблица будет
+    собрана из месячных сумм при первом запросе (см. `ensure_xls()`). Номер seq сохраняется и в суммах, и в книге,
+    поэтому при восстановлении после сбоя видно, до какой записи журнала намерений дошел каждый из них.
+    """
+    date = date or datetime.datetime.now()
+    async with job_lock.user_lock(user_id, 'xls'):
+        materialized = _is_materialized(user_id)
+        if materialized:
+            # Книга загружается до изменения сумм: если пул занят (job_io.BusyError), операция не учитывается нигде.
+            # Лист года создается тоже до изменения сумм, иначе операция попала бы в него дважды.
+            await _year_sheet(user_id, await _get_workbook(user_id), date.year)
+        await job_aggregates.add(user_id, button_type, amount, date, seq=seq)
+        if materialized:
+            await _add_value_unlocked(cell_address=f'{MONTH_COLUMNS[date.month]}{CATEGORY_ROWS[button_type]}',
+                                      value_to_add=amount, user_id=user_id, sheet_name=sheet_name_for(date.year))
+            if seq is not None:
+                _set_wal_seq(await _get_workbook(user_id), seq)
+                _mark_dirty(user_id)
+
+
+async def replay(user_id, items):
+    """
+    Функция для восстановления книги по записям журнала намерений после сбоя
+    :param user_id: ID пользователя
+    :param items: Список кортежей (номер записи, дата, категория, сумма)
+
+    :type user_id: int
+    :type items: list
+
+    :return: Если таблица создана, в нее добавляются только записи с номером больше сохраненного в книге
+    (остальные уже учтены), после чего книга сразу сохраняется. Возвращает количество добавленных записей.
+
+    Примечание:
+    - Суммы job_aggregates к этому моменту уже доприменены, поэтому лист года, созданный во время восстановления,
+    уже содержит операции этого года, и они к нему повторно не прибавляются.
+    """
+    async with job_lock.user_lock(user_id, 'xls'):
+        if not _is_materialized(user_id):
+            return 0
+        workbook = await _get_workbook(user_id)
+        applied = _get_wal_seq(workbook)
+        pending = [item for item in items if item[0] > applied]
+        created = set()
+        for seq, date, category, amount in pending:
+            sheet_name = sheet_name_for(date.year)
+            if sheet_name not in workbook.sheetnames:
+                created.add(sheet_name)
+            sheet = await _year_sheet(user_id, workbook, date.year)
+            if sheet_name in created:
+                continue
+            cell_address = f'{MONTH_COLUMNS[date.month]}{CATEGORY_ROWS[category]}'
+            sheet[cell_address].value = (sheet[cell_address].value or 0) + amount
+            _recalculate(user_id, sheet_name, [cell_address])
+        if pending:
+            _set_wal_seq(workbook, max(item[0] for item in pending))
+            _mark_dirty(user_id)
+            await _save(str(user_id))
+        return len(pending)
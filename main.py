@@ -1,35 +1,59 @@
+import io
 import os
+import math
 import shutil
+import functools
 import datetime
 import logging
 import asyncio
 
 from dotenv import load_dotenv
 
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-
 from aiogram import Bot, Dispatcher, types, executor
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, InputFile
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 
 import job_xls
 import job_json
-
-# Логирование настроено на уровень DEBUG для подробного вывода
-logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.DEBUG)
+import job_io
+import job_lock
+import job_pool
+import job_sqlite
+import job_aggregates
+import job_broadcast
+import job_file_cache
+import job_import
+import job_export
+import job_analytics
+import job_chart
+import job_workers
+import job_metrics
+import job_wal
+import job_registry
+import job_schedule
+from job_fsm_storage import SQLiteStorage
 
 load_dotenv()
 
-# Инициализация бота и диспетчера с хранилищем состояний в памяти
+# Уровень логирования задается переменной LOG_LEVEL (DEBUG заметно замедляет обработку, поэтому по умолчанию INFO)
+logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s",
+                    level=getattr(logging, os.getenv('LOG_LEVEL', 'INFO').upper(), logging.INFO))
+
+# Инициализация бота и диспетчера (хранилище состояний подключает `setup()` в процессе, который обрабатывает
+# обновления: дочерние процессы spawn выполняют этот модуль заново, и открывать в них базу не нужно)
 bot_token = os.getenv('MY_VAR')
 if not bot_token:
     raise ValueError("Необходимо указать BOT_TOKEN в переменных окружения.")
 
 bot = Bot(token=bot_token)
-storage = MemoryStorage()
-dp = Dispatcher(bot, storage=storage)
+# Файл контрольной точки ежедневной рассылки
+BROADCAST_CHECKPOINT = os.getenv('BROADCAST_CHECKPOINT', 'user_files/broadcast.checkpoint')
+# ID администраторов через запятую: им доступны служебные команды (например, /io_stats)
+ADMIN_IDS = {int(user_id) for user_id in os.getenv('ADMIN_IDS', '').split(',') if user_id.strip().isdigit()}
+# Время жизни состояний диалога в секундах
+FSM_STATE_TTL = int(os.getenv('FSM_STATE_TTL', 24 * 60 * 60))
+dp = Dispatcher(bot)
 
 
 # Состояния бота для управления финансовыми данными
@@ -39,6 +63,7 @@ class FinanceState(StatesGroup):
     expense_category = State()
     income_category = State()
     waiting_for_description = State()
+    waiting_for_statement = State()
 
 
 # Обработчик команды /start
@@ -50,8 +75,9 @@ async def start_command(message: types.Message):
 
     :type message: str
 
-    :return: Создает папку с id пользователя в которой создается Excel-таблица для хранения данных, а также в этой
-    же папке будет создан json-файл для более детальной информации про каждую операцию
+    :return: Создает папку с id пользователя, в которой будет храниться журнал операций. Excel-таблица не создается
+    сразу: она собирается из данных пользователя при первом запросе (/get_tables), поэтому /start остается быстрым.
+    Вся работа с файловой системой выполняется в отдельном потоке, чтобы не блокировать цикл событий.
     """
     user_id = message.from_user.id
     folder_path = f'user_files/{user_id}'
@@ -59,7 +85,7 @@ async def start_command(message: types.Message):
     logging.info(f"Пользователь {message.from_user.full_name} ({message.from_user.username}), ID: {user_id} "
                  f"вызвал команду /start в {datetime.datetime.now()}. Сообщение: {message.text}")
 
-    if os.path.exists(folder_path):
+    if await asyncio.to_thread(os.path.exists, folder_path):
         logging.debug(f"Папка {folder_path} существует.")
         keyboard = InlineKeyboardMarkup(row_width=2)
         keyboard.add(
@@ -73,8 +99,8 @@ async def start_command(message: types.Message):
             reply_markup=keyboard
         )
     else:
-        os.makedirs(folder_path, exist_ok=True)
-        job_xls.create_xls(user_id)
+        await asyncio.to_thread(os.makedirs, folder_path, exist_ok=True)
+        await asyncio.to_thread(job_registry.register, user_id)
         await message.reply(
             f'Привет, {message.from_user.first_name}! Я бот, который поможет вам вести финансовую отчетность. '
             f'Для вас создана отдельная папка, в которой будут храниться Excel-таблицы с вашими расходами и доходами. '
@@ -98,13 +124,27 @@ async def help_command(message: types.Message):
         "Этот бот поможет вам вести учет ваших доходов и расходов, сохраняя всю информацию в Excel-таблицах. "
         "Вот список команд, которые вы можете использовать:\n\n"
         "*/start* - *Инициализация бота.*\n"
-        "При первом запуске бот создаст папку и Excel-таблицу, где будут храниться ваши данные. "
+        "При первом запуске бот создаст папку, где будут храниться ваши данные; Excel-таблица соберется при первом запросе. "
         "Если вы уже использовали бота ранее, бот предложит вам очистить текущую таблицу и начать заново.\n\n"
         "*/help* - *Помощь по использованию бота.*\n"
         "Выводит это сообщение с описанием всех доступных команд и функционала.\n\n"
         "*/get_tables* - *Получение вашей таблицы.*\n"
         "Бот отправит вам текущую Excel-таблицу, в которой хранятся все ваши записи о доходах и расходах. "
         "Вы можете открыть этот файл, чтобы просмотреть или отредактировать данные.\n\n"
+        "*/export* - *Выгрузка всей истории.*\n"
+        "Бот отправит Excel-файл со всеми вашими операциями: по листу на каждый год и сводку по категориям.\n\n"
+        "*/stats* - *Аналитика за месяц.*\n"
+        "Расходы по категориям, средний расход в день и сравнение с предыдущими месяцами.\n\n"
+        "*/top* - *Крупнейшие расходы.*\n"
+        "Самые крупные расходы текущего месяца; можно указать количество, например: /top 10\n\n"
+        "*/chart* - *График расходов.*\n"
+        "Рисует расходы по категориям и по месяцам за текущий месяц; для графика за год напишите /chart year\n\n"
+        "*/rebuild_stats* - *Пересчет итогов.*\n"
+        "Пересчитывает суммы за каждый месяц по истории ваших операций.\n\n"
+        "*/report_time* - *Время ежедневного отчета.*\n"
+        "Показывает или меняет время и часовой пояс отчета за день, например: /report_time 21:30 Asia/Yekaterinburg\n\n"
+        "*/import* - *Импорт выписки.*\n"
+        "Загружает операции из банковской выписки (CSV или XLSX) в ваш журнал и таблицу за один раз.\n\n"
         "*/manage_finance* - *Управление финансами.*\n"
         "Эта команда позволяет вам добавить новые записи о доходах или расходах. "
         "После выбора типа операции (Доходы или Расходы) вам будет предложено выбрать категорию и ввести сумму.\n\n"
@@ -125,13 +165,17 @@ async def get_tables_command(message: types.Message):
 
     :type message: str
 
-    :return: Скидывает Excel-таблицу пользователю
+    :return: Скидывает Excel-таблицу пользователю. Если таблица не менялась с прошлой отправки, она отправляется
+    по сохраненному file_id без повторной загрузки.
     """
     file_path = f'user_files/{message.from_user.id}/{message.from_user.id}.xlsx'
 
-    if os.path.exists(file_path):
+    if await asyncio.to_thread(os.path.exists, f'user_files/{message.from_user.id}'):
         try:
-            await message.answer_document(InputFile(file_path))
+            # Таблица собирается при первом запросе, а изменения из кэша книг дописываются на диск
+            await job_xls.ensure_xls(message.from_user.id)
+            await job_xls.flush_user(message.from_user.id)
+            await job_file_cache.send_document(message.from_user.id, file_path, message.answer_document)
             logging.info(f"Пользователю {message.from_user.id} отправлена таблица {file_path}.")
         except Exception as e:
             logging.error(f"Ошибка при отправке файла {file_path} пользователю {message.from_user.id}: {e}")
@@ -141,6 +185,282 @@ async def get_tables_command(message: types.Message):
         await message.reply("Файл не найден.")
 
 
+# Обработчик команды /export
+@dp.message_handler(commands=['export'])
+async def export_command(message: types.Message):
+    """
+    Функция для обработки команды /export
+    :param message: Аргумент в котором хранится вся необходимая информация
+
+    :type message: str
+
+    :return: Выгружает всю историю операций пользователя в Excel (по листу на год и сводка по категориям)
+    и отправляет файл. Книга собирается в пуле процессов потоковой записью.
+    """
+    if not await asyncio.to_thread(os.path.exists, f'user_files/{message.from_user.id}'):
+        await message.reply('Сначала создайте таблицу с помощью команды /start.')
+        return
+
+    try:
+        file_path, count = await job_export.export_history(message.from_user.id)
+        if not count:
+            await message.reply("У вас пока нет операций для выгрузки.")
+            return
+        await job_file_cache.send_document(message.from_user.id, file_path, message.answer_document)
+        logging.info(f"Пользователю {message.from_user.id} отправлена история, операций: {count}.")
+    except Exception as e:
+        logging.error(f"Ошибка при выгрузке истории пользователя {message.from_user.id}: {e}")
+        await message.reply(f"Произошла ошибка при выгрузке истории: {e}")
+
+
+def _format_amount(amount):
+    return f"{amount:,.0f}".replace(",", " ")
+
+
+# Обработчик команды /stats
+@dp.message_handler(commands=['stats'])
+async def stats_command(message: types.Message):
+    """
+    Функция для обработки команды /stats
+    :param message: Аргумент в котором хранится вся необходимая информация
+
+    :type message: str
+
+    :return: Отправляет аналитику за текущий месяц: расходы по категориям, средний расход в день и расходы
+    за последние месяцы с изменением к предыдущему. Расчеты выполняются `job_analytics` над таблицей pandas,
+    которая строится по журналу один раз и обновляется после новых операций.
+    """
+    user_id = message.from_user.id
+    now = datetime.datetime.now()
+    try:
+        categories = await job_analytics.by_category(user_id, now.year, now.month)
+        daily = await job_analytics.average_daily_spend(user_id, now.year, now.month)
+        history = await job_analytics.month_over_month(user_id)
+    except Exception as e:
+        logging.error(f"Ошибка при расчете аналитики пользователя {user_id}: {e}")
+        await message.reply(f"Произошла ошибка при расчете аналитики: {e}")
+        return
+
+    lines = [f"Расходы за {job_aggregates.MONTH_NAMES[now.month]}:"]
+    lines += [f"  {category}: {_format_amount(amount)}₽" for category, amount in categories.items()] or ["  нет расходов"]
+    lines.append(f"\nВ среднем в день: {_format_amount(daily)}₽\n")
+    lines.append("По месяцам:")
+    for period, row in history.iterrows():
+        change = '' if math.isnan(row['change']) else f" ({row['change']:+.0f}%)"
+        lines.append(f"  {job_aggregates.MONTH_NAMES[period.month]} {period.year}: {_format_amount(row['expense'])}₽{change}")
+    await message.reply('\n'.join(lines))
+
+
+# Обработчик команды /top
+@dp.message_handler(commands=['top'])
+async def top_command(message: types.Message):
+    """
+    Функция для обработки команды /top
+    :param message: Сообщение с командой; после команды можно указать количество операций (по умолчанию 5)
+
+    :type message: types.Message
+
+    :return: Отправляет список самых крупных расходов за текущий месяц
+    """
+    user_id = message.from_user.id
+    argument = message.get_args()
+    n = int(argument) if argument.isdigit() and int(argument) > 0 else 5
+    now = datetime.datetime.now()
+    try:
+        top = await job_analytics.top_expenses(user_id, min(n, 50), now.year, now.month)
+    except Exception as e:
+        logging.error(f"Ошибка при расчете крупнейших расходов пользователя {user_id}: {e}")
+        await message.reply(f"Произошла ошибка при расчете аналитики: {e}")
+        return
+
+    if top.empty:
+        await message.reply(f"За {job_aggregates.MONTH_NAMES[now.month]} расходов пока нет.")
+        return
+    lines = [f"Крупнейшие расходы за {job_aggregates.MONTH_NAMES[now.month]}:"]
+    for row in top.itertuples():
+        description = f" — {row.description}" if row.description else ''
+        lines.append(f"{row.date:%d.%m} {row.category}: {_format_amount(row.amount)}₽{description}")
+    await message.reply('\n'.join(lines))
+
+
+# Обработчик команды /chart
+@dp.message_handler(commands=['chart'])
+async def chart_command(message: types.Message):
+    """
+    Функция для обработки команды /chart
+    :param message: Сообщение с командой; после команды можно указать период month (по умолчанию) или year
+
+    :type message: types.Message
+
+    :return: Отправляет PNG-график расходов по категориям и по месяцам. График рисуется в пуле процессов
+    и кэшируется `job_chart` до следующего изменения журнала, повторные запросы отправляются по file_id.
+    """
+    period = message.get_args().strip().lower() or 'month'
+    if period not in job_chart.PERIODS:
+        await message.reply("Укажите период: /chart month или /chart year")
+        return
+    try:
+        await job_chart.send_chart(message.from_user.id, period, message.answer_photo)
+    except Exception as e:
+        logging.error(f"Ошибка при построении графика для пользователя {message.from_user.id}: {e}")
+        await message.reply(f"Произошла ошибка при построении графика: {e}")
+
+
+# Обработчик команды /report_time
+@dp.message_handler(commands=['report_time'])
+async def report_time_command(message: types.Message):
+    """
+    Функция для обработки команды /report_time
+    :param message: Аргумент в котором хранится вся необходимая информация
+
+    :type message: str
+
+    :return: Без аргументов показывает текущее время и часовой пояс ежедневного отчета. С аргументами
+    "/report_time ЧЧ:ММ [Часовой/Пояс]" сохраняет их в реестре `job_registry`; время проверяется
+    `job_schedule.parse_time()`, пояс — `job_schedule.parse_timezone()`.
+    """
+    user_id = message.from_user.id
+    arguments = message.get_args().split()
+    if not arguments:
+        timezone, delivery_time = await asyncio.to_thread(job_registry.get_schedule, user_id)
+        await message.reply(f"Отчет за день приходит в {delivery_time} ({timezone}). "
+                            f"Чтобы изменить, напишите, например: /report_time 21:30 Europe/Moscow")
+        return
+    try:
+        delivery_time = job_schedule.parse_time(arguments[0])
+        timezone = job_schedule.parse_timezone(arguments[1]) if len(arguments) > 1 else None
+    except ValueError as e:
+        await message.reply(f"Не удалось разобрать время или часовой пояс: {e}. Пример: /report_time 21:30 Europe/Moscow")
+        return
+    await asyncio.to_thread(job_registry.set_schedule, user_id, timezone, delivery_time)
+    timezone, delivery_time = await asyncio.to_thread(job_registry.get_schedule, user_id)
+    await message.reply(f"Готово! Отчет за день будет приходить в {delivery_time} ({timezone}).")
+
+
+# Обработчик команды /io_stats
+@dp.message_handler(commands=['io_stats'])
+async def io_stats_command(message: types.Message):
+    """
+    Функция для обработки служебной команды /io_stats (только для ADMIN_IDS)
+    :param message: Аргумент в котором хранится вся необходимая информация
+
+    :type message: str
+
+    :return: Отправляет метрики пула Excel `job_io.xls_executor`: глубину очереди, число принятых и отклоненных
+    задач, среднее и максимальное время ожидания и выполнения. По ним подбираются XLS_IO_WORKERS и XLS_IO_QUEUE_SIZE.
+    """
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    metrics = job_io.xls_executor.metrics()
+    await message.reply('\n'.join(
+        f"{name}: {value:.4f}" if isinstance(value, float) else f"{name}: {value}" for name, value in metrics.items()))
+
+
+# Обработчик команды /metrics
+@dp.message_handler(commands=['metrics'])
+async def metrics_command(message: types.Message):
+    """
+    Функция для обработки служебной команды /metrics (только для ADMIN_IDS)
+    :param message: Аргумент в котором хранится вся необходимая информация
+
+    :type message: str
+
+    :return: Отправляет метрики процесса из `job_metrics`: задержки обработчиков и функций job_json/job_xls
+    (p50/p95/p99), число ошибок и объем ввода-вывода. Длинный отчет отправляется файлом.
+    """
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    text = job_metrics.render_text()
+    if len(text) <= 4000:
+        await message.reply(text)
+    else:
+        await message.answer_document(types.InputFile(io.BytesIO(text.encode('utf-8')), filename='metrics.txt'))
+
+
+# Обработчик команды /rebuild_stats
+@dp.message_handler(commands=['rebuild_stats'])
+async def rebuild_stats_command(message: types.Message):
+    """
+    Функция для обработки команды /rebuild_stats
+    :param message: Аргумент в котором хранится вся необходимая информация
+
+    :type message: str
+
+    :return: Пересчитывает месячные итоги пользователя по журналу операций и сообщает, сколько операций учтено
+    """
+    try:
+        count = await job_aggregates.rebuild(message.from_user.id)
+        logging.info(f"Итоги пользователя {message.from_user.id} пересчитаны, операций: {count}.")
+        await message.reply(f"Итоги пересчитаны. Учтено операций: {count}.")
+    except Exception as e:
+        logging.error(f"Ошибка при пересчете итогов пользователя {message.from_user.id}: {e}")
+        await message.reply(f"Произошла ошибка при пересчете итогов: {e}")
+
+
+# Обработчик команды /import
+@dp.message_handler(commands=['import'])
+async def import_command(message: types.Message):
+    """
+    Функция для обработки команды /import
+    :param message: Аргумент в котором хранится вся необходимая информация
+
+    :type message: str
+
+    :return: Просит пользователя прислать банковскую выписку (CSV или XLSX) и переводит его в состояние ожидания файла
+    """
+    if not await asyncio.to_thread(os.path.exists, f'user_files/{message.from_user.id}'):
+        await message.reply('Сначала создайте таблицу с помощью команды /start.')
+        return
+    await message.reply(
+        "Пришлите выписку банка файлом CSV или XLSX. Бот сам найдет столбцы с датой, суммой, категорией и описанием; "
+        "если названия столбцов другие, укажите их в подписи к файлу, например:\n"
+        "дата=Дата операции; сумма=Сумма; категория=Категория; описание=Комментарий\n\n"
+        "Для отмены напишите /stop."
+    )
+    await FinanceState.waiting_for_statement.set()
+
+
+# Обработчик файла выписки
+@dp.message_handler(state=FinanceState.waiting_for_statement, content_types=[types.ContentType.DOCUMENT,
+                                                                             types.ContentType.TEXT])
+async def handle_statement(message: types.Message, state: FSMContext):
+    """
+    Функция для обработки присланной выписки
+    :param message: Сообщение с файлом выписки (или командой /stop)
+    :param state: Объект состояния FSMContext, используемый для хранения состояния пользователя
+
+    :type message: types.Message
+    :type state: FSMContext
+
+    :return: Скачивает файл, импортирует все операции из него одной пачкой через `job_import.import_statement()`
+    и сообщает пользователю, сколько операций добавлено.
+    """
+    if message.text and message.text.lower() == '/stop':
+        await message.reply("Импорт отменен.")
+        await state.finish()
+        return
+    if message.document is None:
+        await message.reply("Пришлите файл выписки (CSV или XLSX) или напишите /stop для отмены.")
+        return
+
+    try:
+        buffer = io.BytesIO()
+        await message.document.download(destination_file=buffer)
+        count = await job_import.import_statement(message.from_user.id, buffer.getvalue(),
+                                                  message.document.file_name or 'statement.csv',
+                                                  job_import.parse_mapping(message.caption))
+        logging.info(f"Пользователь {message.from_user.id} импортировал операций: {count}")
+        await message.reply(f"Импорт завершен. Добавлено операций: {count}.")
+    except job_io.BusyError:
+        logging.warning(f"Пул Excel занят, импорт пользователя {message.from_user.id} отклонен.")
+        await message.reply(job_io.BUSY_TEXT)
+    except Exception as e:
+        logging.error(f"Ошибка при импорте выписки пользователя {message.from_user.id}: {e}")
+        await message.reply(f"Не удалось импортировать выписку: {e}")
+    finally:
+        await state.finish()
+
+
 # Обработчик команды /manage_finance
 @dp.message_handler(commands=['manage_finance'])
 async def manage_finance_command(message: types.Message):
@@ -190,8 +510,8 @@ async def reset_user_data(callback_query: types.CallbackQuery):
 
     :type callback_query: Types.CallbackQuery
 
-    :return: Удаляет папку с данными пользователя и создает новую Excel-таблицу для хранения данных. Если папка с данными
-    пользователя существует, она удаляется, и создается новая таблица. В случае отсутствия папки, выводится предупреждение
+    :return: Удаляет папку с данными пользователя и создает ее заново пустой (новая Excel-таблица соберется при первом
+    запросе). Удаление выполняется в отдельном потоке. В случае отсутствия папки, выводится предупреждение
     и отправляется сообщение с предложением создать данные с помощью команды /start.
 
     Логирование:
@@ -199,7 +519,8 @@ async def reset_user_data(callback_query: types.CallbackQuery):
     - В случае отсутствия данных выводится предупреждение о том, что папка пользователя не существует.
 
     Задействованные функции:
-    - `job_xls.create_xls(user_id)`: Создает новую Excel-таблицу для пользователя.
+    - `job_xls.drop_user(user_id)`: Убирает старую книгу пользователя из кэша без сохранения.
+    - `asyncio.to_thread()`: Выполняет удаление и создание папки вне цикла событий.
     - `callback_query.answer()`: Показывает всплывающее уведомление о успешной операции.
     - `callback_query.message.answer()`: Отправляет сообщение пользователю, если папка отсутствует.
     """
@@ -207,9 +528,19 @@ async def reset_user_data(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
     folder_path = f'user_files/{user_id}'
 
-    if os.path.exists(folder_path):
-        shutil.rmtree(folder_path)
-        job_xls.create_xls(user_id)
+    if await asyncio.to_thread(os.path.exists, folder_path):
+        # Ждем завершения начатых записей пользователя, чтобы они не попали в новую таблицу
+        async with job_lock.user_lock(user_id, 'json'), job_lock.user_lock(user_id, 'xls'):
+            job_xls.drop_user(user_id)
+            job_aggregates.drop_user(user_id)
+            job_file_cache.drop_user(user_id)
+            job_analytics.invalidate(user_id)
+            job_chart.drop_user(user_id)
+            job_wal.drop_user(user_id)
+            await job_json.reset_user(user_id)
+            await asyncio.to_thread(job_registry.reset, user_id)
+            await asyncio.to_thread(shutil.rmtree, folder_path)
+            await asyncio.to_thread(os.makedirs, folder_path, exist_ok=True)
         logging.info(f"Данные пользователя {user_id} успешно сброшены.")
         await callback_query.answer("Вы успешно обновили свою таблицу!", show_alert=True)
     else:
@@ -248,7 +579,8 @@ async def handle_output(callback_query: types.CallbackQuery):
 
     :type callback_query: types.CallbackQuery
 
-    :return: Функция проверяет наличие Excel-файла с данными пользователя. Если файл существует, он отправляется пользователю.
+    :return: Функция проверяет наличие папки пользователя. Если она существует, Excel-таблица (при необходимости собранная
+    по данным пользователя) отправляется пользователю.
     В случае успешной отправки логируется информация о действии. Если файл не найден, пользователю отправляется сообщение об ошибке,
     а в лог записывается предупреждение. Если при отправке файла возникает ошибка, она логируется, и пользователю отправляется сообщение об ошибке.
 
@@ -258,16 +590,20 @@ async def handle_output(callback_query: types.CallbackQuery):
     - Логируется предупреждение, если файл не найден.
 
     Используемые методы:
-    - `callback_query.message.answer_document()`: Отправляет файл Excel пользователю.
+    - `job_file_cache.send_document()`: Отправляет файл Excel пользователю (по file_id, если файл не менялся).
     - `callback_query.message.reply()`: Отправляет сообщение пользователю в случае ошибки или отсутствия файла.
     - `callback_query.answer()`: Закрывает уведомление о нажатии кнопки для предотвращения блокировки интерфейса.
     """
 
     file_path = f'user_files/{callback_query.from_user.id}/{callback_query.from_user.id}.xlsx'
 
-    if os.path.exists(file_path):
+    if await asyncio.to_thread(os.path.exists, f'user_files/{callback_query.from_user.id}'):
         try:
-            await callback_query.message.answer_document(InputFile(file_path))
+            # Таблица собирается при первом запросе, а изменения из кэша книг дописываются на диск
+            await job_xls.ensure_xls(callback_query.from_user.id)
+            await job_xls.flush_user(callback_query.from_user.id)
+            await job_file_cache.send_document(callback_query.from_user.id, file_path,
+                                               callback_query.message.answer_document)
             logging.info(f"Пользователю {callback_query.from_user.id} отправлена таблица {file_path}.")
         except Exception as e:
             logging.error(f"Ошибка при отправке файла {file_path} пользователю {callback_query.from_user.id}: {e}")
@@ -380,8 +716,7 @@ async def handle_income_amount(message: types.Message, state: FSMContext):
     Используемые методы:
     - `state.get_data()`: Получает данные, сохраненные в состоянии пользователя.
     - `message.reply()`: Отправляет ответное сообщение пользователю.
-    - `job_xls.data_validator()`: Проверяет и добавляет данные о доходе в Excel-таблицу.
-    - `job_json.description_operation()`: Добавляет информацию об операции в JSON-файл.
+    - `job_wal.record()`: Записывает операцию в журнал намерений, затем в JSON-журнал, итоги и Excel-таблицу.
     - `logging.info()`: Логирует успешное добавление дохода.
     - `logging.error()`: Логирует ошибку, если она возникает при добавлении данных.
     - `state.finish()`: Завершает текущее состояние FSM.
@@ -393,9 +728,7 @@ async def handle_income_amount(message: types.Message, state: FSMContext):
 
     user_data = await state.get_data()
     category = user_data.get('income_category')
-    datetime_str = user_data.get('income_category')
     amount = message.text.strip()
-    print(message.from_user.id, category, int(amount))
     if amount.lower() == '/stop':
         await message.reply("Операция отменена.")
         await state.finish()
@@ -406,26 +739,30 @@ async def handle_income_amount(message: types.Message, state: FSMContext):
         return
 
     try:
-        current_time = datetime.datetime.now()
+        # Операция помечается местным временем пользователя: по местной дате собирается его ежедневный отчет
+        current_time = await asyncio.to_thread(job_schedule.local_now, message.from_user.id)
         date_str = current_time.strftime("%d.%m.%Y")
         time_str = current_time.strftime("%H:%M:%S")
-        await job_xls.data_validator(message.from_user.id, category, int(amount))
-        await job_json.description_operation(user_id=message.from_user.id, type_operation='Доход',
-                                             category=category, amount=int(amount),
-                                             date_str=date_str, time_str=time_str)
+        tx_id = await job_wal.record(message.from_user.id, type_operation='Доход', category=category,
+                                     amount=int(amount), date_str=date_str, time_str=time_str)
         keyboard = InlineKeyboardMarkup(row_width=2)
         keyboard.add(
             InlineKeyboardButton(text='Получить таблицу', callback_data='manage_output'),
-            InlineKeyboardButton(text='Добавить описание', callback_data=f'get_description_{date_str}_{time_str}')
+            InlineKeyboardButton(text='Добавить описание', callback_data=f'get_description_{tx_id}')
         )
         await message.reply(f"Доход в категории '{category}' на сумму {amount} успешно добавлен!",
                             reply_markup=keyboard)
         logging.info(f"Пользователь {message.from_user.id} добавил доход: {category} - {amount}")
+    except job_io.BusyError:
+        # Операция нигде не учтена, состояние сохраняется: пользователь может просто отправить сумму еще раз
+        logging.warning(f"Пул Excel занят, операция пользователя {message.from_user.id} отклонена.")
+        await message.reply(job_io.BUSY_TEXT)
+        return
     except Exception as e:
         logging.error(f"Ошибка при добавлении дохода для пользователя {message.from_user.id}: {e}")
         await message.reply(f"Произошла ошибка при добавлении дохода: {e}")
-    finally:
-        await state.finish()
+
+    await state.finish()
 
 
 # Обработчик нажатия на кнопку "Добавить описание"
@@ -439,11 +776,12 @@ async def handle_get_description(callback_query: types.CallbackQuery, state: FSM
     :type callback_query: types.CallbackQuery
     :type state: FSMContext
 
-    :return: Функция извлекает дату и время операции из callback данных и сохраняет их в состоянии FSM для дальнейшего использования.
+    :return: Функция извлекает ID операции (в старых кнопках — дату и время) из callback данных и сохраняет его в состоянии FSM для дальнейшего использования.
     Пользователю отправляется сообщение с просьбой ввести текст описания, после чего состояние переводится в режим ожидания ввода описания.
 
     Логика работы:
-    1. Из callback данных извлекаются дата и время операции, которые сохраняются в состоянии FSM для последующего использования при добавлении описания.
+    1. Из callback данных извлекается ID операции, который сохраняется в состоянии FSM для последующего использования при добавлении описания.
+    Если операции с таким ID нет (например, после сброса данных), пользователь получает уведомление.
     2. Пользователю отправляется сообщение с запросом на ввод описания для выбранной операции.
     3. Состояние пользователя переводится в `FinanceState.waiting_for_description`, чтобы обработчик мог ожидать ввод текста.
     4. Callback запрос завершается с помощью метода `callback_query.answer()`, чтобы не блокировать интерфейс.
@@ -459,13 +797,17 @@ async def handle_get_description(callback_query: types.CallbackQuery, state: FSM
     Пользователь может ввести описание для выбранной операции или отменить ввод, написав "/stop".
     """
 
-    # Извлечение даты и времени из callback_data
-    callback_data_parts = callback_query.data.split('_')
-    date_str = callback_data_parts[2]
-    time_str = callback_data_parts[3]
-
-    # Сохранение даты и времени в state (чтобы использовать при вводе текста)
-    await state.update_data(date_str=date_str, time_str=time_str)
+    # Извлечение ID операции из callback_data (в кнопках, отправленных до появления ID, — дата и время)
+    payload = callback_query.data[len('get_description_'):]
+    if payload.isdigit():
+        if await job_json.find_transaction(callback_query.from_user.id, int(payload)) is None:
+            await callback_query.answer("Операция не найдена.", show_alert=True)
+            return
+        await state.update_data(tx_id=int(payload))
+    else:
+        date_str, time_str = payload.split('_')
+        # Сохранение даты и времени в state (чтобы использовать при вводе текста)
+        await state.update_data(date_str=date_str, time_str=time_str)
 
     # Сообщение пользователю с просьбой ввести текст описания
     await callback_query.message.reply("Пожалуйста, введите описание или напишите /stop для отмены.")
@@ -510,14 +852,19 @@ async def process_description(message: types.Message, state: FSMContext):
         await state.finish()
         return
 
-    # Получаем дату и время из state
+    # Получаем ID операции (или дату и время) из state
     user_data = await state.get_data()
-    date_str = user_data.get('date_str')
-    time_str = user_data.get('time_str')
-
-    # Сообщение пользователю с введенным текстом и временем создания кнопки
-    await job_json.get_description_text(user_id=message.from_user.id, date_str=date_str,
-                                        time_str=time_str, description=message.text)
+    tx_id = user_data.get('tx_id')
+
+    if tx_id is not None:
+        # Дата и время операции берутся из индекса, история целиком не читается
+        if not await job_json.set_description(message.from_user.id, tx_id, message.text):
+            await message.reply("Операция не найдена.")
+            await state.finish()
+            return
+    else:
+        await job_json.get_description_text(user_id=message.from_user.id, date_str=user_data.get('date_str'),
+                                            time_str=user_data.get('time_str'), description=message.text)
     await message.reply(f"Описание успешно добавлено.")
 
     # Завершение состояния
@@ -550,7 +897,6 @@ async def handle_expense_category(callback_query: types.CallbackQuery):
         "Одежда", "Медикаменты", "Процент кредита", "Хоз расходы", "Техника",
         "Парикмахерская", "Развлечения", "Обучение", "Подарки", "Прочие"
     ]
-    print([f"{text} expense_{text}" for text in categories])
     keyboard.add(*[InlineKeyboardButton(text=cat, callback_data=f'expense_{cat}') for cat in categories])
 
     await callback_query.message.reply("Выберите категорию расхода:", reply_markup=keyboard)
@@ -612,8 +958,7 @@ async def handle_expense_amount(message: types.Message, state: FSMContext):
     Используемые методы:
     - `state.get_data()`: Получает данные, сохраненные в состоянии пользователя.
     - `message.reply()`: Отправляет ответное сообщение пользователю.
-    - `job_xls.data_validator()`: Проверяет и добавляет данные о расходе в Excel-таблицу.
-    - `job_json.description_operation()`: Добавляет информацию об операции в JSON-файл.
+    - `job_wal.record()`: Записывает операцию в журнал намерений, затем в JSON-журнал, итоги и Excel-таблицу.
     - `logging.info()`: Логирует успешное добавление расхода.
     - `logging.error()`: Логирует ошибку, если она возникает при добавлении данных.
     - `state.finish()`: Завершает текущее состояние FSM.
@@ -637,35 +982,37 @@ async def handle_expense_amount(message: types.Message, state: FSMContext):
         return
 
     try:
-        current_time = datetime.datetime.now()
+        # Операция помечается местным временем пользователя: по местной дате собирается его ежедневный отчет
+        current_time = await asyncio.to_thread(job_schedule.local_now, message.from_user.id)
         date_str = current_time.strftime("%d.%m.%Y")
         time_str = current_time.strftime("%H:%M:%S")
 
-        # Добавляем запись о расходах в JSON файл
-        await job_json.description_operation(user_id=message.from_user.id, type_operation='Расход',
-                                             category=category, amount=int(amount),
-                                             date_str=date_str, time_str=time_str)
-
-        # Валидируем и добавляем данные в Excel таблицу
-        await job_xls.data_validator(message.from_user.id, category, int(amount))
+        # Записываем намерение в журнал намерений и учитываем расход в журнале, итогах и Excel таблице
+        # (если пул Excel занят, операция не попадет никуда)
+        tx_id = await job_wal.record(message.from_user.id, type_operation='Расход', category=category,
+                                     amount=int(amount), date_str=date_str, time_str=time_str)
 
         # Создаем клавиатуру с кнопками
         keyboard = InlineKeyboardMarkup(row_width=2)
         keyboard.add(
             InlineKeyboardButton(text='Получить таблицу', callback_data='manage_output'),
-            InlineKeyboardButton(text='Добавить описание', callback_data=f'get_description_{date_str}_{time_str}')
+            InlineKeyboardButton(text='Добавить описание', callback_data=f'get_description_{tx_id}')
         )
 
         await message.reply(f"Расход в категории '{category}' на сумму {amount} успешно добавлен!",
                             reply_markup=keyboard)
         logging.info(f"Пользователь {message.from_user.id} добавил расход: {category} - {amount}")
 
+    except job_io.BusyError:
+        # Операция нигде не учтена, состояние сохраняется: пользователь может просто отправить сумму еще раз
+        logging.warning(f"Пул Excel занят, операция пользователя {message.from_user.id} отклонена.")
+        await message.reply(job_io.BUSY_TEXT)
+        return
     except Exception as e:
         logging.error(f"Ошибка при добавлении расхода для пользователя {message.from_user.id}: {e}")
         await message.reply(f"Произошла ошибка при добавлении расхода: {e}")
 
-    finally:
-        await state.finish()
+    await state.finish()
 
 
 @dp.message_handler()
@@ -677,109 +1024,166 @@ async def message_processing(message: types.Message):
     :type message: types.Message
 
     :return: Функция обрабатывает текст сообщения пользователя. Если текст сообщения равен "Расходы за месяц", функция
-    извлекает данные о расходах за текущий месяц из Excel-таблицы и отправляет их пользователю. Расходы берутся из определенной
-    ячейки, соответствующей текущему месяцу.
+    берет расходы и остаток за текущий месяц (строки 30 и 34 таблицы) и отправляет их пользователю.
 
     Логика работы:
-    1. Определение текущего месяца с помощью функции `datetime.datetime.now().month`.
-    2. Если текст сообщения равен "Расходы за месяц", из Excel-таблицы пользователя извлекаются данные о расходах:
-       - Значение из строки 30 для соответствующего столбца месяца.
-       - Название месяца из строки 12 для того же столбца.
-    3. Пользователю отправляется сообщение с информацией о расходах за текущий месяц.
+    1. Определение текущего месяца с помощью функции `datetime.datetime.now()`.
+    2. Если текст сообщения равен "Расходы за месяц", итоги за текущий месяц берутся `job_xls.month_totals()`.
+    3. Пользователю отправляется сообщение с информацией о расходах и остатке за текущий месяц.
 
     Используемые методы:
-    - `job_xls.get_cell_value()`: Получает значение из указанной ячейки Excel-таблицы пользователя.
+    - `job_xls.month_totals()`: Возвращает итоги месяца из книги в кэше (формулы вычисляются графом `job_formula`),
+    а если таблица еще не создана — из месячных сумм `job_aggregates`, не открывая Excel-таблицу.
     - `message.reply()`: Отправляет ответное сообщение пользователю с информацией о его расходах за текущий месяц.
 
     Примечание:
-    - В `month_id` содержится сопоставление номеров месяцев с буквами столбцов, в которых хранятся данные о месячных расходах.
-    - Функция предполагает, что данные о расходах находятся в строке 30, а название месяца — в строке 12 Excel-таблицы.
+    - Итоги обновляются при каждой операции в `job_xls.data_validator()` и могут быть пересчитаны командой /rebuild_stats.
     """
 
-    month_id = {
-        1: 'H', 2: 'I', 3: 'J', 4: 'K',
-        5: 'L', 6: 'M', 7: 'N', 8: 'C',
-        9: 'D', 10: 'E', 11: 'F', 12: 'G'
-    }
-    month = datetime.datetime.now().month
+    now = datetime.datetime.now()
     if message.text == 'Расходы за месяц':
-        amount = await job_xls.get_cell_value(cell_address=f'{month_id[month]}30', user_id=message.from_user.id)
-        m = await job_xls.get_cell_value(cell_address=f'{month_id[month]}12', user_id=message.from_user.id)
-        await message.reply(text=f"Расходы за {m[0]} составляют {amount[0]}")
+        _, amount, balance = await job_xls.month_totals(message.from_user.id, now.year, now.month)
+        await message.reply(text=f"Расходы за {job_aggregates.MONTH_NAMES[now.month]} составляют {amount}, "
+                                 f"остаток — {balance}")
 
 
 # Функция для отправки сообщения всем пользователям из списка
-async def send_daily_message():
+async def send_daily_message(send=None):
     """
-    Асинхронная функция для отправки ежедневного сообщения всем пользователям из списка
-    :return: Функция проходит по списку папок с ID пользователей, извлекает данные для каждого пользователя, и отправляет
-    сообщение с результатами обработки данных. Если возникает ошибка при отправке, она логируется.
+    Асинхронная функция для отправки ежедневного отчета всем пользователям из списка
+    :param send: Корутина send(chat_id, text) для отправки сообщения. По умолчанию сообщение отправляется ботом
+    в формате MarkdownV2; для проверки можно передать локальную заглушку.
+
+    :type send: callable
+
+    :return: Функция выбирает из реестра пользователей тех, у кого есть операции за день, формирует для каждого
+    из них отчет за день и рассылает отчеты через `job_broadcast.broadcast()`. Возвращает счетчики рассылки.
 
     Логика работы:
-    1. Определяется список ID пользователей на основе имен папок в директории 'user_files'. Каждая папка в этой директории
-    представляет собой ID пользователя.
-    2. Для каждого пользователя (папки) вызывается функция `job_json.read_and_process_file()`, которая обрабатывает данные и возвращает текст сообщения.
-    3. Сообщение отправляется пользователю с помощью метода `bot.send_message()` с указанием ID чата.
-    4. В случае ошибки при обработке или отправке сообщения она логируется с подробной информацией о пользователе.
+    1. Список ID пользователей с операциями за текущий день выбирается из реестра `job_registry.active_users()`
+    по индексу даты последней операции. Папки остальных пользователей не просматриваются и их журналы не читаются.
+    2. Для каждого пользователя вызывается функция `job_json.read_and_process_file()`, которая возвращает текст отчета.
+    3. Отчеты отправляются параллельно (до `job_broadcast.CONCURRENCY` одновременно) с учетом лимитов Telegram:
+    общего и на один чат. Ответ RetryAfter обрабатывается паузой и повторной отправкой.
+    4. Прогресс сохраняется в контрольной точке `BROADCAST_CHECKPOINT`: если рассылку прервать, повторный запуск
+    за тот же день продолжит ее с места остановки.
 
     Используемые методы:
-    - `os.listdir()`: Возвращает список файлов и папок в указанной директории.
-    - `os.path.isdir()`: Проверяет, является ли элемент директорией (чтобы убедиться, что это папка пользователя).
-    - `job_json.read_and_process_file()`: Извлекает и обрабатывает данные из JSON-файла пользователя.
-    - `bot.send_message()`: Отправляет сообщение пользователю по его ID в формате MarkdownV2.
-    - `logging.error()`: Логирует ошибку, если сообщение не удалось отправить.
+    - `job_registry.active_users()`: Возвращает ID пользователей, у которых есть операции за указанную дату.
+    - `job_json.read_and_process_file()`: Извлекает и обрабатывает данные из журнала пользователя.
+    - `job_broadcast.broadcast()`: Рассылает сообщения с ограничением частоты и возобновлением.
 
     Примечание:
-    - Функция предполагает, что в директории 'user_files' каждая папка названа по ID пользователя, которому необходимо отправить сообщение.
-    - Обработка данных для каждого пользователя производится функцией `job_json.read_and_process_file()`.
+    - Дату последней операции в реестре обновляет `job_json` при каждой добавленной операции.
     """
 
-    folder_path = 'user_files'
-    # Список ID пользователей, которым бот будет отправлять сообщение
-    chat_ids = [f for f in os.listdir(folder_path) if os.path.isdir(os.path.join(folder_path, f))]
-    for chat_id in chat_ids:
-        try:
-            res = await job_json.read_and_process_file(chat_id)
-            await bot.send_message(chat_id=chat_id, text='''
-            Бот был обновлён\! 🎉
+    if send is None:
+        async def send(chat_id, text):
+            await bot.send_message(chat_id=chat_id, text=text, parse_mode="MarkdownV2")
 
-Теперь бот может добавлять **описания к транзакциям**, а также будет **каждый день в 23:00** отправлять вам отчет за прошедший день\. 📊
+    run_id = datetime.datetime.now().strftime("%d.%m.%Y")
+    # Список ID пользователей с операциями за день, которым бот будет отправлять сообщение
+    chat_ids = await job_registry.active_users(run_id)
+    # При работе с процессами-обработчиками журналы изменяют они, а этот процесс отчеты только читает
+    make_text = functools.partial(job_json.read_and_process_file, read_only=job_workers.WORKER_PROCESSES > 0)
+    stats = await job_broadcast.broadcast(chat_ids, make_text, send,
+                                          run_id=run_id, checkpoint_path=BROADCAST_CHECKPOINT)
+    logging.info(f"Ежедневная рассылка завершена: {stats}")
+    return stats
 
-Если у вас есть идеи или предложения по улучшению, не стесняйтесь отправлять их сюда — [@vay\_ahi](https://t.me/vay_ahi)\.
 
-Мы всегда рады вашим отзывам\! 🙌''', parse_mode="MarkdownV2")
-        except Exception as e:
-            logging.error(f"Ошибка при отправке сообщения пользователю {chat_id}: {e}")
-
-
-# Планировщик задач для отправки сообщения каждый день в 23:00
+# Планировщик ежедневных отчетов
 async def scheduler_setup():
     """
-    Функция для настройки планировщика задач, отправляющего сообщения ежедневно в 23:00
-    :return: Функция создает и настраивает планировщик задач `AsyncIOScheduler`, который каждый день в 23:00 по московскому времени
-    запускает задачу `send_daily_message()`.
+    Функция для настройки планировщика, рассылающего пользователям ежедневные отчеты в их местное время
+    :return: Функция запускает планировщик `job_schedule.setup()`, который в начале каждого слота
+    (job_schedule.SLOT_MINUTES минут) рассылает отчеты пользователям, чье время отчета попадает в слот.
 
     Логика работы:
-    1. Создается экземпляр `AsyncIOScheduler` с указанием часового пояса "Europe/Moscow".
-    2. В планировщике регистрируется задача `send_daily_message()` с использованием триггера `cron`, который запускает задачу каждый день в 23:00.
-    3. Планировщик запускается с помощью метода `scheduler.start()`.
+    1. Время и часовой пояс отчета каждого пользователя хранятся в реестре `job_registry` (команда /report_time),
+    по умолчанию — job_registry.DEFAULT_DELIVERY_TIME по job_registry.DEFAULT_TIMEZONE.
+    2. Отправка внутри слота сдвигается на постоянный для пользователя интервал `job_schedule.jitter()`, поэтому
+    пользователи с одинаковым временем не читают журналы и не получают сообщения одновременно.
+    3. Задача планировщика хранится в SQLite и объединяет пропущенные запуски (coalesce), поэтому после перезапуска
+    бота рассылка выполняется один раз и охватывает все пропущенные слоты.
 
     Используемые методы:
-    - `AsyncIOScheduler()`: Создает асинхронный планировщик задач с возможностью настройки по времени и дате.
-    - `scheduler.add_job()`: Добавляет задачу в планировщик с указанием времени выполнения (каждый день в 23:00).
-    - `scheduler.start()`: Запускает планировщик, позволяя задачам выполняться в фоновом режиме.
+    - `job_schedule.setup()`: Создает и запускает планировщик с постоянным хранилищем задач.
+    - `job_broadcast.broadcast()`: Рассылает сообщения с ограничением частоты и возобновлением.
+    """
+    async def send(chat_id, text):
+        await bot.send_message(chat_id=chat_id, text=text, parse_mode="MarkdownV2")
+
+    # Журналы изменяют процессы-обработчики (их блокировки этому процессу не видны), поэтому здесь отчеты только читаются
+    job_schedule.setup(send, checkpoint_path=BROADCAST_CHECKPOINT, read_only=job_workers.WORKER_PROCESSES > 0)
+    if job_metrics.METRICS_PORT:
+        await job_metrics.start_server()
+
+
+async def on_shutdown(dispatcher: Dispatcher):
+    """
+    Функция, вызываемая при остановке бота
+    :param dispatcher: Диспетчер бота
+
+    :type dispatcher: Dispatcher
+
+    :return: Сохраняет на диск все Excel-таблицы, изменения в которых еще не были записаны фоновой задачей.
+    """
+    await job_xls.flush_all()
+    job_io.xls_executor.shutdown()
+    job_pool.shutdown()
+    job_sqlite.close()
+    job_registry.close()
+    logging.info("Несохраненные таблицы записаны на диск.")
+
+
+def setup():
+    """
+    Функция для подготовки процесса, который обрабатывает обновления
+    :return: Подключает к диспетчеру хранилище состояний в SQLite (состояния переживают перезапуск бота)
+    и включает замеры времени всех обработчиков и функций работы с журналом и таблицами.
 
     Примечание:
-    - Планировщик использует часовой пояс "Europe/Moscow". Вы можете изменить его в зависимости от вашего региона.
-    - Задача `send_daily_message()` будет выполняться каждый день в 23:00 по московскому времени.
+    - Вызывается один раз: в основном процессе при работе без процессов-обработчиков, иначе — в каждом
+    процессе-обработчике (`job_workers.run()`). Процессы пула `job_pool` и основной процесс, который только
+    раздает обновления, выполняют модуль без нее.
     """
-    scheduler = AsyncIOScheduler(timezone="Europe/Moscow")  # Укажите нужный вам часовой пояс
-    scheduler.add_job(send_daily_message, 'cron', hour=00, minute=00)  # Настройка на 23:00
-    scheduler.start()
+    dp.storage = SQLiteStorage(ttl=FSM_STATE_TTL)
+    job_metrics.instrument_dispatcher(dp)
+    job_metrics.instrument_module(job_json)
+    job_metrics.instrument_module(job_xls)
+    job_metrics.register_gauges('xls_io', job_io.xls_executor.metrics)
+
+
+async def on_startup_webhook(dispatcher: Dispatcher):
+    """
+    Функция, вызываемая при запуске бота в режиме webhook в одном процессе: регистрирует адрес webhook в Telegram
+    """
+    if job_workers.WEBHOOK_URL:
+        await dispatcher.bot.set_webhook(job_workers.WEBHOOK_URL)
 
 
 if __name__ == "__main__":
+    # При первом запуске с реестром пользователей он заполняется по существующим папкам (до восстановления,
+    # которое само отмечает операции в реестре)
+    job_registry.populate()
+    # До приема обновлений доприменяем операции, записанные в журнал намерений, но не дошедшие до всех хранилищ
+    # (восстановление идет в основном процессе до запуска процессов-обработчиков)
+    asyncio.get_event_loop().run_until_complete(job_wal.recover())
+    # Соединение с реестром не должно переходить в процессы-обработчики: каждый откроет свое
+    job_registry.close()
     logging.info("Бот запущен и готов к работе.")
-    loop = asyncio.get_event_loop()
-    loop.create_task(scheduler_setup())  # Запускаем планировщик
-    executor.start_polling(dp)
+    if job_workers.WORKER_PROCESSES > 0:
+        # Обновления распределяются по процессам-обработчикам по id пользователя
+        job_workers.run(bot, 'main:dp', 'main:on_shutdown', on_startup=scheduler_setup, setup_target='main:setup')
+    elif job_workers.RUN_MODE == 'webhook':
+        setup()
+        loop = asyncio.get_event_loop()
+        loop.create_task(scheduler_setup())  # Запускаем планировщик
+        executor.start_webhook(dp, job_workers.WEBHOOK_PATH, on_startup=on_startup_webhook, on_shutdown=on_shutdown,
+                               host=job_workers.WEBHOOK_HOST, port=job_workers.WEBHOOK_PORT)
+    else:
+        setup()
+        loop = asyncio.get_event_loop()
+        loop.create_task(scheduler_setup())  # Запускаем планировщик
+        executor.start_polling(dp, on_shutdown=on_shutdown)
@@ -0,0 +1,45 @@
+import os
+import sys
+import asyncio
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import job_broadcast
+
+
+class Crash(BaseException):
+    """Имитация падения процесса: не перехватывается обработчиком ошибок рассылки"""
+
+
+def _broadcast(chat_ids, send, checkpoint_path):
+    async def make_text(chat_id):
+        return f'отчет {chat_id}'
+
+    return asyncio.run(job_broadcast.broadcast(chat_ids, make_text, send, '18.10.2026', checkpoint_path,
+                                               concurrency=1, global_rate=1000, per_chat_rate=1000))
+
+
+def test_crash_resends_nothing_already_delivered(tmp_path):
+    checkpoint_path = str(tmp_path / 'broadcast.checkpoint')
+    sent = []
+
+    async def send(chat_id, text):
+        if chat_id == 4:
+            # Все доставленные до сбоя чаты уже записаны в контрольную точку
+            assert job_broadcast._read_checkpoint(checkpoint_path, '18.10.2026') == {'1', '2', '3'}
+            raise Crash()
+        sent.append(chat_id)
+
+    with pytest.raises(Crash):
+        _broadcast(range(1, 7), send, checkpoint_path)
+    assert sent == [1, 2, 3]
+
+    async def resend(chat_id, text):
+        sent.append(chat_id)
+
+    stats = _broadcast(range(1, 7), resend, checkpoint_path)
+    assert sent == [1, 2, 3, 4, 5, 6]
+    assert stats == {'sent': 3, 'skipped': 0, 'failed': 0, 'resumed': 3}
+    assert not os.path.exists(checkpoint_path)
@@ -0,0 +1,156 @@
+import os
+import sys
+import asyncio
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import job_json
+import job_sqlite
+import job_registry
+import job_ledger_bin
+
+
+def _entry(date_str, time_str, amount, category='Еда'):
+    return {"date": date_str, "time": time_str, "type": 'Расход', "category": category, "amount": amount,
+            "description": None}
+
+
+@pytest.fixture
+def user_dir(tmp_path, monkeypatch):
+    # Модули работают с относительными путями user_files/{id}
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(job_registry, 'REGISTRY_PATH', str(tmp_path / 'registry.sqlite3'))
+    job_registry.close()
+    os.makedirs('user_files/1')
+    yield '1'
+    asyncio.run(job_json.reset_user('1'))
+    job_registry.reset('1')
+    job_registry.close()
+
+
+def _add(user_id, entries):
+    async def scenario():
+        reserved = await job_json.reserve(user_id, entries)
+        await job_json.add_transactions(user_id, reserved)
+        return reserved
+    return asyncio.run(scenario())
+
+
+def _restart(user_id):
+    # Имитация перезапуска: индекс и отчеты в памяти теряются, файлы остаются
+    job_json._indexes.pop(str(user_id), None)
+    job_json._daily_reports.pop(str(user_id), None)
+
+
+def test_same_second_is_shifted_to_next_free_second(user_dir):
+    first = _add(user_dir, [_entry('18.10.2026', '10:00:00', 10)])
+    second = _add(user_dir, [_entry('18.10.2026', '10:00:00', 20), _entry('18.10.2026', '10:00:00', 30)])
+
+    assert [entry['id'] for entry in first + second] == [1, 2, 3]
+    assert [entry['time'] for entry in first + second] == ['10:00:00', '10:00:01', '10:00:02']
+    day = asyncio.run(job_json.load_ledger(user_dir))['18.10.2026']
+    assert {time_str: entry['amount'] for time_str, entry in day.items()} == {
+        '10:00:00': 10, '10:00:01': 20, '10:00:02': 30}
+
+
+def test_second_shift_crosses_midnight(user_dir):
+    _add(user_dir, [_entry('18.10.2026', '23:59:59', 10)])
+    shifted = _add(user_dir, [_entry('18.10.2026', '23:59:59', 20)])
+    assert (shifted[0]['date'], shifted[0]['time']) == ('19.10.2026', '00:00:00')
+
+
+@pytest.mark.parametrize('ledger_format', ['jsonl', 'binary'])
+def test_find_by_id_across_month_partitions(user_dir, monkeypatch, ledger_format):
+    monkeypatch.setattr(job_json, 'LEDGER_FORMAT', ledger_format)
+    added = _add(user_dir, [_entry('30.09.2026', '12:00:00', 10, 'Проезд'),
+                            _entry('01.10.2026', '08:00:00', 20),
+                            _entry('18.10.2026', '09:30:00', 30, 'Связь')])
+    _restart(user_dir)
+
+    for entry in added:
+        found = asyncio.run(job_json.find_transaction(user_dir, entry['id']))
+        assert found == {key: entry[key] for key in ('id', 'date', 'time', 'type', 'category', 'amount')}
+    assert asyncio.run(job_json.find_transaction(user_dir, 99)) is None
+    assert job_json._periods(user_dir) == ['2026-09', '2026-10']
+
+    # Формат {id}.idx: ID, момент операции и смещение в разделе месяца, 24 байта на запись
+    with open(job_json._index_path(user_dir), 'rb') as file:
+        rows = list(job_json._INDEX_ENTRY.iter_unpack(file.read()))
+    assert job_json._INDEX_ENTRY.size == 24
+    assert [(tx_id, job_ledger_bin.from_timestamp(moment)) for tx_id, moment, _ in rows] == [
+        (entry['id'], (entry['date'], entry['time'])) for entry in added]
+    # Смещение отсчитывается от начала раздела: первая запись октября лежит в начале своего раздела
+    assert rows[1][2] == rows[0][2]
+
+
+def test_set_description_by_id(user_dir):
+    added = _add(user_dir, [_entry('30.09.2026', '12:00:00', 10), _entry('18.10.2026', '09:30:00', 30)])
+
+    assert asyncio.run(job_json.set_description(user_dir, added[0]['id'], 'обед'))
+    assert not asyncio.run(job_json.set_description(user_dir, 99, 'нет такой'))
+    ledger = asyncio.run(job_json.load_ledger(user_dir))
+    assert ledger['30.09.2026']['12:00:00']['description'] == 'обед'
+    assert ledger['18.10.2026']['09:30:00']['description'] is None
+
+
+def _crash_between_index_and_ledger(user_id, monkeypatch):
+    async def fail(*args, **kwargs):
+        raise OSError("сбой записи журнала")
+
+    async def scenario():
+        reserved = await job_json.reserve(user_id, [_entry('18.10.2026', '11:00:00', 20)])
+        with monkeypatch.context() as patch:
+            patch.setattr(job_json, '_write_append', fail)
+            with pytest.raises(OSError):
+                await job_json.add_transactions(user_id, reserved)
+        return reserved[0]
+
+    return asyncio.run(scenario())
+
+
+def test_index_entry_without_ledger_record_is_not_found(user_dir, monkeypatch):
+    kept = _add(user_dir, [_entry('18.10.2026', '10:00:00', 10)])[0]
+    lost = _crash_between_index_and_ledger(user_dir, monkeypatch)
+    _restart(user_dir)
+
+    # Индекс уже содержит ID, а журнал — нет: такой ID не находится, остальные операции находятся
+    with open(job_json._index_path(user_dir), 'rb') as file:
+        assert [row[0] for row in job_json._INDEX_ENTRY.iter_unpack(file.read())] == [kept['id'], lost['id']]
+    assert asyncio.run(job_json.find_transaction(user_dir, lost['id'])) is None
+    assert asyncio.run(job_json.find_transaction(user_dir, kept['id']))['amount'] == 10
+
+
+def test_reapplied_operation_is_written_after_crash(user_dir, monkeypatch):
+    _add(user_dir, [_entry('18.10.2026', '10:00:00', 10)])
+    lost = _crash_between_index_and_ledger(user_dir, monkeypatch)
+    _restart(user_dir)
+
+    # Журнал намерений доприменяет операцию с тем же ID: ID есть в индексе, но записи нет, поэтому она дописывается
+    asyncio.run(job_json.add_transactions(user_dir, [dict(lost)]))
+    asyncio.run(job_json.add_transactions(user_dir, [dict(lost)]))
+    day = asyncio.run(job_json.load_ledger(user_dir))['18.10.2026']
+    assert {time_str: entry['amount'] for time_str, entry in day.items()} == {'10:00:00': 10, '11:00:00': 20}
+    _restart(user_dir)
+    assert asyncio.run(job_json.find_transaction(user_dir, lost['id']))['amount'] == 20
+
+
+def test_sqlite_assign_ids_keeps_issued_ids(tmp_path, monkeypatch):
+    monkeypatch.setattr(job_sqlite, 'SQLITE_PATH', str(tmp_path / 'transactions.sqlite3'))
+    job_sqlite.close()
+    try:
+        # Операции, записанные до появления столбца tx_id
+        job_sqlite.insert_transactions([('1', '17.10.2026', '10:00:00', 'Расход', 'Еда', 10, None, None),
+                                        ('1', '18.10.2026', '10:00:00', 'Расход', 'Еда', 20, None, None)])
+        # Кнопка "Добавить описание" второй операции уже отправлена с ID 5 (из файла индекса)
+        first = job_sqlite.assign_ids('1', known={('18.10.2026', '10:00:00'): 5})
+        assert first == [(6, '17.10.2026', '10:00:00'), (5, '18.10.2026', '10:00:00')]
+
+        job_sqlite.insert_transactions([('1', '19.10.2026', '10:00:00', 'Расход', 'Еда', 30, None, 7)])
+        # Назначенные ID сохранены в базе: без индекса они не меняются
+        assert job_sqlite.assign_ids('1') == first + [(7, '19.10.2026', '10:00:00')]
+        assert job_sqlite.fetch_transaction('1', 5)['amount'] == 20
+        assert job_sqlite.fetch_transaction('1', 8) is None
+    finally:
+        job_sqlite.close()
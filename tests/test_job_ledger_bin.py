@@ -0,0 +1,108 @@
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import job_ledger_bin
+
+
+def _add(amount=150, type_operation='Расход', category='Еда', date_str='02.01.1970', time_str='00:00:01', **extra):
+    record = {"op": "add", "date": date_str, "time": time_str, "type": type_operation, "category": category,
+              "amount": amount, "description": None}
+    record.update(extra)
+    return record
+
+
+def _round_trip(record):
+    return list(job_ledger_bin.decode_records(job_ledger_bin.encode_records([record], with_magic=True)))
+
+
+def _flags(encoded):
+    return encoded[5]
+
+
+def test_code_tables_are_append_only():
+    # Коды записаны в существующих файлах: эти значения не должны меняться
+    assert job_ledger_bin.MAGIC == b'FLB1'
+    assert job_ledger_bin.OPS[:2] == ('add', 'describe')
+    assert job_ledger_bin.TYPES[:2] == ('Доход', 'Расход')
+    assert job_ledger_bin.CATEGORIES[:20] == (
+        "Зп на руки", "Зп на карточку", "Шабашки", "Другие", "Жилье", "Коммуналка", "Еда", "Проезд", "Интернет",
+        "Сотовая связь", "Одежда", "Медикаменты", "Процент кредита", "Хоз расходы", "Техника", "Парикмахерская",
+        "Развлечения", "Обучение", "Подарки", "Прочие")
+
+
+def test_add_record_bytes():
+    encoded = job_ledger_bin.encode_record(_add(id=3, description='чай'))
+    assert encoded == bytes.fromhex(
+        '24000000'            # длина записи без этого поля: 36
+        '00'                  # операция add
+        '11'                  # FLAG_ID | FLAG_DESCRIPTION
+        '8151010000000000'    # 86401 секунда от 01.01.1970
+        '01'                  # Расход
+        '06'                  # Еда
+        '9600000000000000'    # сумма 150
+        '0300000000000000'    # ID 3
+        '0600' 'd187d0b0d0b9'  # описание: длина 6 байт и UTF-8
+    )
+    assert _round_trip(_add(id=3, description='чай')) == [_add(id=3, description='чай')]
+
+
+def test_describe_record_bytes():
+    record = {"op": "describe", "date": '02.01.1970', "time": '00:00:01', "description": 'x'}
+    assert job_ledger_bin.encode_record(record) == bytes.fromhex(
+        '17000000' '01' '01' '8151010000000000' '00' '00' '0000000000000000' '0100' '78')
+    assert _round_trip(record) == [record]
+
+
+def test_fractional_amount():
+    encoded = job_ledger_bin.encode_record(_add(amount=12.34))
+    assert _flags(encoded) == job_ledger_bin.FLAG_FRACTION
+    # Сумма хранится в сотых долях
+    assert int.from_bytes(encoded[16:24], 'little', signed=True) == 1234
+    assert _round_trip(_add(amount=12.34)) == [_add(amount=12.34)]
+    assert _round_trip(_add(amount=-0.5)) == [_add(amount=-0.5)]
+
+
+def test_inline_type_and_category():
+    record = _add(type_operation='Перевод', category='Кошка')
+    encoded = job_ledger_bin.encode_record(record)
+    assert _flags(encoded) == job_ledger_bin.FLAG_TYPE_INLINE | job_ledger_bin.FLAG_CATEGORY_INLINE
+    assert encoded[24:] == (bytes([len('Перевод'.encode())]) + 'Перевод'.encode()
+                            + bytes([len('Кошка'.encode())]) + 'Кошка'.encode())
+    assert _round_trip(record) == [record]
+
+
+def test_dates_before_1970():
+    for date_str, time_str in (('31.12.1969', '23:59:59'), ('01.03.1900', '12:30:00')):
+        record = _add(date_str=date_str, time_str=time_str, id=1)
+        assert job_ledger_bin.to_timestamp(date_str, time_str) < 0
+        assert job_ledger_bin.from_timestamp(job_ledger_bin.to_timestamp(date_str, time_str)) == (date_str, time_str)
+        assert _round_trip(record) == [record]
+
+
+def test_json_fallback():
+    records = [
+        _add(date_str='вчера'),                   # нестандартная дата
+        _add(amount=0.001),                       # сумма точнее сотых
+        _add(amount='100'),                       # сумма строкой
+        _add(category='К' * 200),                 # категория длиннее 255 байт
+        {"op": "split", "date": '02.01.1970', "time": '00:00:01'},  # неизвестная операция
+    ]
+    for record in records:
+        encoded = job_ledger_bin.encode_record(record)
+        assert _flags(encoded) == job_ledger_bin.FLAG_JSON
+        assert json.loads(encoded[24:].decode('utf-8')) == record
+        assert _round_trip(record) == [record]
+
+
+def test_truncated_last_record_is_skipped():
+    records = [_add(id=1), _add(amount=12.5, id=2, description='обед')]
+    content = job_ledger_bin.encode_records(records, with_magic=True)
+    assert list(job_ledger_bin.decode_records(content)) == records
+    last = len(job_ledger_bin.encode_record(records[1]))
+    # Обрыв в середине тела и в середине заголовка последней записи
+    for cut in (1, last - 10):
+        assert list(job_ledger_bin.decode_records(content[:-cut])) == records[:1]
+    assert list(job_ledger_bin.decode_records(content[:len(job_ledger_bin.MAGIC)])) == []
@@ -0,0 +1,64 @@
+import os
+import sys
+import asyncio
+import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import job_wal
+import job_xls
+import job_json
+import job_schedule
+import job_registry
+import job_aggregates
+
+UTC = datetime.timezone.utc
+
+
+@pytest.fixture
+def tokyo_user(tmp_path, monkeypatch):
+    # Пользователь восточнее сервера: отчет в 21:00 по Токио (12:00 UTC, 15:00 по Москве)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(job_registry, 'REGISTRY_PATH', str(tmp_path / 'registry.sqlite3'))
+    job_registry.close()
+    os.makedirs('user_files/7')
+    job_registry.set_schedule('7', timezone='Asia/Tokyo', delivery_time='21:00')
+    yield '7'
+    job_registry.close()
+    for module in (job_xls, job_aggregates, job_wal):
+        module.drop_user('7')
+    asyncio.run(job_json.reset_user('7'))
+
+
+def test_operation_after_delivery_lands_in_next_local_report(tokyo_user):
+    # 16:00 UTC — это 19:00 по Москве 18.10, но уже 01:00 по Токио 19.10: отчет за 18.10 пользователю уже отправлен
+    moment = datetime.datetime(2026, 10, 18, 16, 0, tzinfo=UTC)
+    local = job_schedule.local_now(tokyo_user, now=moment)
+    assert local == datetime.datetime(2026, 10, 19, 1, 0)
+
+    async def scenario():
+        await job_wal.record(tokyo_user, 'Расход', 'Еда', 100, local.strftime("%d.%m.%Y"), local.strftime("%H:%M:%S"))
+        next_day = job_schedule._due_users(datetime.datetime(2026, 10, 19, 12, 0, tzinfo=UTC),
+                                           datetime.datetime(2026, 10, 19, 12, 15, tzinfo=UTC))
+        sent = await job_json.read_and_process_file(tokyo_user, '18.10.2026', read_only=True)
+        report = await job_json.read_and_process_file(tokyo_user, '19.10.2026', read_only=True)
+        return sent, next_day, report
+
+    sent, next_day, report = asyncio.run(scenario())
+    assert 'Еда' not in sent
+    assert [(user_id, date_str) for _, user_id, date_str in next_day] == [('7', '19.10.2026')]
+    assert 'Еда' in report and '01:00:00' in report
+
+
+def test_read_only_report_does_not_migrate_legacy_ledger(tokyo_user):
+    # Журнал старого формата одним файлом: перевести его в разделы может только процесс-обработчик пользователя
+    legacy = f'user_files/{tokyo_user}/{tokyo_user}.json'
+    with open(legacy, 'w', encoding='utf-8') as file:
+        file.write('{"19.10.2026": {"01:00:00": {"description": null, "type": "Расход", "category": "Еда", '
+                   '"amount": 100}}}')
+
+    assert asyncio.run(job_json.read_and_process_file(tokyo_user, '19.10.2026', read_only=True)) is None
+    assert os.path.exists(legacy)
+    assert not os.path.exists(f'user_files/{tokyo_user}/ledger')
@@ -0,0 +1,157 @@
+import os
+import sys
+import asyncio
+import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import job_wal
+import job_xls
+import job_json
+import job_registry
+import job_aggregates
+
+DATE = datetime.datetime(2026, 10, 18)
+DATE_STR = DATE.strftime("%d.%m.%Y")
+
+
+def _restart(user_id):
+    # Имитация перезапуска после сбоя: состояние в памяти теряется, несохраненная книга тоже
+    for module in (job_wal, job_xls, job_aggregates):
+        module.drop_user(user_id)
+    asyncio.run(job_json.reset_user(user_id))
+
+
+@pytest.fixture
+def user_dir(tmp_path, monkeypatch):
+    # Модули работают с относительными путями user_files/{id}
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(job_registry, 'REGISTRY_PATH', str(tmp_path / 'registry.sqlite3'))
+    job_registry.close()
+    os.makedirs('user_files/1')
+    yield '1'
+    _restart('1')
+    job_registry.reset('1')
+    job_registry.close()
+
+
+def _build_workbook(user_id):
+    # Таблица создается так же, как в ensure_xls(), но без пула процессов
+    sums = {DATE.year: asyncio.run(job_aggregates.year_summary(user_id, DATE.year))}
+    job_xls.build_workbook(job_xls._xls_path(user_id), sums, asyncio.run(job_aggregates.applied_seq(user_id)))
+
+
+def _ledger_amounts(user_id):
+    ledger = asyncio.run(job_json.load_ledger(user_id))
+    return sorted(entry['amount'] for day in ledger.values() for entry in day.values())
+
+
+def _totals(user_id):
+    return asyncio.run(job_aggregates.month_totals(user_id, DATE.year, DATE.month))
+
+
+def _record(user_id, amount, time_str):
+    return asyncio.run(job_wal.record(user_id, 'Расход', 'Еда', amount, DATE_STR, time_str))
+
+
+def _fail(*args, **kwargs):
+    raise RuntimeError("сбой")
+
+
+def test_crash_before_ledger_is_recovered(user_dir, monkeypatch):
+    with monkeypatch.context() as patch:
+        patch.setattr(job_json, 'description_operation', _fail)
+        with pytest.raises(RuntimeError):
+            _record(user_dir, 100, '10:00:00')
+
+    # Намерение записано, но не применено ни к журналу операций, ни к суммам
+    assert [entry['amount'] for entry in job_wal._read_entries(user_dir)] == [100]
+    assert _ledger_amounts(user_dir) == []
+    assert _totals(user_dir) == (0, 0)
+
+    _restart(user_dir)
+    assert asyncio.run(job_wal.recover()) == 1
+    assert _ledger_amounts(user_dir) == [100]
+    assert _totals(user_dir) == (0, 100)
+    # Журнал намерений сокращен, повторное восстановление ничего не меняет
+    assert job_wal._read_entries(user_dir) == []
+    assert asyncio.run(job_wal.recover()) == 0
+    assert _totals(user_dir) == (0, 100)
+
+
+def test_crash_before_aggregates_is_recovered_once(user_dir, monkeypatch):
+    _record(user_dir, 10, '09:00:00')
+    with monkeypatch.context() as patch:
+        patch.setattr(job_xls, 'data_validator', _fail)
+        with pytest.raises(RuntimeError):
+            _record(user_dir, 100, '10:00:00')
+
+    # Операция уже в журнале операций, но не в суммах
+    assert _ledger_amounts(user_dir) == [10, 100]
+    assert _totals(user_dir) == (0, 10)
+
+    _restart(user_dir)
+    assert asyncio.run(job_wal.recover()) == 1
+    # Журнал операций пропускает уже записанный ID, суммы учитывают операцию один раз
+    assert _ledger_amounts(user_dir) == [10, 100]
+    assert _totals(user_dir) == (0, 110)
+    assert asyncio.run(job_aggregates.applied_seq(user_dir)) == 2
+
+
+def test_incomplete_operation_is_applied_before_the_next_one(user_dir, monkeypatch):
+    with monkeypatch.context() as patch:
+        patch.setattr(job_xls, 'data_validator', _fail)
+        with pytest.raises(RuntimeError):
+            _record(user_dir, 100, '10:00:00')
+
+    # Без перезапуска: следующая операция пользователя сначала доприменяет незавершенную
+    _record(user_dir, 50, '11:00:00')
+    assert _ledger_amounts(user_dir) == [50, 100]
+    assert _totals(user_dir) == (0, 150)
+    assert asyncio.run(job_aggregates.applied_seq(user_dir)) == 2
+
+
+def test_replay_catches_up_unsaved_workbook(user_dir, monkeypatch):
+    monkeypatch.setattr(job_xls, 'FLUSH_DELAY', 3600)
+    _build_workbook(user_dir)
+    _record(user_dir, 100, '10:00:00')
+    _record(user_dir, 20, '11:00:00')
+    # Суммы записаны до seq 2, а книга изменена только в памяти: на диске wal_seq = 0
+    assert asyncio.run(job_aggregates.applied_seq(user_dir)) == 2
+    assert job_xls.saved_seq(user_dir) == 0
+
+    _restart(user_dir)
+    assert asyncio.run(job_wal.recover()) == 2
+
+    async def read_back():
+        workbook = await job_xls._get_workbook(user_dir)
+        return job_xls._get_wal_seq(workbook), await job_xls.month_totals(user_dir, DATE.year, DATE.month)
+
+    # Книга догнала журнал намерений, суммы не удвоились
+    assert asyncio.run(read_back()) == (2, (0, 120, -120))
+    assert _totals(user_dir) == (0, 120)
+    assert job_xls.saved_seq(user_dir) == 2
+
+    # Повторное восстановление идемпотентно и для сумм, и для книги
+    _restart(user_dir)
+    assert asyncio.run(job_wal.recover()) == 0
+    assert asyncio.run(read_back()) == (2, (0, 120, -120))
+    assert _totals(user_dir) == (0, 120)
+
+
+def test_checkpoint_keeps_entries_until_both_stores_apply_them(user_dir, monkeypatch):
+    monkeypatch.setattr(job_xls, 'FLUSH_DELAY', 3600)
+    monkeypatch.setattr(job_wal, 'CHECKPOINT_EVERY', 1)
+    _build_workbook(user_dir)
+    _record(user_dir, 100, '10:00:00')
+    _record(user_dir, 20, '11:00:00')
+
+    # Суммы учли обе записи, а книга на диске — ни одной: журнал намерений не сокращается
+    assert [entry['seq'] for entry in job_wal._read_entries(user_dir)] == [1, 2]
+
+    asyncio.run(job_xls.flush_user(user_dir))
+    asyncio.run(job_wal._checkpoint(user_dir, force=True))
+    assert job_wal._read_entries(user_dir) == []
+    assert _totals(user_dir) == (0, 120)
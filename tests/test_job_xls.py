@@ -0,0 +1,59 @@
+import os
+import sys
+import asyncio
+import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import job_xls
+import job_aggregates
+
+
+@pytest.fixture
+def user_dir(tmp_path, monkeypatch):
+    # Модули работают с относительными путями user_files/{id}
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('user_files/1')
+    yield '1'
+    job_xls.drop_user('1')
+    job_aggregates.drop_user('1')
+
+
+def test_month_totals_follow_data_validator(user_dir):
+    date = datetime.datetime.now()
+
+    async def scenario():
+        await job_xls.data_validator(user_dir, 'Зп на руки', 1000, date=date)
+        # Таблица создается так же, как в ensure_xls(), но без пула процессов
+        sums = {date.year: await job_aggregates.year_summary(user_dir, date.year)}
+        job_xls.build_workbook(job_xls._xls_path(user_dir), sums)
+
+        await job_xls.data_validator(user_dir, 'Еда', 300, date=date)
+        first = await job_xls.month_totals(user_dir, date.year, date.month)
+        graph = job_xls._formulas[user_dir][job_xls.sheet_name_for(date.year)]
+
+        await job_xls.data_validator(user_dir, 'Проезд', 50, date=date)
+        second = await job_xls.month_totals(user_dir, date.year, date.month)
+        return first, second, graph
+
+    first, second, graph = asyncio.run(scenario())
+    assert first == (1000, 300, 700)
+    assert second == (1000, 350, 650)
+    # Граф формул не перестраивается: итоги пересчитаны инкрементально
+    assert job_xls._formulas[user_dir][job_xls.sheet_name_for(date.year)] is graph
+    column = job_xls.MONTH_COLUMNS[date.month]
+    assert graph.value(f'{column}30') == 350
+    assert graph.value(f'{column}34') == 650
+
+
+def test_month_totals_without_workbook(user_dir):
+    date = datetime.datetime.now()
+
+    async def scenario():
+        await job_xls.data_validator(user_dir, 'Еда', 120, date=date)
+        return await job_xls.month_totals(user_dir, date.year, date.month)
+
+    assert asyncio.run(scenario()) == (0, 120, -120)
+    assert not os.path.exists(job_xls._xls_path(user_dir))